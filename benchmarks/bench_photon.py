@@ -0,0 +1,75 @@
+"""Micro-benchmark for Photon packet building, parsing and CRC
+
+Compares the table driven CRC and bytes based hex encoding against the
+original bit-by-bit and string concatenation versions. Run with:
+
+    python benchmarks/bench_photon.py
+"""
+
+import timeit
+
+from leash.logger import Logger
+from leash.photon import Photon, Commands
+
+def bitwiseCRC(data):
+    crc = 0
+    for byte in data:
+        crc ^= (byte << 8)
+        for _ in range(8):
+            if crc & 0x8000:
+                crc ^= (0x1070 << 3)
+            crc <<= 1
+
+    return (crc >> 8) & 0xFF
+
+def concatPacketFromBytes(packet):
+    packet = list(packet)
+    packet.insert(4, bitwiseCRC(packet))
+
+    packetString = "M485 "
+    for i in packet:
+        converted = hex(i)[2:]
+        if len(converted) == 1:
+            converted = "0" + converted
+        packetString = packetString + converted
+
+    return packetString
+
+def slicedBytesFromPacket(responseString):
+    byteArray = []
+    for i in range(int(len(responseString)/2)):
+        index = i*2
+        byteArray.append(int(responseString[index:index+2], 16))
+
+    return byteArray
+
+def run(number=20000):
+    photon = Photon(None, Logger(False))
+
+    # an INITIALIZE_FEEDER packet carries the largest payload we send, a uuid
+    packet = [0x03, 0x00, 0x2a, 13, Commands.INITIALIZE_FEEDER] + list(range(12))
+    reply = photon.buildPacketFromBytes(packet)[5:]
+
+    cases = {
+        "crc": (lambda: bitwiseCRC(packet), lambda: photon.crc(packet)),
+        "build": (lambda: concatPacketFromBytes(packet), lambda: photon.buildPacketFromBytes(packet)),
+        "parse": (lambda: slicedBytesFromPacket(reply), lambda: photon.buildBytesFromPacket(reply))
+    }
+
+    results = {}
+
+    for name, (before, after) in cases.items():
+        beforeTime = min(timeit.repeat(before, number=number, repeat=5)) / number
+        afterTime = min(timeit.repeat(after, number=number, repeat=5)) / number
+
+        results[name] = {
+            "before_us": beforeTime * 1e6,
+            "after_us": afterTime * 1e6,
+            "speedup": beforeTime / afterTime
+        }
+
+    return results
+
+if __name__ == "__main__":
+    for name, result in run().items():
+        print(f"{name:>6}: {result['before_us']:7.2f} us -> {result['after_us']:7.2f} us ({result['speedup']:.1f}x)")
@@ -0,0 +1,85 @@
+"""Benchmark for the Photon reply parser on a recorded bus log
+
+Replays a log made with leash.Recorder through Photon.parseResponse. With no
+log given, a synthetic one is written first: status polls of a bank of
+feeders with a sprinkling of timeouts, bad crcs and garbled replies. Run with:
+
+    python benchmarks/bench_replay.py [log] [--frames N]
+"""
+
+import argparse, os, random, tempfile, time
+
+from leash.logger import Logger
+from leash.photon import Photon, Commands
+from leash.recorder import Recorder, Trace, replay
+
+def synthesize(path, frames, seed = 1):
+    photon = Photon(None, Logger(False))
+    rng = random.Random(seed)
+
+    with Recorder(path) as recorder:
+        photon.recorder = recorder
+
+        for i in range(frames // 2):
+            address = 1 + i % 40
+            gcode, packetID = photon.buildRequest(address, Commands.MOVE_FEED_STATUS)
+
+            reply = bytearray(photon.buildPacketFromBytes((0x00, address, packetID, 1, 0x00))[5:], "ascii")
+            roll = rng.random()
+
+            if roll < 0.02:
+                recorder.reply(address, packetID, "TIMEOUT")
+                continue
+            elif roll < 0.03:
+                # flips a crc bit
+                reply[9] = ord("0") if reply[9] != ord("0") else ord("1")
+            elif roll < 0.035:
+                reply = reply[:5]
+
+            recorder.reply(address, packetID, reply.decode("ascii"))
+
+        photon.recorder = None
+
+def run(path, frames):
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        synthesize(path, frames)
+        print(f"wrote {frames} frames to {path} in {time.perf_counter() - start:.2f} s")
+
+    start = time.perf_counter()
+    with Trace(path) as trace:
+        scanned = sum(1 for _ in trace)
+    scanTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = {"ok": 0, "timeout": 0, "bad": 0}
+
+    for frame, resp in replay(path):
+        if resp == -1:
+            results["timeout"] += 1
+        elif resp is False:
+            results["bad"] += 1
+        else:
+            results["ok"] += 1
+
+    replayTime = time.perf_counter() - start
+    replies = sum(results.values())
+
+    print(f"  scan: {scanned} frames in {scanTime:.2f} s ({scanned / scanTime:,.0f} frames/s)")
+    print(f"replay: {replies} replies in {replayTime:.2f} s ({replies / replayTime:,.0f} replies/s), {results}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("log", nargs="?", help="bus log to replay, a synthetic one is made if left out")
+    parser.add_argument("--frames", type=int, default=1000000, help="frames in the synthetic log")
+    args = parser.parse_args()
+
+    if args.log:
+        run(args.log, args.frames)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        run(os.path.join(directory, "bus.lpbr"), args.frames)
+
+if __name__ == "__main__":
+    main()
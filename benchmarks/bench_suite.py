@@ -0,0 +1,261 @@
+"""Benchmarks for the serial, Photon, pump and vision hot paths
+
+Everything runs against sim.VirtualLumen, so no machine is needed and the
+numbers only move when the library does. Results are written as JSON, one
+file per version, and can be compared against an earlier run:
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --compare benchmarks/results/0.0.1.json
+"""
+
+import argparse, json, os, platform, statistics, sys, time
+
+import cv2
+import numpy as np
+
+from leash import Lumen, VirtualLumen, FiducialFinder, PartFinder
+from leash.__about__ import __version__
+from leash.photon import Commands
+from leash.sim import feederBank
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# results within this fraction of the baseline are treated as noise
+TOLERANCE = 0.25
+
+def timed(fn, repeat):
+    # runs fn repeat times and returns the sorted durations in seconds
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+
+    return sorted(durations)
+
+def summary(durations):
+    return {
+        "median_ms": statistics.median(durations) * 1e3,
+        "min_ms": durations[0] * 1e3,
+        "p95_ms": durations[int(len(durations) * 0.95) - 1] * 1e3
+    }
+
+def connect(latency, **kwargs):
+    sim = VirtualLumen(latency = latency, **kwargs)
+    lumen = Lumen(debug = False, transport = sim)
+
+    if not lumen.connect():
+        raise RuntimeError("Couldn't connect to the simulated Lumen")
+
+    return lumen, sim
+
+#####################
+# Cases
+#####################
+
+def benchSend(latency, count = 500):
+    lumen, _ = connect(latency)
+
+    try:
+        start = time.perf_counter()
+        for i in range(count):
+            lumen.sm.send("G0 X" + str(i % 100))
+        sent = time.perf_counter() - start
+
+        commands = ["G0 X" + str(i % 100) for i in range(count)]
+        start = time.perf_counter()
+        lumen.sm.stream(commands)
+        lumen.sm.drain(30)
+        streamed = time.perf_counter() - start
+    finally:
+        lumen.disconnect()
+
+    return {
+        "send_per_s": count / sent,
+        "stream_per_s": count / streamed
+    }
+
+def benchPacket(number = 20000):
+    lumen, _ = connect(0)
+    photon = lumen.photon
+    lumen.disconnect()
+
+    uuid = list(range(12))
+    packet = bytearray((0x03, 0x00, 0x2a, 13, Commands.INITIALIZE_FEEDER)) + bytes(uuid)
+    reply = "rs485-reply: " + photon.buildPacketFromBytes(bytearray((0x00, 0x03, 0x2a, 13, 0x00)) + bytes(uuid))[5:]
+
+    def build():
+        for _ in range(number):
+            photon.buildPacketFromBytes(packet)
+
+    def parse():
+        for _ in range(number):
+            photon.parseResponse(reply, 0x03, 0x2a)
+
+    def crc():
+        for _ in range(number):
+            photon.crc(packet)
+
+    return {name: min(timed(fn, 5)) / number * 1e6 for name, fn in (("build_us", build), ("parse_us", parse), ("crc_us", crc))}
+
+def benchSendPacket(latency, count = 200):
+    lumen, sim = connect(latency, feeders = feederBank([3]))
+
+    try:
+        durations = timed(lambda: lumen.photon.sendPacket(3, Commands.GET_FEEDER_ID), count)
+    finally:
+        lumen.disconnect()
+
+    return summary(durations)
+
+def benchPressure(latency, count = 100):
+    lumen, sim = connect(latency)
+    sim.sensors[1].pressure = -120000
+
+    try:
+        durations = timed(lumen.leftPump.getPressure, count)
+    finally:
+        lumen.disconnect()
+
+    return summary(durations)
+
+def benchScan(latency, rs485Timeout):
+    lumen, _ = connect(latency, feeders = feederBank([1, 5, 9, 13, 20]), rs485Timeout = rs485Timeout)
+
+    try:
+        start = time.perf_counter()
+        found = lumen.photon.scan(1, 30)
+        duration = time.perf_counter() - start
+    finally:
+        lumen.disconnect()
+
+    if len(found) != 5:
+        raise RuntimeError("Scan found " + str(len(found)) + " of 5 simulated feeders")
+
+    return {"duration_ms": duration * 1e3, "addresses": 30}
+
+def frames():
+    # a dark 720p frame with a fiducial off center and a rotated part
+    image = np.full((720, 1280, 3), 40, dtype=np.uint8)
+    cv2.circle(image, (663, 347), 20, (230, 230, 230), -1)
+
+    part = np.full((720, 1280, 3), 30, dtype=np.uint8)
+    box = cv2.boxPoints(((652.5, 371.5), (180, 90), 12.0)).astype(np.int32)
+    cv2.fillPoly(part, [box], (220, 220, 220))
+
+    return image, part
+
+def benchVision(count = 50):
+    image, part = frames()
+
+    template = np.full((61, 61, 3), 40, dtype=np.uint8)
+    cv2.circle(template, (30, 30), 20, (230, 230, 230), -1)
+
+    roi = (440, 160, 400, 400)
+
+    finders = {
+        "fiducial_moments": FiducialFinder(roi = roi, scale = 0.5),
+        "fiducial_hough": FiducialFinder(mode = "hough", roi = roi, scale = 0.5),
+        "fiducial_template": FiducialFinder(mode = "template", template = template, roi = roi, scale = 0.5),
+        "part": PartFinder(scale = 0.5)
+    }
+
+    results = {}
+    for name, finder in finders.items():
+        frame = part if name == "part" else image
+
+        # the first call sizes the finder's buffers
+        if finder.find(frame) is False:
+            raise RuntimeError(name + " found nothing in the test frame")
+
+        results[name] = summary(timed(lambda: finder.find(frame), count))
+
+    return results
+
+#####################
+# Running
+#####################
+
+def run(latency = 0.0005, rs485Timeout = 0.05):
+    return {
+        "send": benchSend(latency),
+        "packet": benchPacket(),
+        "send_packet": benchSendPacket(latency),
+        "get_pressure": benchPressure(latency),
+        "scan": benchScan(latency, rs485Timeout),
+        "vision": benchVision()
+    }
+
+def flatten(results, prefix = ""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+
+    return flat
+
+def compare(results, baseline):
+    # returns the metrics that got worse by more than TOLERANCE. rates are
+    # better higher, everything else is a time and better lower. min and p95
+    # are too noisy to gate on, medians stand in for them
+    regressions = []
+
+    old = flatten(baseline["results"])
+    for name, value in flatten(results).items():
+        if name not in old or not old[name] or name.endswith(("addresses", "min_ms", "p95_ms")):
+            continue
+
+        change = (value - old[name]) / old[name]
+        if name.endswith("_per_s"):
+            change = -change
+
+        if change > TOLERANCE:
+            regressions.append((name, old[name], value))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark leash against the simulated Lumen")
+    parser.add_argument("--output", help = "JSON file to write, defaults to benchmarks/results/<version>.json")
+    parser.add_argument("--compare", help = "earlier results to check for regressions")
+    parser.add_argument("--latency", type = float, default = 0.0005, help = "one way simulated usb latency in seconds")
+    args = parser.parse_args()
+
+    results = run(latency = args.latency)
+
+    report = {
+        "version": __version__,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "results": results
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, __version__ + ".json")
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent = 2)
+
+    for name, value in flatten(results).items():
+        print(f"{name:>40}: {value:10.3f}")
+
+    print("Wrote " + output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.3f} -> {after:.3f}")
+
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
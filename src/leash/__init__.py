@@ -6,41 +6,61 @@ APP_URL = 'https://github.com/opulo-inc/'
 
 import time
 
+from . import gcode
+from . import cache
 from .logger import Logger
 from .serial import SerialManager
 
 from .photon import Photon
-from .camera import Camera
+from .registry import FeederRegistry
+from .camera import Camera, findCameras
+from .vision import FiducialFinder, PartFinder
+from .calibration import CameraCalibration, calibrateFromMoves
+from .planner import Placement, JobPlanner
+from .kinematics import MotionModel
 from .pump import Pump
+from .monitor import PressureMonitor
+from .metrics import Metrics
+from .aio import AsyncLumen
+from .fleet import Fleet
+from .sim import VirtualLumen, SimFeeder
+from .recorder import Recorder, Trace, replay
 
 """Lumen object, containing all other subsystems
 """
 
 class Lumen():
 
-    def __init__(self, debug=True, topCam = False, botCam = False):
+    # port skips the scan and opens that serial port, as Fleet does for each
+    # machine. transport replaces the usb serial port, e.g. a sim.VirtualLumen
+    def __init__(self, debug=True, topCam = False, botCam = False, transport = None, port = None):
 
         self.log = Logger(debug)
 
-        self.sm = SerialManager(self.log)
-        self.photon = Photon(self.sm, self.log)
+        # each subsystem logs as leash.<name>, so levels can be set apart
+        self.sm = SerialManager(self.log.child("serial"), transport = transport)
 
-        self.leftPump = Pump("LEFT", self.sm, self.log)
-        self.rightPump = Pump("RIGHT", self.sm, self.log)
+        if port is not None:
+            self.sm._ser.port = port
+        self.photon = Photon(self.sm, self.log.child("photon"))
 
-        self.position = {
-            "x": None, 
-            "y": None,
-            "z": None,
-            "a": 0,
-            "b": 0
-        }
+        # round trip histograms and error counters for serial and photon
+        self.metrics = self.sm.metrics
 
+        # what the machine's settings are after the commands sent so far,
+        # goto, lights and pumps skip commands it says change nothing
+        self.state = self.sm.state
+
+        self.leftPump = Pump("LEFT", self.sm, self.log.child("pump"))
+        self.rightPump = Pump("RIGHT", self.sm, self.log.child("pump"))
+
+        # cameras open in the background while the serial port connects. True
+        # uses the index that camera had last time
         if topCam is not False:
-            self.topCam = Camera(topCam)
+            self.topCam = Camera(self._cameraIndex("top", topCam), background = True)
 
         if botCam is not False:
-            self.botCam = Camera(botCam)
+            self.botCam = Camera(self._cameraIndex("bot", botCam), background = True)
 
 
         self._bootCommands = [
@@ -72,32 +92,53 @@ class Lumen():
         self.parkY = 400
         self.parkZ = 31.5
 
+        # the motion model inside self.state, which follows every command
+        # sent. the time it expects the queued moves to take sizes
+        # finishMoves() waits
+        self.motion = self.state.motion
+        self.sm.estimator = self.motion.remaining
+
 
 #####################
 # Serial
 #####################
 
     def connect(self):
-        if self.sm.scanPorts():
-            if self.sm.openSerial():
-                self.sendBootCommands()
-                return True
+        # a port that is already set, like a simulated one, skips the scan
+        if self.sm._ser.port or self.sm.scanPorts():
+            opened = self.sm.openSerial()
+
+            if not opened and self.sm.portFromCache:
+                # the last known port is gone or taken, look again
+                self.sm.forgetPort()
+                opened = self.sm.scanPorts() and self.sm.openSerial()
+
+            if opened:
+                return self.sendBootCommands()
             
         return False
     
     def disconnect(self):
-        self.sm._ser.close()
-        if self.sm._ser.is_open:
-            return False
-        else:
-            return True
+        # the pressure monitors read through the port, so they stop first
+        self.leftPump.stopMonitor()
+        self.rightPump.stopMonitor()
+
+        return self.sm.closeSerial()
         
-    def finishMoves(self):
-        self.sm.clearQueue()
+    def finishMoves(self, timeout=None):
+        # blocks until every move sent so far is done, returns False if the
+        # machine didn't finish in timeout, by default the estimated time
+        done = self.sm.clearQueue(timeout)
+
+        if done:
+            self.motion.settled()
+
+        return done
 
     def sleep(self, seconds):
-        self.finishMoves()
+        done = self.finishMoves()
         time.sleep(seconds)
+        return done
 
     def getHardwareID(self):
         #probe for all hardware pullup pins, plus chimera jumper
@@ -110,37 +151,56 @@ class Lumen():
 #####################
 
     def goto(self, x=None, y=None, z=None, a=None, b=None):
-        command = "G0"
-        if x is not None:
-            command = command + " X" + str(x)
-            self.position["x"] = x
-        if y is not None:
-            command = command + " Y" + str(y)
-            self.position["y"] = y
-        if z is not None:
-            command = command + " Z" + str(z)
-            self.position["z"] = z
-        if a is not None:
-            command = command + " A" + str(a)
-            self.position["a"] = a
-        if b is not None:
-            command = command + " B" + str(b)
-            self.position["b"] = b
-
-        print(command)
-        self.sm.send(command)
+        command = self._moveCommand(x, y, z, a, b)
+
+        self.log.debug("Moving: %s", command)
+        self.sm.sendCached(command)
+
+    def gotoSequence(self, moves):
+        # streams a list of moves, each a dict of goto arguments, keeping
+        # marlin's buffer full instead of waiting on each round trip
+        commands = [self._moveCommand(**move) for move in moves]
+
+        return self.sm.streamCached(commands)
+
+    @property
+    def position(self):
+        # where the commands sent so far leave each axis, None where that
+        # isn't known. a view of self.state, which follows every send
+        return self.state.position
+
+    def estimate(self, moves):
+        # seconds the machine will take to run moves, a list of goto style
+        # dicts or G-code commands, starting from the current position
+        return self.motion.estimate(moves)
+
+    def runJob(self, placements, optimize = True, dwell = 100):
+        # plans a list of Placements, ordered to cut travel when optimize is
+        # set, and streams the whole job. returns once it has all been sent,
+        # use finishMoves() to wait for the machine
+        planner = JobPlanner(self, dwell = dwell)
+        commands = planner.commands(placements, optimize = optimize)
+
+        return self.sm.streamCached(commands)
+
+    def _moveCommand(self, x=None, y=None, z=None, a=None, b=None):
+        return gcode.move(x, y, z, a, b)
 
     def setSpeed(self, f=None):
         if f is not None:
-            command = "G0 F" + str(f)
-            self.sm.send(command)
+            self.sm.sendCached(self._speedCommand(f))
+
+    def _speedCommand(self, f):
+        return "G0 F" + gcode.number(f)
         
     def sendBootCommands(self):
+        # streamed, so only the whole batch waits on marlin rather than
+        # every command's round trip
+        if not self.sm.stream(self._bootCommands) or not self.sm.drain():
+            self.log.error("Halted sending boot commands because sending failed.")
+            return False
 
-        for i in self._bootCommands:
-            if not self.sm.send(i):
-               self.log.error("Halted sending boot commands because sending failed.")
-               break
+        return True
 
 
     def sendPreHomingCommands(self):
@@ -168,28 +228,36 @@ class Lumen():
 
         self.sendPreHomingCommands()
 
-        if x and y and z:
-            self.sm.send("G28")
-            self.position["x"] = 0
-            self.position["y"] = 0
-            self.position["z"] = 0
-
-        else:
-            if x or y or z:
-                command = "G28"
-                if x:
-                    command = command + " X"
-                if y:
-                    command = command + " Y"
-                if z:
-                    command = command + " Z"
-
-                self.sm.send(command)
-
-        self.finishMoves()
+        command = self._homeCommand(x, y, z)
+
+        # homing holds marlin for as long as it takes, so its ok isn't waited
+        # on with the port timeout. the marker behind it waits for it instead
+        if command is not None and self.sm.submit(command) is False:
+            return False
+
+        done = self.finishMoves()
         
         self.sendPostHomingCommands()
 
+        return done
+
+    def _homeCommand(self, x = True, y = True, z = True):
+        if x and y and z:
+            return "G28"
+
+        if x or y or z:
+            command = "G28"
+            if x:
+                command = command + " X"
+            if y:
+                command = command + " Y"
+            if z:
+                command = command + " Z"
+
+            return command
+
+        return None
+
     def sendPostHomingCommands(self):
 
         for i in self._postHomeCommands:
@@ -204,14 +272,29 @@ class Lumen():
 # LEDS
 
     def lightOff(self, index):
-        s = 0 if index == "BOT" else 1
-
-        self.sm.send(f"M150 P0 R0 U0 B0 S{s}")
+        self.sm.sendCached(self._lightCommand(index, 0, 0, 0, 0))
 
     def lightOn(self, index, r=255, g=255, b=255, a=255):
+        self.sm.sendCached(self._lightCommand(index, r, g, b, a))
 
-        s = 0 if index == "BOT" else 1
 
-        self.sm.send(f"M150 P{a} R{r} U{g} B{b} S{s}")
+    def _cameraIndex(self, name, index):
+        cameras = cache.load("cameras")
+
+        if index is True:
+            if name in cameras:
+                return cameras[name]
+
+            self.log.error("No known index for the %s camera, using 1", name)
+            return 1
+
+        if cameras.get(name) != index:
+            cameras[name] = index
+            cache.save("cameras", cameras)
+
+        return index
+
+    def _lightCommand(self, index, r, g, b, a):
+        s = 0 if index == "BOT" else 1
 
-        print("turned on light yo")
\ No newline at end of file
+        return f"M150 P{a} R{r} U{g} B{b} S{s}"
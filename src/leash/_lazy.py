@@ -0,0 +1,32 @@
+"""Deferred imports for heavy optional modules
+
+A module imported with lazy("cv2") is only really imported on first
+attribute access, so users without cameras never pay for OpenCV.
+"""
+
+import importlib, threading
+
+class LazyModule():
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attribute):
+        # only called for attributes the proxy itself doesn't have
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return "<lazy module " + repr(self._name) + (" (loaded)>" if self._module is not None else ">")
+
+def lazy(name):
+    return LazyModule(name)
@@ -0,0 +1,341 @@
+"""asyncio facade over a Lumen and its subsystems
+
+Every call awaits the serial reader's futures instead of blocking on the
+port, so motion, feeder advances and vacuum polling can overlap on one
+event loop.
+"""
+
+import asyncio, time
+
+from .photon import Commands
+
+class AsyncSerialManager():
+
+    def __init__(self, sm):
+        self.sm = sm
+
+    async def submit(self, message):
+        # submitting only blocks while marlin's buffer is full, so hand that
+        # case off to a worker rather than stalling the event loop
+        if self.sm.full():
+            return await asyncio.get_running_loop().run_in_executor(None, self.sm.submit, message)
+
+        return self.sm.submit(message)
+
+    def full(self):
+        return self.sm.full()
+
+    async def send(self, message, timeout=None):
+        # same return values as SerialManager.send
+        if timeout is None:
+            timeout = self.sm.timeout
+
+        future = await self.submit(message)
+
+        if future is False:
+            return False
+
+        try:
+            # shielded so a timeout here doesn't fail the command for the reader
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            self.sm.replyTimedOut(message)
+            return ""
+        except OSError:
+            return False
+
+    async def result(self, future, timeout=None):
+        # same as SerialManager.result, awaiting the future
+        waiting = asyncio.wrap_future(future)
+
+        if timeout is None:
+            return await waiting
+
+        giveUp = time.perf_counter() + self.sm.streamTimeout
+
+        while True:
+            wait = self.sm.resultWait(future, timeout, giveUp)
+
+            try:
+                return await asyncio.wait_for(asyncio.shield(waiting), 0 if wait is None else wait)
+            except asyncio.TimeoutError:
+                if wait is None:
+                    raise
+
+    async def stream(self, messages):
+        for message in messages:
+            if await self.submit(message) is False:
+                return False
+
+        return True
+
+    async def submitCached(self, message):
+        # see SerialManager.submitCached
+        if self.sm.full():
+            return await asyncio.get_running_loop().run_in_executor(None, self.sm.submitCached, message)
+
+        return self.sm.submitCached(message)
+
+    async def streamCached(self, messages):
+        for message in messages:
+            if await self.submitCached(message) is False:
+                return False
+
+        return True
+
+    async def sendCached(self, message, timeout=None):
+        reduced = self.sm.state.reduce(message)
+
+        if reduced is None:
+            return "ok"
+
+        return await self.send(reduced, timeout)
+
+    async def clearQueue(self, timeout=None):
+        # marking can block on a full buffer, so it runs on a worker
+        marker = await asyncio.get_running_loop().run_in_executor(None, self.sm.mark)
+
+        if marker is False:
+            return False
+
+        return await self.waitMarker(marker, timeout)
+
+    async def waitMarker(self, marker, timeout=None):
+        # same as SerialManager.waitMarker, awaiting the marker's future
+        future, timeout = self.sm.beginMarkerWait(marker, timeout)
+
+        if future is None:
+            return marker <= self.sm.markerDone
+
+        waiting = asyncio.wrap_future(future)
+        deadline = time.perf_counter() + timeout
+
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiting), max(0, deadline - time.perf_counter()))
+                return True
+            except asyncio.TimeoutError:
+                deadline = self.sm.markerOverdue(marker, timeout)
+
+                if deadline is None:
+                    return False
+            except OSError:
+                return False
+
+class AsyncPump():
+
+    def __init__(self, pump, sm):
+        self.pump = pump
+        self.sm = sm
+
+    # sensor reads run the sync ones on a worker. both sensors sit behind one
+    # multiplexer, and the sync reads and the pressure monitor already take
+    # the serial manager's i2c lock around a whole read sequence, so taking
+    # that same lock is the only way to keep them from interleaving
+    async def get_pressure(self, timeout=0.05):
+        return await asyncio.get_running_loop().run_in_executor(None, self.pump.getPressure, timeout)
+
+    async def get_temperature(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.pump.getTemperature)
+
+    async def on(self):
+        for i in self.pump.onCommands():
+            await self.sm.sendCached(i)
+
+    async def off(self):
+        for i in self.pump.offCommands():
+            await self.sm.sendCached(i)
+
+class AsyncPhoton():
+
+    def __init__(self, photon, sm):
+        self.photon = photon
+        self.sm = sm
+
+    async def send_packet(self, address, command: Commands, payload = None):
+        # retries the same way as Photon.sendPacket
+        attempt = 0
+
+        while True:
+            gcode, sentPacketID = self.photon.buildRequest(address, command, payload)
+
+            start = time.perf_counter()
+            future = await self.sm.submit(gcode)
+
+            if future is False:
+                return -1
+
+            try:
+                response = await self.sm.result(future, self.photon.replyTimeout(address, command, attempt))
+            except asyncio.TimeoutError:
+                # same as Photon._sendOnce, the ok is still owed
+                future.add_done_callback(lambda done, packetID=sentPacketID: self.photon.lateReply(address, packetID, done))
+                response = ""
+            except Exception:
+                response = ""
+
+            resp = self.photon.parseTimed(response, address, sentPacketID, start, future.started)
+
+            delay = self.photon.nextRetry(address, command, resp, attempt)
+
+            if delay is None:
+                return resp
+
+            attempt = attempt + 1
+            await asyncio.sleep(delay)
+
+    async def _sendForStatus(self, address, command, payload = None):
+        return self.photon.isOK(await self.send_packet(address, command, payload = payload))
+
+    async def get_feeder_uuid(self, address):
+        return self.photon.uuidFromResponse(await self.send_packet(address, Commands.GET_FEEDER_ID))
+
+    async def initialize_feeder(self, address, uuid):
+        return await self._sendForStatus(address, Commands.INITIALIZE_FEEDER, payload = uuid)
+
+    async def move_feed_forward(self, address, tenths):
+        return await self._sendForStatus(address, Commands.MOVE_FEED_FORWARD, payload = [tenths])
+
+    async def move_feed_backward(self, address, tenths):
+        return await self._sendForStatus(address, Commands.MOVE_FEED_BACKWARD, payload = [tenths])
+
+    async def move_feed_status(self, address):
+        return await self._sendForStatus(address, Commands.MOVE_FEED_STATUS)
+
+    def start_feed_forward(self, address, tenths):
+        # returns an awaitable that resolves once the feeder accepts the move
+        return self._startFeed(self.photon.startFeedForward, address, tenths)
+
+    def start_feed_backward(self, address, tenths):
+        return self._startFeed(self.photon.startFeedBackward, address, tenths)
+
+    def _startFeed(self, start, address, tenths):
+        if not self.sm.full():
+            return asyncio.wrap_future(start(address, tenths))
+
+        # starting blocks while marlin's buffer is full, so it goes to a worker
+        return asyncio.ensure_future(self._startOnWorker(start, address, tenths))
+
+    async def _startOnWorker(self, start, address, tenths):
+        accepted = await asyncio.get_running_loop().run_in_executor(None, start, address, tenths)
+        return await asyncio.wrap_future(accepted)
+
+    async def wait_feeders_ready(self, addresses = None, timeout = 5, interval = 0.01):
+        # same as Photon.waitFeedersReady, without blocking the loop
+        if addresses is None:
+            addresses = set(self.photon.feeding)
+
+        waiting = set(addresses)
+        start = time.perf_counter()
+
+        while waiting:
+            polls = [(address, asyncio.wrap_future(self.photon.submitPacket(address, Commands.MOVE_FEED_STATUS))) for address in waiting]
+
+            if not self.photon.checkStatuses(waiting, [(address, await future) for address, future in polls]):
+                return False
+
+            if not waiting:
+                break
+
+            if self.photon.feedWaitExpired(waiting, start, timeout):
+                return False
+
+            await asyncio.sleep(interval)
+
+        return True
+
+class AsyncLumen():
+
+    def __init__(self, lumen = None, **kwargs):
+
+        if lumen is None:
+            from . import Lumen
+            lumen = Lumen(**kwargs)
+
+        self.lumen = lumen
+        self.log = lumen.log
+
+        self.sm = AsyncSerialManager(lumen.sm)
+        self.photon = AsyncPhoton(lumen.photon, self.sm)
+
+        self.leftPump = AsyncPump(lumen.leftPump, self.sm)
+        self.rightPump = AsyncPump(lumen.rightPump, self.sm)
+
+    @property
+    def position(self):
+        return self.lumen.position
+
+    async def connect(self):
+        # port discovery, opening and the streamed boot commands are one-off
+        # blocking calls, run off the loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.lumen.connect)
+
+    async def disconnect(self):
+        # joins the reader and monitor threads, so it runs on a worker
+        return await asyncio.get_running_loop().run_in_executor(None, self.lumen.disconnect)
+
+    async def _sendAll(self, commands, name):
+        for i in commands:
+            if not await self.sm.send(i):
+                self.log.error("Halted sending %s commands because sending failed.", name)
+                return False
+
+        return True
+
+    async def finish_moves(self, timeout=None):
+        done = await self.sm.clearQueue(timeout)
+
+        if done:
+            self.lumen.motion.settled()
+
+        return done
+
+    async def sleep(self, seconds):
+        await self.finish_moves()
+        await asyncio.sleep(seconds)
+
+    async def goto(self, x=None, y=None, z=None, a=None, b=None):
+        await self.sm.sendCached(self.lumen._moveCommand(x, y, z, a, b))
+
+    async def goto_sequence(self, moves):
+        return await self.sm.streamCached([self.lumen._moveCommand(**move) for move in moves])
+
+    async def set_speed(self, f=None):
+        if f is not None:
+            await self.sm.sendCached(self.lumen._speedCommand(f))
+
+    async def home(self, x = True, y = True, z = True):
+        self.log.info("Homing")
+
+        await self._sendAll(self.lumen._preHomeCommands, "pre homing")
+
+        command = self.lumen._homeCommand(x, y, z)
+
+        # see Lumen.home
+        if command is not None and await self.sm.submit(command) is False:
+            return False
+
+        done = await self.finish_moves()
+
+        await self._sendAll(self.lumen._postHomeCommands, "post homing")
+
+        return done
+
+    async def safe_z(self):
+        await self.goto(z=self.lumen.parkZ)
+
+    async def idle(self):
+        await asyncio.gather(self.leftPump.off(), self.rightPump.off())
+
+        await self.light_off("TOP")
+        await self.light_off("BOT")
+
+        await self.safe_z()
+
+        await self.goto(x=self.lumen.parkX, y=self.lumen.parkY)
+
+    async def light_on(self, index, r=255, g=255, b=255, a=255):
+        await self.sm.sendCached(self.lumen._lightCommand(index, r, g, b, a))
+
+    async def light_off(self, index):
+        await self.sm.sendCached(self.lumen._lightCommand(index, 0, 0, 0, 0))
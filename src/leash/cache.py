@@ -0,0 +1,42 @@
+"""Small JSON files under ~/.leash remembering what startup found last time
+"""
+
+import json, os
+
+from .registry import CACHE_DIR
+
+def path(name):
+    return os.path.join(CACHE_DIR, name + ".json")
+
+def load(name):
+    # returns the cached dict, or an empty one if there is none yet
+    try:
+        with open(path(name)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return data if isinstance(data, dict) else {}
+
+def save(name, data):
+    # returns False instead of raising, a cache that can't be written only
+    # costs the next startup some time
+    target = path(name)
+
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        temp = target + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(data, f, indent=2)
+
+        os.replace(temp, target)
+    except OSError:
+        return False
+
+    return True
+
+def update(name, **values):
+    data = load(name)
+    data.update(values)
+    return save(name, data)
@@ -0,0 +1,255 @@
+"""Camera calibration, mapping camera pixels to Lumen machine millimeters
+"""
+
+import os, time
+
+import numpy as np
+
+from ._lazy import lazy
+from .registry import CACHE_DIR
+
+cv2 = lazy("cv2")
+
+class CameraCalibration():
+
+    def __init__(self):
+
+        # lens intrinsics, from fitIntrinsics()
+        self.cameraMatrix = None
+        self.distCoeffs = None
+        self.imageSize = None
+
+        # 2x2 millimeters per pixel matrix, including any rotation of the
+        # camera relative to the machine axes, from fitScale()
+        self.pixelToMM = None
+
+        # camera center relative to the head in millimeters. only known when
+        # fitScale() is given the fiducial's machine position
+        self.offset = None
+
+        # cached remap tables, so undistorting a frame is a single remap
+        self._map1 = None
+        self._map2 = None
+        self._undistorted = None
+
+    @staticmethod
+    def defaultPath(name):
+        return os.path.join(CACHE_DIR, "camera-" + str(name) + ".npz")
+
+#####################
+# Fitting
+#####################
+
+    def fitIntrinsics(self, images, pattern = (9, 6), squareSize = 1.0):
+        # fits the camera matrix and distortion from several views of a
+        # chessboard with pattern inner corners. returns the rms reprojection
+        # error in pixels, or False if the board wasn't found often enough
+
+        objectPoints = np.zeros((pattern[0] * pattern[1], 3), np.float32)
+        objectPoints[:, :2] = np.mgrid[0:pattern[0], 0:pattern[1]].T.reshape(-1, 2) * squareSize
+
+        objects = []
+        corners = []
+        size = None
+
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+        for image in images:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+            size = (gray.shape[1], gray.shape[0])
+
+            found, found_corners = cv2.findChessboardCorners(gray, pattern)
+
+            if found:
+                corners.append(cv2.cornerSubPix(gray, found_corners, (11, 11), (-1, -1), criteria))
+                objects.append(objectPoints)
+
+        if len(corners) < 3:
+            return False
+
+        error, self.cameraMatrix, self.distCoeffs, _, _ = cv2.calibrateCamera(objects, corners, size, None, None)
+        self.imageSize = size
+
+        self.buildMaps()
+
+        return error
+
+    def fitScale(self, headPositions, pixels, imageSize, fiducial = None):
+        # fits the pixel to millimeter matrix from a fixed target seen at
+        # pixels[i] while the head was at headPositions[i] (x, y). with the
+        # head at H, a feature at pixel p sits at H + offset + M (p - c), and
+        # for a fixed target that is constant, so H = K - M (p - c) is linear
+        # in M and K. if the target's machine position is known, the camera
+        # offset falls out as fiducial - K. returns the rms residual in mm
+
+        if len(pixels) < 3:
+            return False
+
+        center = self._center(imageSize)
+
+        p = np.asarray(pixels, dtype=np.float64) - center
+        H = np.asarray(headPositions, dtype=np.float64)
+
+        # rows for x and y of each sample, unknowns [m00, m01, m10, m11, kx, ky]
+        A = np.zeros((len(p) * 2, 6))
+        A[0::2, 0] = -p[:, 0]
+        A[0::2, 1] = -p[:, 1]
+        A[0::2, 4] = 1
+        A[1::2, 2] = -p[:, 0]
+        A[1::2, 3] = -p[:, 1]
+        A[1::2, 5] = 1
+
+        solution, _, _, _ = np.linalg.lstsq(A, H.reshape(-1), rcond=None)
+
+        self.pixelToMM = solution[:4].reshape(2, 2)
+        K = solution[4:]
+
+        if self.imageSize is None:
+            self.imageSize = tuple(imageSize)
+
+        if fiducial is not None:
+            self.offset = np.asarray(fiducial, dtype=np.float64) - K
+
+        residual = A @ solution - H.reshape(-1)
+
+        return float(np.sqrt(np.mean(residual ** 2)))
+
+    @property
+    def mmPerPixel(self):
+        if self.pixelToMM is None:
+            return None
+
+        return float(np.sqrt(abs(np.linalg.det(self.pixelToMM))))
+
+#####################
+# Runtime
+#####################
+
+    def buildMaps(self):
+        if self.cameraMatrix is None:
+            return
+
+        self._map1, self._map2 = cv2.initUndistortRectifyMap(
+            self.cameraMatrix, self.distCoeffs, None, self.cameraMatrix, self.imageSize, cv2.CV_16SC2
+        )
+
+    def undistort(self, image, out = None):
+        # one remap through the cached tables. without intrinsics the image
+        # is returned untouched
+        if self._map1 is None:
+            return image
+
+        if out is None:
+            if self._undistorted is None or self._undistorted.shape != image.shape:
+                self._undistorted = np.empty_like(image)
+            out = self._undistorted
+
+        return cv2.remap(image, self._map1, self._map2, cv2.INTER_LINEAR, dst=out)
+
+    def headPositionFor(self, pixel, head):
+        # where the head has to go to bring the feature at pixel, seen with
+        # the head at head (x, y), to the center of the image
+        p = np.asarray(pixel, dtype=np.float64) - self._center(self.imageSize)
+        x, y = np.asarray(head[:2], dtype=np.float64) + self.pixelToMM @ p
+        return float(x), float(y)
+
+    def toMachine(self, pixel, head):
+        # machine position of the feature at pixel, seen with the head at head
+        if self.offset is None:
+            raise ValueError("Camera offset unknown, calibrate with a known fiducial position")
+
+        x, y = np.asarray(self.headPositionFor(pixel, head)) + self.offset
+        return float(x), float(y)
+
+    def _center(self, size):
+        return np.array([(size[0] - 1) / 2.0, (size[1] - 1) / 2.0])
+
+#####################
+# Persistence
+#####################
+
+    def save(self, path):
+        # stores the fitted model along with the remap tables, so loading
+        # never has to build them
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        fields = {}
+        for name in ("cameraMatrix", "distCoeffs", "imageSize", "pixelToMM", "offset"):
+            value = getattr(self, name)
+            if value is not None:
+                fields[name] = np.asarray(value)
+
+        if self._map1 is not None:
+            fields["map1"] = self._map1
+            fields["map2"] = self._map2
+
+        with open(path, "wb") as f:
+            np.savez(f, **fields)
+
+    @classmethod
+    def load(cls, path):
+        calibration = cls()
+
+        with np.load(path) as data:
+            for name in ("cameraMatrix", "distCoeffs", "pixelToMM", "offset"):
+                if name in data:
+                    setattr(calibration, name, data[name])
+
+            if "imageSize" in data:
+                calibration.imageSize = tuple(int(i) for i in data["imageSize"])
+
+            if "map1" in data:
+                calibration._map1 = data["map1"]
+                calibration._map2 = data["map2"]
+
+        return calibration
+
+def calibrateFromMoves(lumen, camera, center, span = 2.0, steps = 3, fiducial = None, calibration = None):
+    # steps the head over a grid of span mm around center (x, y), with a
+    # fiducial in view of camera, and fits the pixel to millimeter mapping.
+    # pass the fiducial's machine position to also fit the camera offset.
+    # returns the calibration, or False if the fiducial was lost
+
+    if calibration is None:
+        calibration = camera.calibration or CameraCalibration()
+
+    heads = []
+    pixels = []
+    size = None
+
+    offsets = np.linspace(-span / 2.0, span / 2.0, steps)
+
+    for dy in offsets:
+        for dx in offsets:
+            x = round(center[0] + dx, 3)
+            y = round(center[1] + dy, 3)
+
+            lumen.goto(x=x, y=y)
+            lumen.finishMoves()
+
+            frame = camera.capture_after(time.perf_counter())
+
+            if frame is False:
+                return False
+
+            image = calibration.undistort(frame[1])
+            size = (image.shape[1], image.shape[0])
+
+            pixel = camera.fiducialFinder.find(image)
+
+            if pixel is False:
+                lumen.log.error("Lost the fiducial at %s while calibrating", (x, y))
+                return False
+
+            heads.append((x, y))
+            pixels.append(pixel)
+
+    error = calibration.fitScale(heads, pixels, size, fiducial = fiducial)
+
+    lumen.log.info("Camera calibrated at %s mm/px, rms error %s mm", calibration.mmPerPixel, error)
+
+    camera.calibration = calibration
+
+    return calibration
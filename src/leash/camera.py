@@ -1,80 +1,219 @@
 """Manager for a Lumen camera
 """
 
-import cv2
+import threading, time
+
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from ._lazy import lazy
+from .vision import FiducialFinder, PartFinder
+
+cv2 = lazy("cv2")
+
+def findCameras(maxIndex = 8):
+    # every video index below maxIndex that opens, probed all at once
+    # rather than one after another
+    def opens(index):
+        capture = cv2.VideoCapture(index)
+        opened = capture.isOpened()
+        capture.release()
+        return opened
+
+    with ThreadPoolExecutor(max_workers=maxIndex) as pool:
+        opened = list(pool.map(opens, range(maxIndex)))
+
+    return [index for index in range(maxIndex) if opened[index]]
+
 class Camera():
 
-    def __init__(self, index = 1):
+    # background opens the device on a thread, so construction returns at
+    # once and the first capture waits for it instead
+    def __init__(self, index = 1, threaded = False, width = 1280, height = 720, calibration = None, background = False):
+
+        self._device = None
+        self._opened = threading.Event()
+
+        if background:
+            threading.Thread(target=self._open, args=(index, width, height), name="leash-camera-open", daemon=True).start()
+        else:
+            self._open(index, width, height)
+
+        # grabber state. frames are decoded into the back buffer and swapped
+        # with the front one under the lock, so neither is ever reallocated
+        self._front = None
+        self._back = None
+        self._frameTime = None
+        self._frameCount = 0
+        self._frameLock = threading.Condition()
+
+        self._grabber = None
+        self._grabbing = False
+
+        # detectors keep their buffers between frames, so reuse these
+        self.fiducialFinder = FiducialFinder()
+        self.partFinder = PartFinder()
 
+        # a CameraCalibration. when set, frames are undistorted before detection
+        self.calibration = calibration
+
+        if threaded:
+            self.startGrabber()
+
+    def _open(self, index, width, height):
         # opening camera from config settings, setting frame size
-        self._capture = cv2.VideoCapture(index)
-        self._capture.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        self._capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+        try:
+            self._device = cv2.VideoCapture(index)
+            self._device.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self._device.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        finally:
+            self._opened.set()
+
+    @property
+    def _capture(self):
+        self._opened.wait()
+        return self._device
 
     def list_cameras(self):
-        index = 0
-        cameras = []
-        while True:
-            cap = cv2.VideoCapture(index)
-            if not cap.isOpened():
-                break
-            cameras.append(index)
-            cap.release()
-            index += 1
-        return cameras
-            
+        return findCameras()
+
     def capture(self):
+        if self._grabbing:
+            frame = self.latest()
+            return False if frame is None else frame[1]
+
         ret, image = self._capture.read()
         if ret is True:
             return image
         else:
             return False
+
+#####################
+# Grabber
+#####################
+
+    def startGrabber(self):
+        # keeps reading frames on a background thread so the driver's buffer
+        # never goes stale, holding on to only the newest one
+        if self._grabber is not None and self._grabber.is_alive():
+            return
+
+        self._grabbing = True
+        self._grabber = threading.Thread(target=self._grabLoop, name="leash-camera", daemon=True)
+        self._grabber.start()
+
+    def stopGrabber(self):
+        self._grabbing = False
+
+        if self._grabber is not None:
+            self._grabber.join()
+
+        self._grabber = None
+
+        with self._frameLock:
+            self._frameLock.notify_all()
+
+    def _grabLoop(self):
+        while self._grabbing:
+            # grab() returns as soon as the frame arrives, so stamp it before
+            # spending time on decoding
+            if not self._capture.grab():
+                time.sleep(0.001)
+                continue
+
+            timestamp = time.perf_counter()
+
+            ret, image = self._capture.retrieve(self._back)
+            if not ret:
+                continue
+
+            with self._frameLock:
+                if self._back is None or image is not self._back:
+                    # first frame, or the driver changed resolution
+                    self._back = image
+                    self._front = np.empty_like(image)
+
+                self._front, self._back = self._back, self._front
+                self._frameTime = timestamp
+                self._frameCount = self._frameCount + 1
+                self._frameLock.notify_all()
+
+    def latest(self, out = None):
+        # returns (timestamp, frame) for the newest frame, or None before the
+        # first one. the frame is copied into out if given
+        with self._frameLock:
+            if self._frameTime is None:
+                return None
+
+            return self._frameTime, self._copyFront(out)
+
+    def capture_after(self, t, timeout = 1, out = None):
+        # returns (timestamp, frame) for the first frame grabbed after
+        # time.perf_counter() reached t, e.g. once a move has settled. returns
+        # False if no such frame arrives within timeout
+        self.startGrabber()
+
+        with self._frameLock:
+            ready = self._frameLock.wait_for(
+                lambda: not self._grabbing or (self._frameTime is not None and self._frameTime > t),
+                timeout
+            )
+
+            if not ready or not self._grabbing:
+                return False
+
+            return self._frameTime, self._copyFront(out)
+
+    def _copyFront(self, out):
+        if out is None:
+            return self._front.copy()
+
+        np.copyto(out, self._front)
+        return out
     
-    def getFidPosition(self, debug=False):
+    def undistort(self, image):
+        if self.calibration is None:
+            return image
 
-        while True:
+        return self.calibration.undistort(image)
+
+    def find_fiducial(self, image = None):
+        # returns the sub-pixel (x, y) center of the fiducial nearest the
+        # middle of the roi, or False. configure through self.fiducialFinder
+        if image is None:
             image = self.capture()
-            if image.any():
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-                blur = cv2.blur(gray,(10,10))
+        if image is False:
+            return False
 
-                mask = cv2.threshold(blur, 128, 255, cv2.THRESH_BINARY)[1]
+        return self.fiducialFinder.find(self.undistort(image))
 
-                circles = cv2.HoughCircles(mask, cv2.HOUGH_GRADIENT, 1.2, 100)
+    def find_part_offset(self, image = None):
+        # returns (dx, dy, angle) of a part relative to the image center, or
+        # False. configure through self.partFinder
+        if image is None:
+            image = self.capture()
 
-                cv2.imshow("img", circles)
+        if image is False:
+            return False
 
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
-            else:
-                print("couldnt take a pic")
-    
-        self._capture.release()
-        cv2.destroyAllWindows()
-
-        # circles = cv2.HoughCircles(mask, cv2.HOUGH_GRADIENT, 1.2, 100)
-
-        # if circles is not None:
-        #     # convert the (x, y) coordinates and radius of the circles to integers
-        #     circles = np.round(circles[0, :]).astype("int")
-        #     # loop over the (x, y) coordinates and radius of the circles
-        #     for (x, y, r) in circles:
-        #         # draw the circle in the output image, then draw a rectangle
-        #         # corresponding to the center of the circle
-        #         cv2.circle(output, (x, y), r, (0, 255, 0), 4)
-        #         cv2.rectangle(output, (x - 5, y - 5), (x + 5, y + 5), (0, 128, 255), -1)
-        #     # show the output image
-
-        #     if debug:
-        #         cv2.imshow("output", np.hstack([image, output]))
-        #         cv2.waitKey(1)
-
-        #     return (x, y, r)
-        
-        return False
-        
-
-        
\ No newline at end of file
+        return self.partFinder.offset(self.undistort(image))
+
+    def getFidPosition(self, debug=False):
+
+        image = self.capture()
+
+        if image is False:
+            return False
+
+        position = self.find_fiducial(image)
+
+        if debug and position is not False:
+            output = image.copy()
+            x, y = int(round(position[0])), int(round(position[1]))
+            cv2.rectangle(output, (x - 5, y - 5), (x + 5, y + 5), (0, 128, 255), -1)
+            cv2.imshow("output", np.hstack([image, output]))
+            cv2.waitKey(1)
+
+        return position
@@ -0,0 +1,184 @@
+"""Drives several Lumens from one process, each from its own worker thread
+"""
+
+import queue, threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .logger import Logger
+from .registry import FeederRegistry
+from .serial import findPorts
+
+class Machine():
+
+    # one Lumen and the thread that runs its jobs, oldest first. jobs for
+    # different machines run concurrently, jobs for one machine never do
+    def __init__(self, name, lumen, log):
+
+        self.name = name
+        self.lumen = lumen
+        self.log = log
+
+        self._jobs = queue.Queue()
+        self._worker = None
+
+        # jobs queued or running
+        self.outstanding = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+
+        self._worker = threading.Thread(target=self._run, name="leash-fleet-" + str(self.name), daemon=True)
+        self._worker.start()
+
+    def stop(self, wait = True):
+        # lets queued jobs finish, then ends the worker
+        if self._worker is None:
+            return
+
+        self._jobs.put(None)
+
+        if wait:
+            self._worker.join()
+
+        self._worker = None
+
+    def submit(self, fn, *args, **kwargs):
+        # queues fn(lumen, *args, **kwargs) and returns a future for its result
+        future = Future()
+
+        with self._lock:
+            self.outstanding = self.outstanding + 1
+
+        self._jobs.put((future, fn, args, kwargs))
+        self.start()
+        return future
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+
+            if job is None:
+                return
+
+            future, fn, args, kwargs = job
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(self.lumen, *args, **kwargs))
+            except Exception as e:
+                self.log.error("Job on %s failed: %s", self.name, e)
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self.outstanding = self.outstanding - 1
+
+    def __repr__(self):
+        return "Machine(" + str(self.name) + ", port=" + str(self.lumen.sm._ser.port) + ")"
+
+class Fleet():
+
+    # factory builds the Lumen for a port, defaulting to Lumen(debug, port=port)
+    def __init__(self, debug = False, factory = None):
+
+        self.log = Logger(debug).child("fleet")
+        self.debug = debug
+        self.factory = factory
+
+        # serial number -> Machine
+        self.machines = {}
+
+    def __getitem__(self, name):
+        return self.machines[name].lumen
+
+    def __iter__(self):
+        return iter(self.machines)
+
+    def __len__(self):
+        return len(self.machines)
+
+    def discover(self):
+        # binds every connected Lumen by its usb serial number, so a machine
+        # keeps its name when it comes back on a different port. returns the
+        # names of newly found machines
+        found = []
+
+        for port, serialNumber, hwid in findPorts():
+            if serialNumber is None:
+                self.log.error("Lumen at %s doesn't report a serial number, skipping it", port)
+                continue
+
+            machine = self.machines.get(serialNumber)
+
+            if machine is None:
+                self.add(serialNumber, self._build(port))
+                found.append(serialNumber)
+
+            elif machine.lumen.sm._ser.port != port and not machine.lumen.sm._ser.is_open:
+                self.log.info("Lumen %s moved to %s", serialNumber, port)
+                machine.lumen.sm._ser.port = port
+
+        return found
+
+    def add(self, name, lumen):
+        # adds an already built Lumen, e.g. one on a simulated transport
+        lumen.metrics.labels["machine"] = str(name)
+
+        # every machine on the host would otherwise share ~/.leash/feeders.json
+        if lumen.photon.registry is None:
+            lumen.photon.registry = FeederRegistry.forMachine(name)
+        self.machines[name] = Machine(name, lumen, self.log)
+        return self.machines[name]
+
+    def _build(self, port):
+        if self.factory is not None:
+            return self.factory(port)
+
+        from . import Lumen
+        return Lumen(self.debug, port = port)
+
+#####################
+# Connection
+#####################
+
+    def connect(self):
+        # connects and boots every machine at once. returns name -> success
+        return self._everywhere(lambda lumen: lumen.connect())
+
+    def disconnect(self):
+        # finishes queued jobs, then closes every port
+        for machine in self.machines.values():
+            machine.stop()
+
+        return self._everywhere(lambda lumen: lumen.disconnect())
+
+    def _everywhere(self, fn):
+        if not self.machines:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=len(self.machines)) as pool:
+            futures = {name: pool.submit(fn, machine.lumen) for name, machine in self.machines.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+#####################
+# Jobs
+#####################
+
+    def submit(self, name, fn, *args, **kwargs):
+        # queues fn(lumen, *args, **kwargs) on one machine, returns a future
+        return self.machines[name].submit(fn, *args, **kwargs)
+
+    def submitAll(self, fn, *args, **kwargs):
+        # queues the same job on every machine, returns name -> future
+        return {name: machine.submit(fn, *args, **kwargs) for name, machine in self.machines.items()}
+
+    def submitAny(self, fn, *args, **kwargs):
+        # queues a job on the machine with the fewest jobs queued or running
+        machine = min(self.machines.values(), key=lambda m: m.outstanding)
+        return machine.submit(fn, *args, **kwargs)
+
+    def runJob(self, name, placements, **kwargs):
+        return self.submit(name, lambda lumen: lumen.runJob(placements, **kwargs))
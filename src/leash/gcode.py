@@ -0,0 +1,46 @@
+"""Helpers for building G-code commands
+"""
+
+AXES = ("x", "y", "z", "a", "b")
+
+def number(value, places=3):
+    # shortest text for value at marlin's micron resolution, so 10.0 goes
+    # out as "10" and 0.1 + 0.2 as "0.3"
+    if isinstance(value, int):
+        return str(value)
+
+    # anything float() takes works, like "10" or a numpy scalar
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Not a number: " + repr(value)) from None
+
+    text = format(value, "." + str(places) + "f").rstrip("0").rstrip(".")
+
+    if text == "-0":
+        return "0"
+
+    return text
+
+def move(x=None, y=None, z=None, a=None, b=None):
+    # builds a G0 with only the axes that are given
+    command = "G0"
+
+    for axis, value in zip(AXES, (x, y, z, a, b)):
+        if value is not None:
+            command = command + " " + axis.upper() + number(value)
+
+    return command
+
+def checksum(line):
+    # marlin's line checksum, the xor of every byte before the *
+    result = 0
+    for byte in line.encode('utf-8'):
+        result = result ^ byte
+
+    return result
+
+def numbered(line, lineNumber):
+    # frames line as "N<n> <line>*<checksum>" for checksummed streaming
+    framed = "N" + str(lineNumber) + " " + line
+    return framed + "*" + str(checksum(framed))
@@ -0,0 +1,185 @@
+"""Estimates how long Lumen moves take, from the G-code that sets them up
+"""
+
+import copy, math, time
+
+from .gcode import AXES
+
+def parse(command):
+    # splits a command into its code and a dict of its numeric words
+    tokens = command.split()
+
+    if not tokens:
+        return None, {}
+
+    words = {}
+    for token in tokens[1:]:
+        try:
+            words[token[0].lower()] = float(token[1:])
+        except (ValueError, IndexError):
+            words[token[0].lower()] = None
+
+    return tokens[0].upper(), words
+
+class MotionModel():
+
+    # feedrate is in mm/min like G-code, acceleration in mm/s^2. maxFeedrate
+    # (mm/s) and maxAcceleration (mm/s^2) optionally cap individual axes, the
+    # way marlin scales a move down so no axis exceeds its limits.
+    # position, relative, feedrate and acceleration can be None for unknown,
+    # see forget(). moves time unknown settings at the defaults given here
+    def __init__(self, feedrate = 50000, acceleration = 4000, maxFeedrate = None, maxAcceleration = None):
+
+        self.defaultFeedrate = feedrate
+        self.defaultAcceleration = acceleration
+
+        self.feedrate = feedrate
+        self.acceleration = acceleration
+
+        self.maxFeedrate = maxFeedrate or {}
+        self.maxAcceleration = maxAcceleration or {}
+
+        self.position = {axis: 0.0 for axis in AXES}
+        self.relative = False
+
+        # where G28 leaves each axis it homes
+        self.home = {"x": 0.0, "y": 0.0, "z": 0.0}
+
+        # seconds allowed for a homing move, which depends on where the
+        # machine really is and can't be estimated
+        self.homingTime = 20
+
+        # perf_counter time the moves tracked so far should be done by
+        self.busyUntil = 0
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def forget(self):
+        # marks position, positioning mode, feedrate and acceleration unknown,
+        # e.g. after a reconnect. moves from an unknown position take no time
+        self.position = {axis: None for axis in AXES}
+        self.relative = None
+        self.feedrate = None
+        self.acceleration = None
+
+    def apply(self, command):
+        # updates the model with a command as marlin would run it, and returns
+        # the seconds it will take. commands that don't move take no time
+        code, words = parse(command)
+
+        if code in ("G0", "G1"):
+            if words.get("f"):
+                self.feedrate = words["f"]
+
+            target = dict(self.position)
+            for axis in AXES:
+                if axis not in words:
+                    continue
+
+                if words[axis] is None or self.relative is None:
+                    target[axis] = None
+                elif self.relative:
+                    current = self.position[axis]
+                    target[axis] = current + words[axis] if current is not None else None
+                else:
+                    target[axis] = words[axis]
+
+            duration = self.moveTime(self.position, target)
+            self.position = target
+            return duration
+
+        if code == "G4":
+            if words.get("p") is not None:
+                return words["p"] / 1000.0
+            if words.get("s") is not None:
+                return words["s"]
+            return 0
+
+        if code == "G28":
+            homed = [axis for axis in ("x", "y", "z") if axis in words] or ["x", "y", "z"]
+            for axis in homed:
+                self.position[axis] = self.home[axis]
+            return 0
+
+        if code == "G90":
+            self.relative = False
+        elif code == "G91":
+            self.relative = True
+        elif code == "G92":
+            for axis in AXES:
+                if axis in words:
+                    self.position[axis] = words[axis]
+        elif code == "M204":
+            # T is travel acceleration, S sets print and travel together
+            if words.get("t") is not None:
+                self.acceleration = words["t"]
+            elif words.get("s") is not None:
+                self.acceleration = words["s"]
+
+        return 0
+
+    def track(self, command):
+        # applies a command as it is sent, and pushes back when the queue on
+        # marlin should run dry. used as a SerialManager observer
+        duration = self.apply(command)
+
+        if command[:3].upper() == "G28":
+            duration = self.homingTime
+
+        if duration:
+            self.busyUntil = max(self.busyUntil, time.perf_counter()) + duration
+
+    def remaining(self):
+        # seconds until the tracked moves should be done
+        return max(0, self.busyUntil - time.perf_counter())
+
+    def settled(self):
+        # the machine reported its queue empty, so nothing is left to wait on
+        self.busyUntil = 0
+
+    def moveTime(self, start, end):
+        # trapezoidal profile from rest to rest at the current feedrate and
+        # acceleration. moves are assumed not to blend, so this errs long
+        deltas = {axis: abs(end[axis] - start[axis]) for axis in AXES if start.get(axis) is not None and end.get(axis) is not None}
+
+        # like marlin, rotation only counts when there is no linear motion
+        distance = math.sqrt(sum(deltas.get(axis, 0) ** 2 for axis in ("x", "y", "z")))
+        if distance == 0:
+            distance = math.sqrt(sum(deltas.get(axis, 0) ** 2 for axis in ("a", "b")))
+
+        if distance == 0:
+            return 0
+
+        velocity = (self.feedrate or self.defaultFeedrate) / 60.0
+        acceleration = self.acceleration or self.defaultAcceleration
+
+        for axis, delta in deltas.items():
+            if delta == 0:
+                continue
+            if axis in self.maxFeedrate:
+                velocity = min(velocity, self.maxFeedrate[axis] * distance / delta)
+            if axis in self.maxAcceleration:
+                acceleration = min(acceleration, self.maxAcceleration[axis] * distance / delta)
+
+        # too short to reach full speed, the profile is a triangle
+        if distance < velocity ** 2 / acceleration:
+            return 2 * math.sqrt(distance / acceleration)
+
+        return distance / velocity + velocity / acceleration
+
+    def estimate(self, commands, start = None):
+        # seconds to run a list of G-code commands, or of goto style move
+        # dicts, without touching this model. start overrides the position
+        model = self.copy()
+
+        if start is not None:
+            model.position.update({axis: value for axis, value in start.items() if value is not None})
+
+        total = 0
+        for command in commands:
+            if isinstance(command, dict):
+                command = "G0 " + " ".join(axis.upper() + str(value) for axis, value in command.items() if value is not None)
+            total = total + model.apply(command)
+
+        return total
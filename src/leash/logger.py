@@ -1,19 +1,186 @@
+"""Logging for leash, built on the standard logging module
 
-from datetime import datetime
+Messages are formatted lazily, only once a handler accepts them, and written
+from a background thread through a queue so logging never blocks a caller on
+the console. Each subsystem logs to its own child of the "leash" logger, e.g.
+"leash.serial", so levels can be set per subsystem.
+"""
+
+import atexit, collections, logging, queue, threading, time
+
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT = "leash"
+
+FORMAT = "%(levelname)s - %(asctime)s - %(name)s - %(message)s"
+
+_listener = None
+_listenerLock = threading.Lock()
+
+def _startListener(handler = None):
+    # one queue and writer thread for every Logger in the process
+    global _listener
+
+    with _listenerLock:
+        if _listener is not None:
+            return
+
+        if handler is None:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(FORMAT))
+
+        records = queue.SimpleQueue()
+
+        _listener = QueueListener(records, handler, respect_handler_level=True)
+        _listener.start()
+
+        logging.getLogger(ROOT).addHandler(QueueHandler(records))
+
+        atexit.register(_stopListener)
+
+def _stopListener():
+    global _listener
+
+    with _listenerLock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+# the library stays quiet unless an application or debug=True asks otherwise
+logging.getLogger(ROOT).addHandler(logging.NullHandler())
+
+class Span():
+
+    __slots__ = ("name", "command", "start", "end")
+
+    def __init__(self, name, command, start, end):
+        self.name = name
+        self.command = command
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return "Span(" + self.name + ", " + self.command + ", " + format(self.duration * 1e3, ".3f") + " ms)"
+
+class Tracer():
+
+    # keeps the last size spans, e.g. each serial command from write to ok.
+    # recording is an append to a bounded deque, so it can stay on
+    def __init__(self, size = 4096):
+
+        self.spans = collections.deque(maxlen=size)
+
+    def record(self, name, command, start, end = None):
+        self.spans.append(Span(name, command, start, end if end is not None else time.perf_counter()))
+
+    def clear(self):
+        self.spans.clear()
+
+    def durations(self, name = None):
+        return [span.duration for span in list(self.spans) if name is None or span.name == name]
+
+    def summary(self, name = None):
+        # count, mean, median, p95 and max in seconds, or None with no spans
+        durations = sorted(self.durations(name))
+
+        if not durations:
+            return None
+
+        return {
+            "count": len(durations),
+            "mean": sum(durations) / len(durations),
+            "median": durations[len(durations) // 2],
+            "p95": durations[max(0, int(len(durations) * 0.95) - 1)],
+            "max": durations[-1]
+        }
 
 class Logger():
 
-    def __init__(self, debug = True):
-        self.debug = debug
+    # debug turns on INFO level output to the console through the queue. an
+    # application that configures logging itself can leave it off and set
+    # levels on the "leash" loggers directly
+    def __init__(self, debug = True, name = ROOT, parent = None):
+
+        self.enabled = debug
+        self.name = name
+
+        self._logger = logging.getLogger(name)
+        self._parent = parent
+
+        if parent is None:
+            self.tracer = None
+
+            if debug:
+                _startListener()
+                self._logger.setLevel(logging.INFO)
+            elif self._logger.level == logging.NOTSET:
+                self._logger.setLevel(logging.WARNING)
+
+    def child(self, subsystem):
+        # a Logger for one subsystem, logging as leash.<subsystem>
+        return Logger(self.enabled, self.name + "." + subsystem, parent = self)
+
+    @property
+    def root(self):
+        return self._parent.root if self._parent is not None else self
+
+    def setLevel(self, level, subsystem = None):
+        # level is a logging level or its name, e.g. "WARNING"
+        name = self.name + "." + subsystem if subsystem else self.name
+        logging.getLogger(name).setLevel(level)
+
+    def isEnabledFor(self, level):
+        return self._logger.isEnabledFor(level)
+
+#####################
+# Messages
+#####################
+
+    # args are %-formatted into message only if the record is kept, so pass
+    # them separately instead of building the string at the call site
+    def debug(self, message, *args):
+        self._logger.debug(message, *args)
+
+    def info(self, message, *args):
+        self._logger.info(message, *args)
+
+    def warning(self, message, *args):
+        self._logger.warning(message, *args)
+
+    def error(self, message, *args):
+        self._logger.error(message, *args)
+
+#####################
+# Tracing
+#####################
+
+    def startTracing(self, size = 4096):
+        # turns on span recording for this Logger and all its children
+        root = self.root
+        if root.tracer is None:
+            root.tracer = Tracer(size)
+
+        return root.tracer
+
+    def stopTracing(self):
+        root = self.root
+        tracer = root.tracer
+        root.tracer = None
+        return tracer
+
+    def span(self, name, command, start, end = None):
+        # records a span if tracing is on, and logs it at debug level
+        tracer = self.root.tracer
 
-    def error(self, message):
-        if self.debug:
-            error_string = "ERROR - " + str(datetime.now()) + " - " + str(message)
-            print(error_string)
+        if tracer is None:
+            return
 
-    def info(self, message):
-        if self.debug:
-            info_string = "INFO - " + str(datetime.now()) + " - " + str(message)
-            print(info_string)
+        if end is None:
+            end = time.perf_counter()
 
-    
\ No newline at end of file
+        tracer.record(name, command, start, end)
+        self._logger.debug("%s %s took %.3f ms", name, command, (end - start) * 1e3)
@@ -0,0 +1,222 @@
+"""Latency histograms and error counters, with a Prometheus text exporter
+
+Recording is a bisect and a few additions under a lock, cheap enough to leave
+on. Read the numbers with snapshot(), or serve them for a Prometheus scraper
+with serve().
+"""
+
+import bisect, threading
+
+# round trip buckets in seconds, from a fast usb reply to a slow homing
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+def _labelString(labels):
+    return ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in labels)
+
+class Histogram():
+
+    def __init__(self, buckets = BUCKETS):
+
+        self.buckets = tuple(buckets)
+
+        # counts per bucket, not cumulative, with one more for overflow
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def cumulative(self):
+        # (upper bound, count at or below it) pairs, ending with infinity
+        total = 0
+        pairs = []
+
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total = total + count
+            pairs.append((bound, total))
+
+        return pairs
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q quantile, None when empty
+        if self.count == 0:
+            return None
+
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+class Metrics():
+
+    # labels are attached to every series, e.g. {"machine": serial number}
+    # so several machines can be scraped into one place
+    def __init__(self, labels = None):
+
+        self.labels = dict(labels or {})
+
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+        self._lock = threading.Lock()
+
+        self._server = None
+
+    def describe(self, name, kind, text):
+        # kind is "histogram" or "counter". described counters are exported
+        # at zero before anything increments them
+        self._help[name] = (kind, text)
+
+        if kind == "counter":
+            with self._lock:
+                self._counters.setdefault((name, ()), 0)
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+#####################
+# Recording
+#####################
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def increment(self, name, amount = 1, **labels):
+        key = self._key(name, labels)
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            for key in self._counters:
+                self._counters[key] = 0
+
+#####################
+# Reading
+#####################
+
+    def histogram(self, name, **labels):
+        return self._histograms.get(self._key(name, labels))
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    def snapshot(self):
+        # plain dicts, safe to json.dump. series are keyed by their label
+        # string, e.g. 'code="G0"'
+        snapshot = {"labels": dict(self.labels), "histograms": {}, "counters": {}}
+
+        with self._lock:
+            for (name, labels), histogram in self._histograms.items():
+                snapshot["histograms"].setdefault(name, {})[_labelString(labels)] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.sum / histogram.count if histogram.count else None,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "buckets": {str(bound): total for bound, total in histogram.cumulative()}
+                }
+
+            for (name, labels), value in self._counters.items():
+                snapshot["counters"].setdefault(name, {})[_labelString(labels)] = value
+
+        return snapshot
+
+    def exposition(self):
+        # the Prometheus text format, version 0.0.4
+        lines = []
+        common = tuple(sorted(self.labels.items()))
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+            for name, series, kind in self._families(histograms, "histogram") + self._families(counters, "counter"):
+                text = self._help.get(name, (kind, name))[1]
+                lines.append("# HELP " + name + " " + text)
+                lines.append("# TYPE " + name + " " + kind)
+
+                for labels, value in series:
+                    labels = common + labels
+
+                    if kind == "counter":
+                        lines.append(name + self._braces(labels) + " " + repr(value))
+                        continue
+
+                    for bound, total in value.cumulative():
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(name + "_bucket" + self._braces(labels + (("le", le),)) + " " + str(total))
+
+                    lines.append(name + "_sum" + self._braces(labels) + " " + repr(value.sum))
+                    lines.append(name + "_count" + self._braces(labels) + " " + str(value.count))
+
+        return "\n".join(lines) + "\n"
+
+    def _families(self, items, kind):
+        families = {}
+        for (name, labels), value in items:
+            families.setdefault(name, []).append((labels, value))
+
+        return [(name, series, kind) for name, series in families.items()]
+
+    def _braces(self, labels):
+        return "{" + _labelString(labels) + "}" if labels else ""
+
+#####################
+# Endpoint
+#####################
+
+    def serve(self, port = 9464, host = "127.0.0.1"):
+        # serves exposition() at http://host:port/metrics from a daemon
+        # thread. returns the server, or the running one if already serving
+        if self._server is not None:
+            return self._server
+
+        # only loaded here, it is slow to import and most users never serve
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = metrics.exposition().encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+        threading.Thread(target=self._server.serve_forever, name="leash-metrics", daemon=True).start()
+
+        return self._server
+
+    def stopServing(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,146 @@
+"""Background vacuum sampling for a pump, with pick, drop and clog detection
+"""
+
+import threading, time
+
+import numpy as np
+
+class PressureMonitor():
+
+    # readings fall as vacuum builds. a sealed nozzle, whether from a part or
+    # a clog, reads below threshold, and has to climb back above
+    # threshold + hysteresis before it counts as open again
+    def __init__(self, pump, size=4096, interval=0, threshold=-100000, hysteresis=20000, window=5):
+
+        self.pump = pump
+        self.log = pump.log
+
+        self.interval = interval
+
+        # a failed read waits backoff seconds, doubling up to maxBackoff
+        # while reads keep failing
+        self.backoff = 0.01
+        self.maxBackoff = 1.0
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.window = window
+
+        self.size = size
+        self._times = np.zeros(size, dtype=np.float64)
+        self._values = np.zeros(size, dtype=np.float64)
+        self._count = 0
+        self._lock = threading.Lock()
+
+        self.sealed = False
+
+        # set while the nozzle is supposed to be open with the pump running, so
+        # a seal means a clog rather than a pick
+        self.expectEmpty = False
+
+        self._callbacks = {
+            "picked": [],
+            "dropped": [],
+            "clogged": []
+        }
+
+        self._thread = None
+        self._running = False
+
+        # set by stop() to cut a wait short
+        self._wake = threading.Event()
+
+    def on(self, event, callback):
+        # callback(monitor, timestamp, value) runs on the sampler thread
+        self._callbacks[event].append(callback)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._running = True
+        self._wake.clear()
+        self._thread = threading.Thread(target=self._run, name="leash-pressure-" + str(self.pump.index), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+        self._thread = None
+
+    def samples(self, n=None):
+        # returns (times, values) for the newest n samples, oldest first
+        with self._lock:
+            count = min(self._count, self.size)
+
+            if n is None or n > count:
+                n = count
+
+            index = (np.arange(self._count - n, self._count)) % self.size
+
+            return self._times[index], self._values[index]
+
+    def latest(self):
+        times, values = self.samples(1)
+
+        if len(values) == 0:
+            return None
+
+        return times[0], values[0]
+
+    def record(self, timestamp, value):
+        with self._lock:
+            i = self._count % self.size
+            self._times[i] = timestamp
+            self._values[i] = value
+            self._count = self._count + 1
+
+        self._detect()
+
+    def _run(self):
+        failures = 0
+
+        while self._running:
+            if not self.pump.sm._ser.is_open:
+                self.log.error("Pressure monitor for pump %s stopped, the serial port is closed", self.pump.index)
+                self._running = False
+                break
+
+            value = self.pump.getPressure()
+
+            if value is False:
+                failures = min(failures + 1, 16)
+                self._wake.wait(min(self.maxBackoff, self.backoff * 2 ** (failures - 1)))
+                continue
+
+            failures = 0
+            self.record(time.perf_counter(), value)
+
+            if self.interval:
+                self._wake.wait(self.interval)
+
+    def _detect(self):
+        times, values = self.samples(self.window)
+
+        if len(values) < self.window:
+            return
+
+        if not self.sealed and np.all(values < self.threshold):
+            self.sealed = True
+            self._fire("clogged" if self.expectEmpty else "picked", times[-1], values[-1])
+
+        elif self.sealed and np.all(values > self.threshold + self.hysteresis):
+            self.sealed = False
+            self._fire("dropped", times[-1], values[-1])
+
+    def _fire(self, event, timestamp, value):
+        self.log.info("Pump %s %s at pressure %s", self.pump.index, event, value)
+
+        for callback in self._callbacks[event]:
+            try:
+                callback(self, timestamp, value)
+            except Exception as e:
+                self.log.error(e)
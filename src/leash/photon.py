@@ -2,9 +2,13 @@
 """
 
 import enum
-import re
+import collections, re, threading, time
+
+from concurrent.futures import Future, TimeoutError
 
 from . import logger
+from .registry import FeederRegistry
+from .metrics import Metrics
 
 class Commands(enum.IntEnum):
     GET_FEEDER_ID = 0x01
@@ -19,19 +23,120 @@ class Commands(enum.IntEnum):
     PROGRAM_FEEDER_FLOOR = 0xc2
     UNINITIALIZED_FEEDERS_RESPOND = 0xc3
 
+class Status(enum.IntEnum):
+    OK = 0x00
+    WRONG_FEEDER_ID = 0x01
+    COULDNT_REACH = 0x02
+    UNINITIALIZED_FEEDER = 0x03
+    FEEDING_IN_PROGRESS = 0x04
+    FAIL = 0x05
+    TIMEOUT = 0xfe
+    UNKNOWN_ERROR = 0xff
+
+# commands that leave a feeder in the same state however many times they
+# arrive, so a lost or garbled reply can be fixed by sending them again. a
+# repeated move would feed twice, so moves are never retried
+RETRYABLE = frozenset((
+    Commands.GET_FEEDER_ID,
+    Commands.INITIALIZE_FEEDER,
+    Commands.GET_VERSION,
+    Commands.MOVE_FEED_STATUS
+))
+
+def _crcTable():
+    # crc-8 of every single byte value, polynomial x^8 + x^2 + x + 1
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+        table.append(crc)
+
+    return bytes(table)
+
+CRC_TABLE = _crcTable()
+
+class Feeder():
+
+    def __init__(self, uuid, address, version = None):
+
+        self.uuid = list(uuid)
+        self.address = address
+        self.version = version
+        self.lastSeen = time.time()
+
+    @property
+    def uuidString(self):
+        return bytes(self.uuid).hex()
+
+    def seen(self):
+        self.lastSeen = time.time()
+
+    def __repr__(self):
+        return "Feeder(address=" + str(self.address) + ", uuid=" + self.uuidString + ", version=" + str(self.version) + ")"
+
 class Photon():
 
     def __init__(self, sm, log):
 
         self.sm = sm
         self.log = log
-        
+
+        # shares the serial manager's metrics, so one snapshot covers both
+        self.metrics = sm.metrics if sm is not None else Metrics()
+        self.metrics.describe("leash_photon_round_trip_seconds", "histogram", "Time from marlin reaching a packet to its parsed reply, by feeder address")
+        self.metrics.describe("leash_photon_timeouts_total", "counter", "Packets no feeder answered")
+        self.metrics.describe("leash_photon_crc_errors_total", "counter", "Replies with a bad crc")
+        self.metrics.describe("leash_photon_bad_packets_total", "counter", "Replies that were garbled, misaddressed or the wrong length")
+        self.metrics.describe("leash_photon_retries_total", "counter", "Packets sent again after a failed reply")
+        self.metrics.describe("leash_photon_late_replies_total", "counter", "Replies that arrived after their packet was given up on")
+        self.metrics.describe("leash_photon_duplicate_replies_total", "counter", "Replies to a packet that was already answered")
+        self.metrics.describe("leash_photon_resyncs_total", "counter", "Times the bus was left to go quiet after a garbled frame")
+
+        # retries of a RETRYABLE packet after a bad or lost reply, waiting
+        # backoff seconds before the first and doubling up to maxBackoff
+        self.retries = 3
+        self.backoff = 0.005
+        self.maxBackoff = 0.1
+
+        # time for the rest of a garbled frame to clear the bus
+        self.quietTime = 0.01
+
+        # per feeder reply timeouts are learned from its round trips, but
+        # never drop below minTimeout, which has to cover marlin's own wait
+        # on the bus
+        self.minTimeout = 0.25
+
+        # address -> (smoothed round trip, mean deviation) in seconds
+        self._latency = {}
+
         self._packetID = 0x00
 
-        self._outstandingPackets = []
+        # packet id -> address, for packets sent and not answered yet. a
+        # reply to one of these that shows up later is recognized as late.
+        # ids of the last few answered packets catch duplicate replies
+        self._outstandingPackets = {}
+        self._answeredPackets = collections.deque(maxlen=16)
+        self._packetLock = threading.Lock()
 
         self.activeFeeders = []
 
+        # every initialized feeder, keyed by address
+        self.feeders = {}
+
+        # set by reconnect(), keeps the feeder table on disk
+        self.registry = None
+
+        # a recorder.Recorder, when set every packet and reply is logged to it
+        self.recorder = None
+
+        # addresses with a feed started by startFeedForward/Backward that
+        # hasn't been confirmed done by waitFeedersReady yet
+        self.feeding = set()
+
         # PRIVATE
 
         ## Bus Utils
@@ -39,23 +144,30 @@ class Photon():
     def crc(self, data: bytes) -> int:
         crc: int = 0
         for byte in data:
-            crc ^= (byte << 8)
-            for _ in range(8):
-                if crc & 0x8000:
-                    crc ^= (0x1070 << 3)
-                crc <<= 1
-        
-        return (crc >> 8) & 0xFF
+            crc = CRC_TABLE[crc ^ byte]
+
+        return crc
     
     def byteArrayToString(self, byteArray):
-        hexString = ""
-        for i in byteArray:
-            converted = hex(i)[2:]
-            if len(converted) == 1:
-                converted = "0" + converted
-            hexString = hexString + converted
+        return bytes(byteArray).hex()
+
+    def _claimPacketID(self, address):
+        with self._packetLock:
+            packetID = self._packetID
+            self.incrementPacketID()
+
+            # the id wrapped around, whatever used it last is long gone
+            if packetID in self._answeredPackets:
+                self._answeredPackets.remove(packetID)
+
+            self._outstandingPackets[packetID] = address
 
-        return hexString
+        return packetID
+
+    def _answered(self, packetID):
+        with self._packetLock:
+            self._outstandingPackets.pop(packetID, None)
+            self._answeredPackets.append(packetID)
 
     def incrementPacketID(self):
         if self._packetID == 0xFF:
@@ -65,76 +177,278 @@ class Photon():
 
     def buildPacketFromBytes(self, packet):
 
-        crc = self.crc(packet)
+        packet = bytearray(packet)
 
-        packet.insert(4, crc)
+        packet.insert(4, self.crc(packet))
 
-        packetString = "M485 "
+        return "M485 " + packet.hex()
 
-        # convert byte to string and append to packetString
-        for i in packet:
-            converted = hex(i)[2:]
-            if len(converted) == 1:
-                converted = "0" + converted
-            packetString = packetString + converted
+    def buildBytesFromPacket(self, responseString):
+        return bytearray.fromhex(responseString)
 
-        return packetString
+    def sendPacket(self, address, command: Commands, payload = None):
+        # returns the response payload, -1 on timeout or False on a bad
+        # packet, once retries have run out for a RETRYABLE command
 
-    def buildBytesFromPacket(self, responseString):
-        byteArray = []
+        attempt = 0
 
-        for i in range(int(len(responseString)/2)):
-            index = i*2
-            sliced = responseString[index:index+2]
-            hexed = int(sliced, 16)
-            byteArray.append(hexed)
+        while True:
+            resp = self._sendOnce(address, command, payload, attempt)
 
-        return byteArray
+            delay = self.nextRetry(address, command, resp, attempt)
 
+            if delay is None:
+                return resp
 
-    def sendPacket(self, address, command: Commands, payload = None):
+            attempt = attempt + 1
+            time.sleep(delay)
+
+    def _sendOnce(self, address, command, payload, attempt):
+
+        gcode, sentPacketID = self.buildRequest(address, command, payload)
+
+        start = time.perf_counter()
+
+        # the reply is routed back to this command by the serial reader
+        future = self.sm.submit(gcode)
+
+        if future is False:
+            return -1
+
+        try:
+            response = self.sm.result(future, self.replyTimeout(address, command, attempt))
+        except TimeoutError:
+            # marlin still owes this command an ok, note it when it comes
+            future.add_done_callback(lambda done: self.lateReply(address, sentPacketID, done))
+            response = ""
+        except Exception:
+            response = ""
+
+        return self.parseTimed(response, address, sentPacketID, start, future.started)
+
+    def submitPacket(self, address, command: Commands, payload = None):
+        # like sendPacket, but returns a future for the parsed response
+        # instead of waiting on it, so several packets can be in flight
+
+        result: Future = Future()
+        self._submitAttempt(result, address, command, payload, 0)
+
+        return result
+
+    def _submitAttempt(self, result, address, command, payload, attempt):
+
+        gcode, sentPacketID = self.buildRequest(address, command, payload)
+
+        start = time.perf_counter()
+        future = self.sm.submit(gcode)
+
+        if future is False:
+            result.set_result(-1)
+            return
+
+        def parse(done):
+            try:
+                response = done.result()
+            except Exception:
+                response = ""
+
+            resp = self.parseTimed(response, address, sentPacketID, start, done.started)
+
+            delay = self.nextRetry(address, command, resp, attempt)
+
+            if delay is not None:
+                # resubmitting can block on a full buffer, which only the
+                # reader thread running this callback can empty
+                timer = threading.Timer(delay, self._submitAttempt, (result, address, command, payload, attempt + 1))
+                timer.daemon = True
+                timer.start()
+                return
+
+            result.set_result(resp)
+
+        future.add_done_callback(parse)
+
+    def parseTimed(self, response, address, sentPacketID, start, started = None):
+        # start is when the packet was written and started when marlin got
+        # to it. only the time since started is the feeder's, the rest was
+        # spent queued behind other commands
+        now = time.perf_counter()
+
+        resp = self.parseResponse(response, address, sentPacketID)
+        self.metrics.observe("leash_photon_round_trip_seconds", now - (start if started is None else started), address=address)
+
+        if resp != -1 and resp is not False and started is not None:
+            self._observeLatency(address, now - started)
+
+        return resp
+
+    ## Reliability
+
+    def _shouldRetry(self, address, command, resp):
+        # broadcasts aren't retried, a garbled one is a collision that would
+        # only happen again and a timeout just means nobody is uninitialized
+        if command not in RETRYABLE or address == 0xFF:
+            return False
+
+        if resp is False:
+            return True
+
+        # a feeder we know is there should have answered. an empty address
+        # timing out during a scan is expected and not worth another try
+        return resp == -1 and address in self.feeders
+
+    def nextRetry(self, address, command, resp, attempt):
+        # seconds to wait before retrying after attempt got resp, or None if
+        # resp is the final answer
+        if attempt >= self.retries or not self._shouldRetry(address, command, resp):
+            return None
+
+        return self._prepareRetry(address, command, resp, attempt + 1)
+
+    def _prepareRetry(self, address, command, resp, attempt):
+        # counts and logs retry number attempt, returning how long to wait
+        # before sending it
+        self.metrics.increment("leash_photon_retries_total", address=address)
+        self.log.debug("Retrying %s to address %s, attempt %d", command.name, address, attempt)
+
+        delay = min(self.maxBackoff, self.backoff * 2 ** (attempt - 1))
+
+        if resp is False:
+            delay = max(delay, self.resync())
+
+        return delay
+
+    def resync(self):
+        # after a garbled frame the rest of it, or a late reply, may still be
+        # on the bus. returns how long to leave it quiet before the next
+        # packet. replies that arrive anyway are told apart by packet id
+        self.metrics.increment("leash_photon_resyncs_total")
+        return self.quietTime
+
+    def _observeLatency(self, address, seconds):
+        # smoothed the way tcp smooths round trips, 1/8 and 1/4 gains
+        if address not in self._latency:
+            self._latency[address] = (seconds, seconds / 2)
+            return
+
+        smoothed, deviation = self._latency[address]
+        deviation = 0.75 * deviation + 0.25 * abs(smoothed - seconds)
+        smoothed = 0.875 * smoothed + 0.125 * seconds
+
+        self._latency[address] = (smoothed, deviation)
+
+    def timeoutFor(self, address):
+        # the learned reply timeout for an address, None until it has answered
+        if address not in self._latency:
+            return None
+
+        smoothed, deviation = self._latency[address]
+        return max(self.minTimeout, smoothed + 4 * deviation)
+
+    def replyTimeout(self, address, command, attempt):
+        # how long to wait on marlin's reply to a packet. only packets that
+        # can be retried give up early, and each retry waits twice as long
+        limit = self.sm._ser.timeout
+        learned = self.timeoutFor(address)
+
+        if command not in RETRYABLE or learned is None:
+            return limit
+
+        learned = learned * 2 ** attempt
+
+        return learned if limit is None else min(learned, limit)
+
+    def lateReply(self, address, packetID, done = None):
+        # counts the reply to a packet that was given up on, and records it
+        # when done, the command's future, holds marlin's response
+        self.metrics.increment("leash_photon_late_replies_total", address=address)
+        self.log.debug("Late reply to packet %d from address %s", packetID, address)
+
+        if self.recorder is None or done is None or done.exception() is not None:
+            return
+
+        reMatch = re.search("rs485-reply: (.*)", done.result())
+
+        if reMatch is not None:
+            self.recorder.late(address, packetID, reMatch.group(1).strip())
+
+    def resultOf(self, future):
+        # waits on a future from submitPacket, treating a lost reply as a timeout
+        try:
+            return future.result(self.sm.streamTimeout)
+        except Exception:
+            return -1
+
+    def buildRequest(self, address, command: Commands, payload = None):
+        # builds the M485 gcode for a packet and claims its packet id
+
+        self.log.debug("Sending packet payload: %s", payload)
+
+        sentPacketID = self._claimPacketID(address)
 
-        self.log.info("Sending packet payload: " + str(payload))
         # builds a packet without crc
         if payload is None:
-            packet = [address, 0x00, self._packetID, 1, command]
+            packet = bytearray((address, 0x00, sentPacketID, 1, command))
         else:
-            packet = [address, 0x00, self._packetID, len(payload) + 1, command] + payload
-
-        sentPacketID = self._packetID
+            packet = bytearray((address, 0x00, sentPacketID, len(payload) + 1, command))
+            packet += bytes(payload)
 
         gcode = self.buildPacketFromBytes(packet)
 
-        self.log.info("Gcode to send: " + str(gcode))
+        self.log.debug("Gcode to send: %s", gcode)
 
-        # open serial, send packet, close it
-        self.sm._ser.read_all()
-        response = self.sm.send(gcode).strip()
+        if self.recorder is not None:
+            self.recorder.request(address, sentPacketID, bytes.fromhex(gcode[5:]))
 
-        self.incrementPacketID()
+        return gcode, sentPacketID
 
-        reMatch = re.search("rs485-reply: (.*)", response).group(1)
+    def parseResponse(self, response, address, sentPacketID):
+        # returns the response payload, -1 on timeout or False on a bad packet
 
-        if reMatch == None or reMatch == "TIMEOUT":
+        byteArray = self.decodeResponse(response, address, sentPacketID)
+
+        if byteArray is False or byteArray == -1:
+            return byteArray
+
+        return list(byteArray[4:])
+
+    def decodeResponse(self, response, address, sentPacketID):
+        # returns the checked reply with its crc removed, -1 on timeout or
+        # False on a bad packet
+
+        reMatch = re.search("rs485-reply: (.*)", response.strip()) if response else None
+
+        if self.recorder is not None:
+            self.recorder.reply(address, sentPacketID, reMatch.group(1) if reMatch else None)
+
+        if reMatch is None or reMatch.group(1) == "TIMEOUT":
+            self.metrics.increment("leash_photon_timeouts_total", address=address)
             return -1
         else:
-            byteArray = self.buildBytesFromPacket(reMatch)
+            try:
+                byteArray = self.buildBytesFromPacket(reMatch.group(1))
+            except ValueError:
+                self.log.error("Received garbled packet.")
+                return self._badPacket(address)
+
+            if len(byteArray) < 5:
+                self.log.error("Received packet too short.")
+                return self._badPacket(address)
 
-            if byteArray[0] != 0x00:
+            elif byteArray[0] != 0x00:
                 self.log.error("Received packet not addressed to host.")
-                return False
+                return self._badPacket(address)
 
             elif byteArray[1] != address and address != 0xFF:
                 self.log.error("Received packet not from intended receipient.")
-                return False
+                return self._badPacket(address)
 
             elif byteArray[2] != sentPacketID:
-                self.log.error("Received packet with wrong packet id.")
-                return False
+                return self._wrongPacketID(address, byteArray[2])
 
             elif byteArray[3] != len(byteArray) - 5:
                 self.log.error("Received packet has wrong payload length.")
-                return False
+                return self._badPacket(address)
 
             else:
                 sacrificialCRC = byteArray
@@ -144,20 +458,54 @@ class Photon():
 
                 if receivedCRC != calcCRC:
                     self.log.error("Received packet with wrong crc.")
+                    self.metrics.increment("leash_photon_crc_errors_total", address=address)
                     return False
 
                 else:
-                    respond = byteArray[4:]
-                    return respond
+                    self._answered(sentPacketID)
+                    return byteArray
+
+    def _badPacket(self, address):
+        self.metrics.increment("leash_photon_bad_packets_total", address=address)
+        return False
+
+    def _wrongPacketID(self, address, packetID):
+        # a reply that belongs to another packet. it's still a failed
+        # exchange, but one the bus can recover from by trying again
+        with self._packetLock:
+            late = packetID in self._outstandingPackets
+            duplicate = packetID in self._answeredPackets
+
+        if late:
+            self.log.debug("Dropped late reply to packet %d", packetID)
+            self.metrics.increment("leash_photon_late_replies_total", address=address)
+        elif duplicate:
+            self.log.debug("Dropped duplicate reply to packet %d", packetID)
+            self.metrics.increment("leash_photon_duplicate_replies_total", address=address)
+        else:
+            self.log.error("Received packet with wrong packet id.")
+            self.metrics.increment("leash_photon_bad_packets_total", address=address)
 
-    ## UNICAST
+        return False
 
-    def getFeederUUID(self, address):
+    def sendBroadcast(self, command: Commands, payload = None):
+        # returns (sender address, payload), -1 on timeout or False on a bad
+        # packet, which on a broadcast usually means several feeders collided
 
-        self.log.info("Requesting UUID from address: " + str(address))
+        gcode, sentPacketID = self.buildRequest(0xFF, command, payload)
 
-        resp = self.sendPacket(address, Commands.GET_FEEDER_ID)
+        response = self.sm.send(gcode)
+
+        byteArray = self.decodeResponse(response, 0xFF, sentPacketID)
+
+        if byteArray is False or byteArray == -1:
+            return byteArray
+
+        return byteArray[1], list(byteArray[4:])
 
+    ## UNICAST
+
+    def uuidFromResponse(self, resp):
         if resp == -1:
             return -1
         elif resp == False:
@@ -170,94 +518,359 @@ class Photon():
             else:
                 return False
 
+    def getFeederUUID(self, address):
+
+        self.log.info("Requesting UUID from address: %s", address)
+
+        resp = self.sendPacket(address, Commands.GET_FEEDER_ID)
+
+        return self.uuidFromResponse(resp)
+
     def initializeFeeder(self, address, uuid):
 
-        self.log.info("Requesting init at address: " + str(address))
+        self.log.info("Requesting init at address: %s", address)
 
         resp = self.sendPacket(address, Commands.INITIALIZE_FEEDER, payload = uuid)
 
-        if resp != -1:
-            if resp[0] == 0x00:
-                return True
-            else:
-                return False
+        return self.isOK(resp)
+
+    def getVersion(self, address):
 
-    # def getVersion(address):
+        resp = self.sendPacket(address, Commands.GET_VERSION)
+
+        if resp == -1 or resp is False or resp[0] != 0x00 or len(resp) < 2:
+            return False
+
+        return resp[1]
+
+    def isOK(self, resp):
+        return resp != -1 and resp is not False and len(resp) > 0 and resp[0] == Status.OK
 
     def moveFeedForward(self, address, tenths):
 
-        self.log.info("Requesting " + str(tenths) + " feed from address: " + str(address))
+        self.log.info("Requesting %s feed from address: %s", tenths, address)
 
         resp = self.sendPacket(address, Commands.MOVE_FEED_FORWARD, payload = [tenths])
 
-        if resp[0] == 0x00:
-            return True
-        else:
-            return False
+        return self.isOK(resp)
 
     def moveFeedBackward(self, address, tenths):
 
         resp = self.sendPacket(address, Commands.MOVE_FEED_BACKWARD, payload = [tenths])
 
-        if resp[0] == 0x00:
-            return True
-        else:
-            return False
+        return self.isOK(resp)
+
+    def startFeedForward(self, address, tenths):
+        # starts a feed without waiting on the reply. returns a future that
+        # resolves True once the feeder has accepted the move, so the next
+        # feeder can be started while the head is still travelling. pair it
+        # with waitFeedersReady() before picking
+        return self._startFeed(address, Commands.MOVE_FEED_FORWARD, tenths)
+
+    def startFeedBackward(self, address, tenths):
+        return self._startFeed(address, Commands.MOVE_FEED_BACKWARD, tenths)
+
+    def _startFeed(self, address, command, tenths):
+
+        self.log.info("Starting %s feed at address: %s", tenths, address)
+
+        self.feeding.add(address)
+
+        accepted = Future()
+
+        def check(done):
+            accepted.set_result(self.isOK(done.result()))
+
+        self.submitPacket(address, command, payload = [tenths]).add_done_callback(check)
+
+        return accepted
+
+    def getFeedStatus(self, address):
+        # returns the feeder's Status, TIMEOUT if it didn't answer or
+        # UNKNOWN_ERROR for a bad reply
+        return self._statusOf(self.sendPacket(address, Commands.MOVE_FEED_STATUS))
+
+    def _statusOf(self, resp):
+        if resp == -1:
+            return Status.TIMEOUT
+        elif resp is False or len(resp) == 0:
+            return Status.UNKNOWN_ERROR
+
+        try:
+            return Status(resp[0])
+        except ValueError:
+            return Status.UNKNOWN_ERROR
 
     def moveFeedStatus(self, address):
+        # True once the last feed has finished
+
+        return self.getFeedStatus(address) == Status.OK
+
+    def waitFeedersReady(self, addresses = None, timeout = 5, interval = 0.01):
+        # blocks until every feeder has finished its feed, polling all of the
+        # ones still moving with one pipelined batch of MOVE_FEED_STATUS
+        # packets per round. defaults to every feeder started with
+        # startFeedForward/Backward. returns False if one fails or the
+        # timeout runs out
+
+        if addresses is None:
+            addresses = set(self.feeding)
 
-        resp = self.sendPacket(address, Commands.MOVE_FEED_STATUS)
+        waiting = set(addresses)
+        start = time.perf_counter()
 
-        if resp[0] == 0x00:
+        while waiting:
+            polls = [(address, self.submitPacket(address, Commands.MOVE_FEED_STATUS)) for address in waiting]
+
+            if not self.checkStatuses(waiting, [(address, self.resultOf(future)) for address, future in polls]):
+                return False
+
+            if not waiting:
+                break
+
+            if self.feedWaitExpired(waiting, start, timeout):
+                return False
+
+            time.sleep(interval)
+
+        return True
+
+    def checkStatuses(self, waiting, results):
+        # takes (address, reply) for one round of status polls, and drops the
+        # feeders that are done from waiting. False if one reported a failure
+        for address, resp in results:
+            status = self._statusOf(resp)
+
+            if status == Status.OK:
+                waiting.discard(address)
+                self.feeding.discard(address)
+
+                if address in self.feeders:
+                    self.feeders[address].seen()
+
+            elif status != Status.FEEDING_IN_PROGRESS:
+                self.log.error("Feeder at address %s reported %s", address, status.name)
+                self.feeding.discard(address)
+                return False
+
+        return True
+
+    def feedWaitExpired(self, waiting, start, timeout):
+        if time.perf_counter() - start > timeout:
+            self.log.error("Timed out waiting on feeders: %s", sorted(waiting))
             return True
-        else:
-            return False
+
+        return False
 
     def vendorOptions(self, address, payload):
 
-        resp = self.sendPacket(address, Commands.MOVE_FEED_FORWARD, payload = payload)
+        resp = self.sendPacket(address, Commands.VENDOR_OPTIONS, payload = payload)
 
-        if resp[0] == 0x00:
-            return True
-        else:
+        return self.isOK(resp)
+
+    def _addFeeder(self, address, uuid, version = None):
+        # initializes a feeder and records it in the feeder table
+
+        if not self.initializeFeeder(address, uuid):
+            self.log.error("Found feeder at %s but couldn't initialize", address)
             return False
 
-    def scan(self, min = 1, max = 50):
+        self.log.info("Initialized feeder %s at address %s", uuid, address)
+
+        return self._recordFeeder(address, uuid, version)
+
+    def _recordFeeder(self, address, uuid, version = None):
+
+        if version is None:
+            version = self.getVersion(address)
+
+        feeder = Feeder(uuid, address, version)
+        self.feeders[address] = feeder
+
+        # add to list of active feeders
+        if uuid not in self.activeFeeders:
+            self.activeFeeders.append(uuid)
+
+        return feeder
 
-        for i in range(min, max):
+    def scan(self, min = 1, max = 50, skip = ()):
+        # probes every address in turn. the GET_FEEDER_ID probes are pipelined
+        # so only the bus timeouts of absent feeders are paid, not a round trip each
+
+        probes = [(i, self.submitPacket(i, Commands.GET_FEEDER_ID)) for i in range(min, max) if i not in skip]
+
+        for i, future in probes:
 
             #see if a feeder is there
-            uuid = self.getFeederUUID(i)
+            uuid = self.uuidFromResponse(self.resultOf(future))
 
             #if we got a response
-            if uuid is not None and uuid != -1 and uuid != -2:
+            if isinstance(uuid, list):
+                self._addFeeder(i, uuid)
 
-                #initialize
-                if self.initializeFeeder(i, uuid):
+        self._saveRegistry()
 
-                    self.log.info("Initialized feeder " + str(uuid) + " at address " + str(i))
+        return self.feeders
 
-                    # add to list of active feeders
-                    self.activeFeeders.append(uuid)
+    def discover(self, min = 1, max = 50):
+        # finds feeders without probing every address. feeders remembered in
+        # the registry are looked up by uuid, then uninitialized ones answer
+        # a broadcast one at a time, so a sparse bank costs one bus timeout
+        # instead of one per empty address. only if broadcast replies collide
+        # are the remaining addresses scanned. a feeder initialized by an
+        # earlier session but missing from the registry answers neither
+        # broadcast, use scan() for those
 
-                else:
-                    self.log.error("Found feeder at " + str(i) + " but couldn't initialize")
+        self._findKnown()
+        self._findUninitialized(min, max)
+
+        self._saveRegistry()
+
+        return self.feeders
+
+    def _findKnown(self):
+        # looks up every feeder in the registry that isn't in the table yet
+        if self.registry is None:
+            return
+
+        found = [feeder.uuidString for feeder in self.feeders.values()]
+
+        for uuid, address, version in self.registry.known():
+
+            if bytes(uuid).hex() in found:
+                continue
+
+            address = self.getFeederAddress(uuid)
+
+            if address is not False and address != -1:
+                self._addFeeder(address, uuid)
+
+    def _findUninitialized(self, min, max):
+        # one broadcast per uninitialized feeder, plus one nobody answers
+
+        for _ in range(min, max):
+
+            resp = self.uninitializedFeedersRespond()
+
+            # nobody left uninitialized
+            if resp == -1:
+                return
+
+            if resp is False:
+                self.log.info("Broadcast replies collided, falling back to unicast scan")
+                self.scan(min, max, skip = set(self.feeders))
+                return
+
+            # the reply comes from the feeder's own address
+            sender, uuid = resp
+
+            if not self._addFeeder(sender, uuid):
+                return
+
+    def reconnect(self, registry = None, min = 1, max = 50):
+        # re-initializes the feeders remembered from the last session with
+        # targeted INITIALIZE_FEEDER calls, all pipelined. a feeder that
+        # doesn't answer at its old address is looked up by uuid, and only if
+        # that fails too are uninitialized feeders found as discover() does
+
+        if registry is None:
+            registry = self.registry or FeederRegistry()
+
+        self.registry = registry
+
+        known = registry.known()
+
+        requests = [
+            (uuid, address, version, self.submitPacket(address, Commands.INITIALIZE_FEEDER, payload = uuid))
+            for uuid, address, version in known
+        ]
+
+        missing = []
+
+        for uuid, address, version, future in requests:
+
+            if self.isOK(self.resultOf(future)):
+                self._recordFeeder(address, uuid, version)
+                continue
+
+            # it may have been moved to another slot
+            newAddress = self.getFeederAddress(uuid)
+
+            if newAddress is False or newAddress == -1 or not self._addFeeder(newAddress, uuid):
+                self.log.info("Known feeder %s didn't answer", bytes(uuid).hex())
+                missing.append(uuid)
+
+        if missing or not known:
+            # the known feeders have all been looked up by uuid already
+            self._findUninitialized(min, max)
+
+            # feeders that are gone for good shouldn't cost a scan every start
+            found = [feeder.uuidString for feeder in self.feeders.values()]
+            for uuid in missing:
+                if bytes(uuid).hex() not in found:
+                    registry.forget(uuid)
+
+            self._saveRegistry()
+
+            return self.feeders
+
+        self._saveRegistry()
+
+        return self.feeders
+
+    def _saveRegistry(self):
+        if self.registry is None:
+            return
+
+        self.registry.update(self.feeders)
+
+        try:
+            self.registry.save()
+        except OSError as e:
+            self.log.error("Couldn't save feeder registry: %s", e)
 
     ## BROADCAST
 
-    #def getFeederAddress(uuid):
+    def getFeederAddress(self, uuid):
+
+        self.log.info("Requesting address of UUID: %s", uuid)
+
+        resp = self.sendBroadcast(Commands.GET_FEEDER_ADDRESS, payload = uuid)
+
+        if resp == -1 or resp is False:
+            return resp
+
+        sender, payload = resp
+
+        if payload[0] != 0x00:
+            return False
+
+        return sender
 
     def identifyFeeder(self, uuid):
 
-        self.log.info("Requesting identify from UUID: " + str(uuid))
+        self.log.info("Requesting identify from UUID: %s", uuid)
 
         resp = self.sendPacket(0xFF, Commands.IDENTIFY_FEEDER, payload = uuid)
 
-        if resp[0] == 0x00:
-            return True
-        else:
-            return False
+        return self.isOK(resp)
 
     #def programFeederFloor(uuid, addressToProgram):
 
-    #def uninitilizedFeedersRespond():
+    def uninitializedFeedersRespond(self):
+        # returns (address, uuid) of one uninitialized feeder, -1 if none
+        # answered or False if the replies were garbled
+
+        resp = self.sendBroadcast(Commands.UNINITIALIZED_FEEDERS_RESPOND)
+
+        if resp == -1 or resp is False:
+            return resp
+
+        sender, payload = resp
+
+        uuid = self.uuidFromResponse(payload)
+
+        if not isinstance(uuid, list):
+            return False
+
+        return sender, uuid
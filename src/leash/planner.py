@@ -0,0 +1,191 @@
+"""Plans pick and place jobs into short, streamable G-code
+"""
+
+import math
+
+from . import gcode
+
+class Placement():
+
+    # pick and place are (x, y, z) in machine millimeters. rotation is the
+    # nozzle angle to place at, on A for the left nozzle or B for the right
+    def __init__(self, pick, place, nozzle = "LEFT", rotation = None):
+
+        self.pick = tuple(pick)
+        self.place = tuple(place)
+        self.nozzle = nozzle
+        self.rotation = rotation
+
+    def __repr__(self):
+        return "Placement(pick=" + str(self.pick) + ", place=" + str(self.place) + ", nozzle=" + self.nozzle + ")"
+
+def _distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+def travel(order, start = None):
+    # total xy travel of the order, including the pick to place legs
+    total = 0
+    position = start
+
+    for placement in order:
+        if position is not None:
+            total = total + _distance(position, placement.pick)
+        total = total + _distance(placement.pick, placement.place)
+        position = placement.place
+
+    return total
+
+def orderPlacements(placements, start = None, passes = 50):
+    # orders placements to cut down on travel between one place and the next
+    # pick. nearest neighbour gives a first tour, then 2-opt reverses
+    # segments while that shortens it
+    remaining = list(placements)
+
+    if len(remaining) < 2:
+        return remaining
+
+    order = []
+    position = start if start is not None else remaining[0].pick
+
+    while remaining:
+        nearest = min(remaining, key=lambda p: _distance(position, p.pick))
+        remaining.remove(nearest)
+        order.append(nearest)
+        position = nearest.place
+
+    return _twoOpt(order, start, passes)
+
+def _twoOpt(order, start, passes):
+    # the legs are asymmetric (a place to the next pick), so reversing a
+    # segment also flips every leg inside it. forward and reverse prefix sums
+    # let each candidate be scored in constant time
+    n = len(order)
+
+    def leg(a, b):
+        return _distance(order[a].place, order[b].pick)
+
+    def into(i, j):
+        # leg arriving at j when it follows position i - 1 in the tour
+        if i == 0:
+            return _distance(start, order[j].pick) if start is not None else 0
+        return leg(i - 1, j)
+
+    def sums():
+        forward = [0] * n
+        backward = [0] * n
+        for k in range(1, n):
+            forward[k] = forward[k - 1] + leg(k - 1, k)
+            backward[k] = backward[k - 1] + leg(k, k - 1)
+        return forward, backward
+
+    for _ in range(passes):
+        forward, backward = sums()
+        improved = False
+
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                old = into(i, i) + (forward[j] - forward[i])
+                new = into(i, j) + (backward[j] - backward[i])
+
+                if j + 1 < n:
+                    old = old + leg(j, j + 1)
+                    new = new + leg(i, j + 1)
+
+                if new < old - 1e-9:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    forward, backward = sums()
+                    improved = True
+
+        if not improved:
+            break
+
+    return order
+
+class JobPlanner():
+
+    def __init__(self, lumen, safeZ = None, dwell = 100):
+
+        self.lumen = lumen
+
+        self.safeZ = safeZ if safeZ is not None else lumen.parkZ
+
+        # milliseconds to wait for vacuum to build or release
+        self.dwell = dwell
+
+        self._commands = []
+        self.position = {}
+        self._pendingZ = None
+
+    def commands(self, placements, optimize = True):
+        # returns the full job as a list of G-code commands, ready to stream.
+        # self.position is left where the job ends
+
+        start = None
+        if self.lumen.position["x"] is not None and self.lumen.position["y"] is not None:
+            start = (self.lumen.position["x"], self.lumen.position["y"])
+
+        if optimize:
+            placements = orderPlacements(placements, start)
+
+        self._commands = []
+        self.position = dict(self.lumen.position)
+        self._pendingZ = None
+
+        for placement in placements:
+            pump = self.lumen.leftPump if placement.nozzle == "LEFT" else self.lumen.rightPump
+            axis = "a" if placement.nozzle == "LEFT" else "b"
+
+            self._lift()
+            self._move(x=placement.pick[0], y=placement.pick[1])
+            self._move(z=placement.pick[2])
+            self._actuate(pump.onCommands())
+            self._lift()
+
+            place = {"x": placement.place[0], "y": placement.place[1]}
+            if placement.rotation is not None:
+                place[axis] = placement.rotation
+
+            self._move(**place)
+            self._move(z=placement.place[2])
+            self._actuate(pump.offCommands())
+            self._lift()
+
+        self._flushZ()
+
+        return self._commands
+
+    def _lift(self):
+        self._move(z=self.safeZ)
+
+    def _move(self, **axes):
+        # z only moves are held back, so a run of them collapses into the
+        # last one, and moves to where the head already is are dropped
+        if set(axes) == {"z"}:
+            self._pendingZ = axes["z"]
+            return
+
+        self._flushZ()
+        self._emit(axes)
+
+    def _flushZ(self):
+        if self._pendingZ is not None:
+            z = self._pendingZ
+            self._pendingZ = None
+            self._emit({"z": z})
+
+    def _emit(self, axes):
+        changed = {axis: value for axis, value in axes.items() if self.position.get(axis) != value}
+
+        if not changed:
+            return
+
+        self._commands.append(gcode.move(**changed))
+        self.position.update(changed)
+
+    def _actuate(self, commands):
+        # vacuum switches as soon as marlin reads the command, not in step
+        # with the planner, so wait for the nozzle to arrive and then dwell
+        self._flushZ()
+        self._commands.append("M400")
+        self._commands.extend(commands)
+        self._commands.append("G4 P" + str(self.dwell))
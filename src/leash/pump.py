@@ -3,142 +3,183 @@
 
 import re, time
 
+from .monitor import PressureMonitor
+
+# writes 0x1B to the sensor's command register 0x30, starting a combined
+# pressure and temperature conversion
+TRIGGER_COMMANDS = [
+    "M260 A109",
+    "M260 B48",
+    "M260 B27",
+    "M260 S1"
+]
+
+# reads back register 0x30, whose bit 3 stays set until the conversion is done
+READY_COMMANDS = [
+    "M260 A109 B48 S1",
+    "M261 A109 B1 S1"
+]
+
+# reads 0x06, 0x07 and 0x08 in one go, the sensor auto increments the register
+PRESSURE_COMMANDS = [
+    "M260 A109 B6 S1",
+    "M261 A109 B3 S1"
+]
+
+# reads 0x09 and 0x0A
+TEMPERATURE_COMMANDS = [
+    "M260 A109 B9 S1",
+    "M261 A109 B2 S1"
+]
+
+def parseBytes(response, count):
+    # pulls count bytes out of an M261 reply, or returns None
+    reMatch = re.search("data:([0-9a-fA-F ]+)", response or "")
+
+    if reMatch is None:
+        return None
+
+    data = reMatch.group(1).replace(" ", "")
+
+    if len(data) < count * 2:
+        return None
+
+    return [int(data[i*2:i*2+2], 16) for i in range(count)]
+
+def parseData(response):
+    # pulls the byte out of an M261 reply, or returns None
+    data = parseBytes(response, 1)
+
+    if data is None:
+        return None
+
+    return data[0]
+
+def isReady(status):
+    return status is not None and not status & 0x08
+
+def toPressure(msb, csb, lsb):
+    # the pressure registers hold a signed 24 bit value
+    result = (msb << 16) | (csb << 8) | lsb
+
+    if(result & (1 << 23)):
+        result = result - 2**24
+
+    return result
+
+def toTemperature(high, low):
+    # the temperature registers hold a signed 16 bit value in 1/256 degrees
+    N = high * 256 + low
+
+    if N < 2**15:
+        return N / 256.0
+    else:
+        return (N - 2**16) / 256.0
+
 class Pump():
 
     def __init__(self, index, sm, log):
-        
+
         self.index = index
         self.sm = sm
         self.log = log
 
-    def getPressure(self):
-        
-            try:
-                if self.index == "LEFT":
-                    #selects vac 1 through multiplexer
-                    self.sm.send("M260 A112 B1 S1")
+        self.monitor = None
 
-                elif self.index == "RIGHT":
-
-                    #selects vac 2 through multiplexer
-                    self.sm.send("M260 A112 B2 S1")
+    def muxCommand(self):
+        # selects this pump's vacuum sensor through the i2c multiplexer
+        if self.index == "LEFT":
+            return "M260 A112 B1 S1"
+        elif self.index == "RIGHT":
+            return "M260 A112 B2 S1"
 
-                self.sm.send("M260 A109")
-                self.sm.send("M260 B48")
-                self.sm.send("M260 B27")
-                self.sm.send("M260 S1")
+    def onCommands(self):
+        if self.index == "LEFT":
+            # turn on pump, then valve
+            return ["M106", "M106 P1 S255"]
+        elif self.index == "RIGHT":
+            return ["M106 P2 S255", "M106 P3 S255"]
 
-                time.sleep(0.03)
+        return []
 
-                #read addresses 0x06 0x07 and 0x08 for pressure reading
-                self.sm.send("M260 A109 B6 S1")
-                msb = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
+    def offCommands(self):
+        if self.index == "LEFT":
+            return ["M107", "M107 P1"]
+        elif self.index == "RIGHT":
+            return ["M107 P2", "M107 P3"]
 
-                self.sm.send("M260 A109 B7 S1")
-                csb = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
+        return []
 
-                self.sm.send("M260 A109 B8 S1")
-                lsb = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
+    def triggerCommands(self):
+        return [self.muxCommand()] + TRIGGER_COMMANDS
 
-                val = msb.group(1)+csb.group(1)+lsb.group(1)
+    def _query(self, commands):
+        # pipelines every command and waits only on the last one's reply.
+        # a mux select for the channel already selected is skipped
+        if not self.sm.streamCached(commands[:-1]):
+            return False
 
-                result = int(val, 16)
+        return self.sm.send(commands[-1])
 
-                if(result & (1 << 23)):
-                    result = result - 2**24
+    def _waitReady(self, timeout):
+        start = time.perf_counter()
 
-                return result
-            except Exception as e: 
-                print(e)
+        while not isReady(parseData(self._query(READY_COMMANDS))):
+            if time.perf_counter() - start > timeout:
                 return False
 
-        
+        return True
 
-            try:
-                
+    def getPressure(self, timeout=0.05):
 
-                #read addresses 0x06 0x07 and 0x08 for pressure reading
-                self.sm.send("M260 A109 B6 S1")
-                msb = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
-
-                self.sm.send("M260 A109 B7 S1")
-                csb = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
+        try:
+            with self.sm.i2cLock:
+                # mux select and conversion trigger go out as one burst. the
+                # trigger starts a new measurement, so it is always sent
+                if not self.sm.streamCached(self.triggerCommands()):
+                    return False
 
-                self.sm.send("M260 A109 B8 S1")
-                lsb = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
+                if not self._waitReady(timeout):
+                    self.log.error("Vacuum sensor conversion didn't finish in time")
+                    return False
 
-                val = msb.group(1)+csb.group(1)+lsb.group(1)
+                data = parseBytes(self._query(PRESSURE_COMMANDS), 3)
 
-                result = int(val, 16)
+            return toPressure(*data)
 
-                if(result & (1 << 23)):
-                    result = result - 2**24
+        except Exception as e:
+            self.log.error("Couldn't read pressure: %s", e)
+            return False
 
-                return result
-            except Exception as e: 
-                print(e)
-                return False
-            
     def getTemperature(self):
 
         try:
-            if self.index == "LEFT":
-                #selects vac 1 through multiplexer
-                self.sm.send("M260 A112 B1 S1")
-            elif self.index == "RIGHT":
-                self.sm.send("M260 A112 B2 S1")
-
-            # Assuming sensor is an object or interface to communicate with the sensor
-            
-            # Read REG0x09 and REG0x0A
-            self.sm.send("M260 A109 B9 S1")
-            REG0x09 = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
-
-            self.sm.send("M260 A109 B10 S1")
-            REG0x0A = re.search("data:(..)", self.sm.send("M261 A109 B1 S1"))
-            
-            # Calculate the temperature ADC value
-            N = REG0x09 * 256 + REG0x0A
-            
-            # Determine if temperature is positive or negative
-            if N < 2**15:
-                # Temperature is positive
-                temperature = N / 256.0
-            else:
-                # Temperature is negative, apply the formula
-                temperature = (N - 2**16) / 256.0
-            
-            return temperature
-    
-        except Exception as e: 
-            print(e)
+            with self.sm.i2cLock:
+                data = parseBytes(self._query([self.muxCommand()] + TEMPERATURE_COMMANDS), 2)
+
+            return toTemperature(*data)
+
+        except Exception as e:
+            self.log.error("Couldn't read temperature: %s", e)
             return False
 
     def off(self):
-        if self.index == "LEFT":
-            self.sm.send("M107")
-            self.sm.send("M107 P1")
+        for i in self.offCommands():
+            self.sm.sendCached(i)
 
-        elif self.index == "RIGHT":
-            self.sm.send("M107 P2")
-            self.sm.send("M107 P3")
+    def on(self):
+        for i in self.onCommands():
+            self.sm.sendCached(i)
 
+    def startMonitor(self, **kwargs):
+        # samples pressure continuously in the background. see PressureMonitor
+        # for the detection settings and the picked/dropped/clogged callbacks
+        if self.monitor is None:
+            self.monitor = PressureMonitor(self, **kwargs)
 
-    def on(self):
-        if self.index == "LEFT":
-            # turn on pump
-            self.sm.send("M106")
-            # turn on valve
-            self.sm.send("M106 P1 S255")
-            # self.sm.send("G4 50")
-            # self.sm.send("M106 P1 S150")
+        self.monitor.start()
+        return self.monitor
 
-        elif self.index == "RIGHT":
-            #turn on pump
-            self.sm.send("M106 P2 S255")
-            #turn on valve
-            self.sm.send("M106 P3 S255")
-            # self.sm.send("G4 50")
-            # self.sm.send("M106 P3 S150")
- 
-            
+    def stopMonitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
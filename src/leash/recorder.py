@@ -0,0 +1,201 @@
+"""Records Photon bus traffic to a compact binary log, and replays it
+
+A log is a header followed by one frame per request or reply:
+
+    header  b"LPBR", version (u8), wall clock start time (f64)
+    frame   time since start (f64), kind (u8), address (u8),
+            packet id (u8), length (u16), data
+
+little endian throughout. Request data is the packet as sent, crc included.
+Reply data is the packet as received, or the text marlin sent if it wasn't
+hex. A late reply, one that arrived after its packet was given up on and
+logged as lost, keeps the text marlin sent. Logs are read through mmap, so a trace of millions of frames is never
+loaded whole.
+"""
+
+import enum
+import mmap, struct, threading, time
+
+from .logger import Logger
+
+MAGIC = b"LPBR"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBd")
+FRAME = struct.Struct("<dBBBH")
+
+class Kind(enum.IntEnum):
+    REQUEST = 0
+    REPLY = 1
+    # marlin reported that no feeder answered
+    TIMEOUT = 2
+    # marlin's reply wasn't hex
+    GARBLED = 3
+    # no rs485-reply at all, e.g. the host gave up waiting on marlin
+    LOST = 4
+    # the reply to a LOST packet, once it turned up
+    LATE = 5
+
+class Frame():
+
+    __slots__ = ("time", "kind", "address", "packetID", "data")
+
+    def __init__(self, time, kind, address, packetID, data):
+        self.time = time
+        self.kind = kind
+        self.address = address
+        self.packetID = packetID
+        self.data = data
+
+    def response(self):
+        # the reply as marlin printed it, for feeding back through the parser
+        if self.kind == Kind.REPLY:
+            return "rs485-reply: " + self.data.hex()
+        elif self.kind == Kind.TIMEOUT:
+            return "rs485-reply: TIMEOUT"
+        elif self.kind in (Kind.GARBLED, Kind.LATE):
+            return "rs485-reply: " + self.data.decode("utf-8", "replace")
+
+        return ""
+
+    def __repr__(self):
+        return "Frame(" + format(self.time, ".6f") + ", " + Kind(self.kind).name + ", address=" + str(self.address) + ", id=" + str(self.packetID) + ", " + self.data.hex() + ")"
+
+class Recorder():
+
+    # appends frames to path as they happen. set it as photon.recorder to
+    # record a session, and close() it to flush the rest to disk
+    def __init__(self, path):
+
+        self.path = path
+        self.frames = 0
+
+        self._file = open(path, "wb")
+        self._lock = threading.Lock()
+
+        self._start = time.perf_counter()
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+
+    def record(self, kind, address, packetID, data = b""):
+        elapsed = time.perf_counter() - self._start
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            self._file.write(FRAME.pack(elapsed, kind, address & 0xFF, packetID & 0xFF, len(data)))
+            self._file.write(data)
+            self.frames = self.frames + 1
+
+    def request(self, address, packetID, packet):
+        self.record(Kind.REQUEST, address, packetID, bytes(packet))
+
+    def reply(self, address, packetID, text):
+        # text is what followed "rs485-reply: ", or None if there was no reply
+        if text is None:
+            self.record(Kind.LOST, address, packetID)
+        elif text == "TIMEOUT":
+            self.record(Kind.TIMEOUT, address, packetID)
+        else:
+            try:
+                self.record(Kind.REPLY, address, packetID, bytes.fromhex(text))
+            except ValueError:
+                self.record(Kind.GARBLED, address, packetID, text.encode("utf-8"))
+
+    def late(self, address, packetID, text):
+        # text is what followed "rs485-reply: " in a reply that came after
+        # the packet was recorded as lost
+        self.record(Kind.LATE, address, packetID, text.encode("utf-8"))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Trace():
+
+    # a recorded log, read through mmap. iterating yields Frames in order
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, "rb") as f:
+            size = f.seek(0, 2)
+
+            if size < HEADER.size:
+                raise ValueError(path + " is too short to be a bus log")
+
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.started = HEADER.unpack_from(self._map, 0)
+
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(path + " isn't a version " + str(VERSION) + " bus log")
+
+    def __iter__(self):
+        view = self._map
+        end = len(view)
+        offset = HEADER.size
+        unpack = FRAME.unpack_from
+        frameSize = FRAME.size
+
+        # a frame cut short by a crash while recording ends the trace
+        while offset + frameSize <= end:
+            elapsed, kind, address, packetID, length = unpack(view, offset)
+            offset = offset + frameSize
+
+            if offset + length > end:
+                return
+
+            yield Frame(elapsed, kind, address, packetID, view[offset:offset + length])
+            offset = offset + length
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def replay(path, photon = None, speed = None):
+    # feeds every reply in a log back through photon.parseResponse, yielding
+    # (frame, parsed reply) with the same -1 / False / payload values a live
+    # session saw. speed paces replies against their recorded times, e.g.
+    # 1.0 for real time, or None to go as fast as possible. the photon is
+    # a detached one by default, so replays count into its own metrics
+    if photon is None:
+        from .photon import Photon
+        photon = Photon(None, Logger(False).child("photon"))
+
+    with Trace(path) as trace:
+        start = time.perf_counter()
+
+        for frame in trace:
+            if frame.kind == Kind.REQUEST:
+                # lets the parser tell late replies from stray ones
+                photon._outstandingPackets[frame.packetID] = frame.address
+                continue
+
+            # the live session never parsed these, only counted them
+            if frame.kind == Kind.LATE:
+                photon.lateReply(frame.address, frame.packetID)
+                continue
+
+            if speed:
+                wait = frame.time / speed - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+
+            yield frame, photon.parseResponse(frame.response(), frame.address, frame.packetID)
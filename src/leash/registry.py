@@ -0,0 +1,78 @@
+"""On-disk cache of known Photon feeders, so a restart can skip the bus scan
+"""
+
+import json, os, re, time
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".leash")
+
+class FeederRegistry():
+
+    def __init__(self, path = None):
+
+        if path is None:
+            path = os.path.join(CACHE_DIR, "feeders.json")
+
+        self.path = path
+
+        # uuid hex string -> {"address", "slot", "version", "lastSeen"}
+        self.entries = {}
+
+        self.load()
+
+    @classmethod
+    def forMachine(cls, name):
+        # a registry of its own for one of several machines on a host, e.g.
+        # keyed by usb serial number, so they don't forget each other's feeders
+        return cls(os.path.join(CACHE_DIR, "feeders-" + re.sub(r"[^\w.-]", "_", str(name)) + ".json"))
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+        return self.entries
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # written aside and swapped in, so a crash never leaves half a file
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.entries, f, indent=2)
+
+        os.replace(temp, self.path)
+
+    def update(self, feeders):
+        # records every Feeder in a {address: Feeder} table
+        for feeder in feeders.values():
+            entry = self.entries.setdefault(feeder.uuidString, {"slot": None})
+            entry["address"] = feeder.address
+            entry["version"] = feeder.version
+            entry["lastSeen"] = feeder.lastSeen
+
+    def forget(self, uuid):
+        self.entries.pop(bytes(uuid).hex(), None)
+
+    def assignSlot(self, uuid, slot):
+        entry = self.entries.setdefault(bytes(uuid).hex(), {"address": None, "version": None, "lastSeen": time.time()})
+        entry["slot"] = slot
+
+    def slotOf(self, uuid):
+        entry = self.entries.get(bytes(uuid).hex())
+
+        if entry is None:
+            return None
+
+        return entry.get("slot")
+
+    def known(self):
+        # returns (uuid, address, version) for every feeder with an address
+        return [
+            (list(bytes.fromhex(uuid)), entry["address"], entry.get("version"))
+            for uuid, entry in self.entries.items()
+            if entry.get("address") is not None
+        ]
@@ -2,128 +2,779 @@
 """
 
 import serial.tools.list_ports
-import serial, time, re
+import serial, time, re, threading, queue, collections
+
+from concurrent.futures import Future, TimeoutError, ThreadPoolExecutor
+
+from . import cache, gcode
+from .metrics import Metrics
+from .state import MachineState
+
+# usb vid:pid of the Lumen motherboard
+DEVICE_ID = "0483:5740"
+
+# rates findBaud() tries, fastest first
+BAUDRATES = (1000000, 500000, 250000, 230400, 115200)
+
+def findPorts(device_id=DEVICE_ID):
+    # every connected port matching device_id, as (port, serial number, hwid)
+    # tuples sorted by port. serial number is None if the os doesn't report one
+    found = []
+
+    for info in sorted(serial.tools.list_ports.comports(), key=lambda i: i.device):
+        if device_id in info.hwid:
+            found.append((info.device, info.serial_number, info.hwid))
+
+    return found
+
+class CommandFuture(Future):
+
+    # a submitted command's future. started is the perf_counter time marlin
+    # got to the command, when the one ahead of it was acknowledged, or None
+    # while it is still queued behind others
+    def __init__(self):
+        super().__init__()
+        self.started = None
+
+class PendingCommand():
+
+    def __init__(self, message):
+        self.message = message
+        self.lines = []
+        self.future = CommandFuture()
+
+        # perf_counter time the command was written
+        self.sent = None
+
+        # bytes as written, with the line number and checksum if enabled
+        self.wire = None
+        self.resends = 0
+
+    @property
+    def code(self):
+        # the G-code family the command's metrics are filed under, e.g. M260
+        return self.message.split(" ", 1)[0].upper()
 
 class SerialManager():
 
-    def __init__(self, log):
+    # transport stands in for the pyserial port, anything with the same open,
+    # close, write, readline and read_all methods, like sim.VirtualLumen
+    def __init__(self, log, bufsize=4, transport=None, metrics=None):
 
-        self._ser = serial.Serial()
-        self._ser.baudrate = 119200
-        self._ser.timeout = 1
+        if transport is not None:
+            self._ser = transport
+        else:
+            self._ser = serial.Serial()
+            self._ser.baudrate = 119200
+            self._ser.timeout = 1
 
         self.log = log
 
-    def clearQueue(self, timeout=3):
-        messages = [
-            "M400",
-            "M118 E1 done"
-        ]
-
-        # send messages
-        for i in messages:
-            response = self.send(i)
-            reMatch = re.search("echo:done", response)
-            if reMatch is not None:
-                return True
+        # number of commands allowed in flight while streaming. defaults to
+        # marlin's BUFSIZE, and is updated from ADVANCED_OK replies if enabled
+        self.bufsize = bufsize
+        self.streamTimeout = 30
+
+        # checksummed streaming, see enableChecksums()
+        self.checksums = False
+        self.maxResends = 5
+        self._lineNumber = 0
+        self._rejected = False
+
+        # lines that arrived while no command was outstanding, or marlin's
+        # busy notices. kept for inspection, oldest are dropped first
+        self.unsolicited = collections.deque(maxlen=256)
+
+        # commands written to marlin and still waiting on their ok, oldest first
+        self._pending = collections.deque()
+        self._lock = threading.Condition()
+
+        self._listeners = []
+
+        # callables run with every command as it is written, so models of the
+        # machine see raw sends too
+        self.observers = []
+
+        # held across i2c sequences, both vacuum sensors sit behind one multiplexer
+        self.i2cLock = threading.RLock()
+
+        # what marlin's settings are after the commands sent so far, so the
+        # *Cached senders can skip commands that wouldn't change anything
+        self.state = MachineState()
+        self.observers.append(self.state.apply)
+
+        self._reader = None
+        self._reading = False
+
+        # the port scanPorts() picked, and whether it came from the cache
+        self._scannedPort = None
+        self.portFromCache = False
 
-        #wait for done to arrive with timeout
-        start = time.perf_counter()
+        # completion markers, see mark(). id -> future resolved when marlin
+        # echoes it back, and the highest id seen so far
+        self._markerCount = 0
+        self._markers = {}
+        self.markerDone = 0
+
+        # callable returning the seconds of motion still queued on marlin,
+        # which Lumen points at its MotionModel. marker waits are sized from
+        # it, with markerSlack seconds on top for round trips
+        self.estimator = None
+        self.markerSlack = 3
+
+        # marlin sends busy notices every couple of seconds while M400 holds
+        # it, so a wait isn't given up while they are still coming
+        self.busyGrace = 5
+        self._lastBusy = 0
+
+        # resync sentinel in flight, see resync()
+        self._syncCount = 0
+        self._sync = None
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.describe("leash_serial_round_trip_seconds", "histogram", "Time from marlin reaching a command to its ok, by G-code")
+        self.metrics.describe("leash_serial_queue_seconds", "histogram", "Time a command waited behind earlier ones before marlin reached it, by G-code")
+        self.metrics.describe("leash_serial_timeouts_total", "counter", "Commands whose ok didn't arrive in time")
+        self.metrics.describe("leash_serial_resends_total", "counter", "Lines marlin asked to have sent again")
+        self.metrics.describe("leash_serial_lost_oks_total", "counter", "Commands dropped by a resync because their ok never came")
+
+    def clearQueue(self, timeout=None):
+        # blocks until every move sent so far has finished. timeout defaults
+        # to the estimated time left on the queue, see markerTimeout()
+        marker = self.mark()
+
+        if marker is False:
+            return False
+
+        return self.waitMarker(marker, timeout)
+
+#####################
+# Markers
+#####################
+
+    def mark(self):
+        # queues M400 and a uniquely numbered M118 behind everything sent so
+        # far. M400 holds marlin until all moves are done, so the marker's
+        # echo only arrives once they have finished. returns the marker's id
+        # for waitMarker(), or False if it couldn't be sent
+        with self._lock:
+            self._markerCount = self._markerCount + 1
+            marker = self._markerCount
+            self._markers[marker] = Future()
+
+        if self.submit("M400") is False or self.submit("M118 E1 leash:" + str(marker)) is False:
+            with self._lock:
+                self._markers.pop(marker, None)
+            return False
+
+        return marker
+
+    def markerFuture(self, marker):
+        # future for a marker, or None if it has already been echoed
+        with self._lock:
+            return self._markers.get(marker)
+
+    def markerTimeout(self):
+        remaining = self.estimator() if self.estimator is not None else 0
+        return remaining * 1.5 + self.markerSlack
+
+    def stillBusy(self):
+        # True if marlin sent a busy notice within the last busyGrace seconds
+        return time.perf_counter() - self._lastBusy < self.busyGrace
+
+    def waitMarker(self, marker, timeout=None):
+        # blocks until marlin echoes marker. returns False if it didn't
+        # arrive in timeout seconds and marlin stopped reporting busy
+        future, timeout = self.beginMarkerWait(marker, timeout)
+
+        if future is None:
+            return marker <= self.markerDone
+
+        deadline = time.perf_counter() + timeout
 
         while True:
-            response = self._ser.readline().decode('utf-8')
-            reMatch = re.search("echo:done", response)
-            if reMatch is not None:
+            try:
+                future.result(max(0, deadline - time.perf_counter()))
                 return True
+            except TimeoutError:
+                deadline = self.markerOverdue(marker, timeout)
 
-            if time.perf_counter() - start > timeout:
+                if deadline is None:
+                    return False
+            except (OSError, serial.SerialException):
                 return False
-            
+
+    def beginMarkerWait(self, marker, timeout):
+        # the marker's future, None if it was already echoed, and the timeout
+        # to wait on it with
+        if timeout is None:
+            timeout = self.markerTimeout()
+
+        return self.markerFuture(marker), timeout
+
+    def markerOverdue(self, marker, timeout):
+        # called when a marker wait runs out. returns a new deadline while
+        # marlin still reports busy, otherwise counts the timeout and
+        # returns None
+        if self.stillBusy():
+            return time.perf_counter() + self.busyGrace
+
+        self.log.error("Timed out waiting for marker %d after %.1f s", marker, timeout)
+        self.metrics.increment("leash_serial_timeouts_total", code="M118")
+        return None
 
     def scanPorts(self):
+        # picks a Lumen to connect to. the port the last connection used is
+        # taken straight away if it is still there, otherwise every matching
+        # port is probed at once and the first one that opens wins. use
+        # findPorts() to see all of them when several are connected
+        found = findPorts()
+        ports = [port for port, serialNumber, hwid in found]
 
-        comports = serial.tools.list_ports.comports()
+        cached = cache.load("serial").get("port")
 
-        device_id = "0483:5740"
+        if cached in ports:
+            self.log.info("Using last known port: %s", cached)
+            self._usePort(cached, True)
+            return True
 
-        for port, desc, hwid in sorted(comports):
-            if device_id in hwid:
-                try:
-                    s = serial.Serial(port)
-                    s.close()
-                    self.log.info("Found motherboard at port: " + " with hwid: " + hwid)
-                    self._ser.port = port
-                    return True
+        if found:
+            with ThreadPoolExecutor(max_workers=len(found)) as pool:
+                usable = list(pool.map(self._probe, ports))
 
-                except (OSError, serial.SerialException):
-                    pass
+            for (port, serialNumber, hwid), ok in zip(found, usable):
+                if ok:
+                    self.log.info("Found motherboard at port: %s with hwid: %s", port, hwid)
+                    self._usePort(port, False)
+                    return True
 
         self.log.error("Was unable to find a connected Lumen")
         return False
 
+    def _probe(self, port):
+        try:
+            s = serial.Serial(port)
+            s.close()
+            return True
+
+        except (OSError, serial.SerialException):
+            return False
+
+    def _usePort(self, port, fromCache):
+        self._ser.port = port
+        self._scannedPort = port
+        self.portFromCache = fromCache
+
+    def forgetPort(self):
+        # drops the cached port, e.g. when it no longer opens
+        cache.update("serial", port=None)
+        self.portFromCache = False
+
     def openSerial(self):
         if self._ser.is_open:
             self.log.info("Serial port already open")
             return True
-        
-        if self._ser.port != "":
-            self._ser.open()
+
+        if self._ser.port:
+            try:
+                self._ser.open()
+            except (OSError, serial.SerialException) as e:
+                self.log.error("Couldn't open serial port: %s", e)
+                return False
+
             self._ser.timeout = 1
         else:
             self.log.error("No serial port selected")
             return False
 
         if self._ser.is_open:
-            self.log.info("Connected to Lumen over serial port: " + self._ser.port)
+            self.log.info("Connected to Lumen over serial port: %s", self._ser.port)
+
+            if self._ser.port == self._scannedPort and not self.portFromCache:
+                cache.update("serial", port=self._ser.port)
+
+            self.state.invalidate()
             self._ser.read_all()
+            self.startReader()
             return True
         else:
             self.log.error("Couldn't open serial port")
             return False
-        
-    def send(self, message):
-        # send can return two things
-        # it can return bool False if port isnt open
-        # or it can respond with marlin's response
-        
-        #check to see if serial port is open
-        if self._ser.is_open:
-            self._ser.reset_input_buffer()
-            encoded = message.encode('utf-8')
-            self._ser.write(encoded + b'\n')
-            resp = self._ser.readline().decode('utf-8')
-            return resp
-        else:
-            self.log.error("Serial port isn't open.")
+
+    def findBaud(self, candidates=BAUDRATES, tries=3):
+        # picks the fastest rate marlin answers reliably at, trying each with
+        # a few echoed probes. the Lumen's own usb port ignores the rate, so
+        # this only matters for a board behind a usb to uart bridge. returns
+        # the rate, or False with the original rate restored
+        original = self._ser.baudrate
+
+        for rate in candidates:
+            if self._tryBaud(rate, tries):
+                self.log.info("Talking to marlin at %d baud", rate)
+                return rate
+
+        self._ser.baudrate = original
+        self._ser.reset_input_buffer()
+        return False
+
+    def _tryBaud(self, rate, tries):
+        self._ser.baudrate = rate
+        self._ser.reset_input_buffer()
+
+        for i in range(tries):
+            probe = "leash-baud:" + str(rate) + ":" + str(i)
+            response = self.send("M118 E1 " + probe, timeout=0.5)
+
+            if not response or "echo:" + probe not in response:
+                # garbled commands never get their ok, drop them
+                self._failPending(serial.SerialException("No reply at " + str(rate) + " baud"))
+                return False
+
+        return True
+
+    def enableChecksums(self):
+        # numbers and checksums every line from here on, so marlin asks for
+        # any line corrupted on the way to be sent again instead of running
+        # it. M110 resets marlin's line counter first
+        if not self.drain() or not self.send("M110 N0"):
             return False
-        
-    def sendBlind(self, message):
-        if self._ser.is_open:
-            self._ser.reset_input_buffer()
-            encoded = message.encode('utf-8')
-            self._ser.write(encoded + b'\n')
-            return True
-        else:
+
+        with self._lock:
+            self._lineNumber = 0
+            self.checksums = True
+
+        return True
+
+    def disableChecksums(self):
+        with self._lock:
+            self.checksums = False
+
+    def closeSerial(self):
+        self.state.invalidate()
+        self.stopReader()
+        self._ser.close()
+        self._failPending(serial.SerialException("Serial port closed"))
+
+        return not self._ser.is_open
+
+#####################
+# Reader
+#####################
+
+    def startReader(self):
+        if self._reader is not None and self._reader.is_alive():
+            return
+
+        self._reading = True
+        self._reader = threading.Thread(target=self._readLoop, name="leash-serial-reader", daemon=True)
+        self._reader.start()
+
+    def stopReader(self):
+        self._reading = False
+
+        if self._reader is not None and self._reader is not threading.current_thread():
+            self._reader.join()
+
+        self._reader = None
+
+    def subscribe(self, pattern):
+        # returns a queue that receives every incoming line matching pattern,
+        # whether or not it belongs to an outstanding command
+        lines = queue.Queue()
+        self._listeners.append((re.compile(pattern), lines))
+        return lines
+
+    def unsubscribe(self, lines):
+        self._listeners = [i for i in self._listeners if i[1] is not lines]
+
+    def _readLoop(self):
+        while self._reading:
+            try:
+                raw = self._ser.readline()
+            except (OSError, serial.SerialException) as e:
+                self.log.error("Serial reader stopped: %s", e)
+                self._reading = False
+                self._failPending(e)
+                break
+
+            if raw:
+                self._dispatch(raw.decode('utf-8', errors='replace').strip())
+
+    def _dispatch(self, line):
+        # every line is parsed exactly once here. oks complete the oldest
+        # outstanding command, anything else is attached to it, and lines
+        # with no command waiting are kept as unsolicited
+        for pattern, lines in self._listeners:
+            if pattern.search(line):
+                lines.put(line)
+
+        command = None
+        markers = []
+        lost = []
+
+        with self._lock:
+            if line.startswith("echo:leash:"):
+                markers = self._markersDone(line)
+
+            if line.startswith("echo:leash-sync:"):
+                lost = self._synced(line)
+
+            if line.startswith("busy:") or line.startswith("echo:busy"):
+                self._lastBusy = time.perf_counter()
+                self.unsolicited.append(line)
+
+            elif line.startswith("Resend:") or line.startswith("rs "):
+                # the ok that follows is for a line marlin threw away
+                self._rejected = True
+                self.unsolicited.append(line)
+
+            elif line.startswith("ok") and self._pending and self._rejected:
+                self._rejected = False
+                command = self._resend(self._pending.popleft())
+                self._advance()
+
+            elif line.startswith("ok") and self._pending:
+                command = self._pending.popleft()
+                command.lines.append(line)
+                self._advance()
+
+                # ADVANCED_OK replies look like "ok N<line> P<planner> B<buffer>",
+                # where B is the number of free slots in marlin's command buffer
+                reMatch = re.search(r"B(\d+)", line)
+                if reMatch is not None:
+                    self.bufsize = max(1, int(reMatch.group(1)) + len(self._pending))
+
+                self._lock.notify_all()
+
+            elif self._pending:
+                self._pending[0].lines.append(line)
+
+            else:
+                self.unsolicited.append(line)
+
+        # resolved outside the lock so callbacks are free to send
+        if command is not None and command.resends > self.maxResends:
+            command.future.set_exception(serial.SerialException("Marlin rejected " + command.message + " " + str(self.maxResends) + " times"))
+
+        elif command is not None:
+            now = time.perf_counter()
+
+            # time spent queued behind earlier commands is kept apart, so a
+            # slow command isn't confused with a busy queue
+            started = command.future.started if command.future.started is not None else command.sent
+            self.metrics.observe("leash_serial_queue_seconds", started - command.sent, code=command.code)
+            self.metrics.observe("leash_serial_round_trip_seconds", now - started, code=command.code)
+            self.log.span("serial", command.message, command.sent, now)
+
+            command.future.set_result("\n".join(command.lines))
+
+        for future in markers:
+            future.set_result(True)
+
+        # answered like a send that timed out
+        for dropped in lost:
+            dropped.future.set_result("")
+
+    def _resend(self, command):
+        # writes a rejected line again, behind the lines already in flight.
+        # marlin rejects every line after a bad one until it is resent, so
+        # those come back here in order too. called with the lock held.
+        # returns the command once it has been rejected too often
+        command.resends = command.resends + 1
+        command.lines = []
+        command.future.started = None
+
+        self.metrics.increment("leash_serial_resends_total", code=command.code)
+
+        if command.resends > self.maxResends:
+            self.log.error("Giving up on %s after %d resends", command.message, self.maxResends)
+            self._lock.notify_all()
+            return command
+
+        self._pending.append(command)
+        self._ser.write(command.wire)
+
+        return None
+
+    def resync(self):
+        # recovers from oks that never arrived, which would otherwise leave
+        # every later reply matched to the wrong command. a numbered M118
+        # goes out, and once marlin echoes it every command written before it
+        # has been processed, so any still waiting on an ok lost it and is
+        # dropped. commands that are only slow, like a long M400, are answered
+        # before the echo and left alone. written even if the buffer looks
+        # full, since lost oks are what fill it
+        with self._lock:
+            if self._sync is not None or not self._ser.is_open:
+                return False
+
+            self._syncCount = self._syncCount + 1
+            self._sync = PendingCommand("M118 E1 leash-sync:" + str(self._syncCount))
+            self._write(self._sync)
+
+        self._sync.future.set_running_or_notify_cancel()
+        return True
+
+    def _synced(self, line):
+        # called with the lock held. returns the commands that lost their ok
+        sync = self._sync
+
+        if sync is None or line != "echo:leash-sync:" + str(self._syncCount):
+            return []
+
+        self._sync = None
+
+        if sync not in self._pending:
+            return []
+
+        lost = []
+        while self._pending[0] is not sync:
+            lost.append(self._pending.popleft())
+
+        self._advance()
+
+        if lost:
+            self.log.error("Dropped %d commands whose ok never arrived", len(lost))
+            for command in lost:
+                self.metrics.increment("leash_serial_lost_oks_total", code=command.code)
+
+            self._lock.notify_all()
+
+        return lost
+
+    def _advance(self):
+        # the command now at the head of the queue is the one marlin is on.
+        # called with the lock held
+        if self._pending and self._pending[0].future.started is None:
+            self._pending[0].future.started = time.perf_counter()
+
+    def _markersDone(self, line):
+        # markers are echoed in order, so one arriving means every earlier
+        # one has too. called with the lock held
+        try:
+            marker = int(line[len("echo:leash:"):])
+        except ValueError:
+            return []
+
+        self.markerDone = max(self.markerDone, marker)
+
+        done = [i for i in self._markers if i <= marker]
+        return [self._markers.pop(i) for i in done]
+
+    def _failPending(self, exception):
+        with self._lock:
+            failed = list(self._pending)
+            self._pending.clear()
+
+            markers = list(self._markers.values())
+            self._markers.clear()
+
+            self._sync = None
+
+            self._lock.notify_all()
+
+        for command in failed:
+            command.future.set_exception(exception)
+
+        for future in markers:
+            future.set_exception(exception)
+
+#####################
+# Sending
+#####################
+
+    def submit(self, message):
+        # writes a command and returns a future for marlin's full response,
+        # without waiting on the round trip. only blocks while bufsize
+        # commands are already in flight. returns False if the port isn't open
+        if not self._ser.is_open:
             self.log.error("Serial port isn't open.")
             return False
 
-    def send_rtn_lines(self, message):
-        # send can return two things
+        # marlin doesn't acknowledge blank or comment-only lines, so they are
+        # answered here instead of being written
+        if not message.split(";", 1)[0].strip():
+            future = Future()
+            future.set_result("ok")
+            return future
+
+        self.startReader()
+
+        command = PendingCommand(message)
+
+        with self._lock:
+            if not self._lock.wait_for(lambda: len(self._pending) < self.bufsize, self.streamTimeout):
+                self.log.error("Timed out sending, marlin stopped acknowledging commands")
+                self.metrics.increment("leash_serial_timeouts_total", code=command.code)
+                full = True
+            else:
+                self._write(command)
+                full = False
+
+        if full:
+            self.resync()
+            return False
+
+        # once written the command can't be taken back, so the future can't be cancelled
+        command.future.set_running_or_notify_cancel()
+
+        return command.future
+
+    def _write(self, command):
+        # queues and writes a command, called with the lock held
+        self._pending.append(command)
+
+        if self.checksums:
+            self._lineNumber = self._lineNumber + 1
+            command.wire = (gcode.numbered(command.message, self._lineNumber) + "\n").encode('utf-8')
+        else:
+            command.wire = command.message.encode('utf-8') + b'\n'
+
+        command.sent = time.perf_counter()
+        self._ser.write(command.wire)
+
+        if len(self._pending) == 1:
+            command.future.started = command.sent
+
+        for observer in self.observers:
+            observer(command.message)
+
+    def replyDeadline(self, future, timeout):
+        # when the reply to a submitted command is overdue: timeout seconds
+        # after marlin got to it, so time spent queued behind other commands
+        # doesn't count. None while it is still queued
+        started = getattr(future, "started", None)
+
+        if started is None:
+            return None
+
+        return started + timeout
+
+    def result(self, future, timeout=None):
+        # future.result(timeout) for a submitted command, with timeout
+        # counted as in replyDeadline(). a command that stays queued for
+        # longer than streamTimeout times out too
+        if timeout is None:
+            return future.result()
+
+        giveUp = time.perf_counter() + self.streamTimeout
+
+        while True:
+            wait = self.resultWait(future, timeout, giveUp)
+
+            try:
+                return future.result(0 if wait is None else wait)
+            except TimeoutError:
+                if wait is None:
+                    raise
+
+    def resultWait(self, future, timeout, giveUp):
+        # seconds to wait on a submitted command before looking again, or
+        # None once its reply is overdue. while it is still queued, that is
+        # once it could have started
+        now = time.perf_counter()
+        deadline = self.replyDeadline(future, timeout)
+
+        if now >= giveUp or (deadline is not None and now >= deadline):
+            return None
+
+        return min(timeout if deadline is None else deadline - now, giveUp - now)
+
+    @property
+    def timeout(self):
+        # seconds send() waits for a reply by default
+        return self._ser.timeout
+
+    def full(self):
+        # True if submitting another command would block on marlin's buffer
+        with self._lock:
+            return len(self._pending) >= self.bufsize
+
+    def drain(self, timeout=None):
+        # blocks until every outstanding command has been acknowledged
+        if timeout is None:
+            timeout = self.streamTimeout
+
+        with self._lock:
+            if not self._lock.wait_for(lambda: not self._pending, timeout):
+                self.log.error("Timed out waiting for %d commands to be acknowledged", len(self._pending))
+                return False
+
+        return True
+
+    def stream(self, messages):
+        # sends a sequence of commands without waiting on each round trip,
+        # keeping up to bufsize commands in flight and only blocking when
+        # marlin's buffer is full. returns False if the port isn't open or
+        # marlin stops acknowledging
+        for message in messages:
+            if self.submit(message) is False:
+                return False
+
+        return True
+
+    def send(self, message, timeout=None):
+        # send can return three things
         # it can return bool False if port isnt open
+        # it can return "" if marlin didn't finish responding within timeout
         # or it can respond with marlin's response
-        
-        #check to see if serial port is open
-        if self._ser.is_open:
-            self._ser.reset_input_buffer()
-            encoded = message.encode('utf-8')
-            self._ser.write(encoded + b'\n')
-            resp = self._ser.readlines()
-            decoded_resp = ""
-            i = 0
-            while i < len(resp):
-                decoded_resp = decoded_resp + resp[i].decode('utf-8')
-                i = i + 1
-            return decoded_resp
-        else:
-            self.log.error("Serial port isn't open.")
-            return False
\ No newline at end of file
+        if timeout is None:
+            timeout = self.timeout
+
+        future = self.submit(message)
+
+        if future is False:
+            return False
+
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            self.replyTimedOut(message)
+            return ""
+        except (OSError, serial.SerialException):
+            return False
+
+    def replyTimedOut(self, message):
+        self.metrics.increment("leash_serial_timeouts_total", code=message.split(" ", 1)[0].upper())
+
+        # if the ok was lost rather than late, this puts replies back in step
+        self.resync()
+
+    def submitCached(self, message):
+        # like submit, but drops words or the whole command when the machine
+        # is already in that state. an elided command gets a future that is
+        # already resolved with "ok"
+        message = self.state.reduce(message)
+
+        if message is None:
+            future = Future()
+            future.set_result("ok")
+            return future
+
+        return self.submit(message)
+
+    def streamCached(self, messages):
+        # messages are reduced one at a time as they go out, so each sees the
+        # state the ones before it left
+        for message in messages:
+            if self.submitCached(message) is False:
+                return False
+
+        return True
+
+    def sendCached(self, message, timeout=None):
+        # like send, returning "ok" without a round trip for a no-op command
+        reduced = self.state.reduce(message)
+
+        if reduced is None:
+            return "ok"
+
+        return self.send(reduced, timeout)
+
+    def sendBlind(self, message):
+        # the ok still gets routed to this command, it just isn't waited on
+        return self.submit(message) is not False
+
+    def send_rtn_lines(self, message):
+        # responds with every line marlin sent before its ok
+        return self.send(message)
@@ -0,0 +1,470 @@
+"""Simulated Lumen, an in-process Marlin emulator behind a pyserial-like transport
+
+Pass one to Lumen(transport=VirtualLumen()) to run, benchmark or load test
+the library without hardware.
+"""
+
+import random, re, threading, time, collections
+
+from .gcode import checksum
+from .kinematics import MotionModel, parse
+from .photon import Commands, Status, CRC_TABLE
+
+def _crc(data):
+    crc = 0
+    for byte in data:
+        crc = CRC_TABLE[crc ^ byte]
+    return crc
+
+def frame(sender, packetID, payload):
+    # builds a reply packet addressed to the host, crc at index 4
+    packet = bytearray((0x00, sender, packetID, len(payload))) + bytes(payload)
+    packet.insert(4, _crc(packet))
+    return packet
+
+class SimFeeder():
+
+    def __init__(self, uuid, version = 1, feedTime = 0.2):
+
+        self.uuid = list(uuid)
+        self.version = version
+
+        # seconds a feed of any length keeps the feeder busy
+        self.feedTime = feedTime
+
+        self.initialized = False
+        self._busyUntil = 0
+
+    def handle(self, command, payload):
+        # returns the reply payload for a packet addressed to this feeder
+
+        if command == Commands.GET_FEEDER_ID:
+            return [Status.OK] + self.uuid
+
+        if command == Commands.INITIALIZE_FEEDER:
+            if list(payload) != self.uuid:
+                return [Status.WRONG_FEEDER_ID] + self.uuid
+            self.initialized = True
+            return [Status.OK]
+
+        if command == Commands.GET_VERSION:
+            return [Status.OK, self.version]
+
+        if command in (Commands.MOVE_FEED_FORWARD, Commands.MOVE_FEED_BACKWARD):
+            if not self.initialized:
+                return [Status.UNINITIALIZED_FEEDER] + self.uuid
+            self._busyUntil = time.perf_counter() + self.feedTime
+            return [Status.OK]
+
+        if command == Commands.MOVE_FEED_STATUS:
+            if time.perf_counter() < self._busyUntil:
+                return [Status.FEEDING_IN_PROGRESS]
+            return [Status.OK]
+
+        return [Status.OK]
+
+class SimPressureSensor():
+
+    # registers follow the vacuum sensor Pump reads: 0x30 command, 0x06-0x08
+    # signed 24 bit pressure, 0x09-0x0A signed 16 bit temperature
+    def __init__(self, conversionTime = 0.002):
+
+        self.conversionTime = conversionTime
+
+        self.pressure = 0
+        self.temperature = 25.0
+
+        self.pointer = 0
+        self._doneAt = 0
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.pointer = data[0]
+
+        # writing 0x1B to 0x30 starts a combined conversion
+        if self.pointer == 0x30 and len(data) > 1 and data[1] & 0x08:
+            self._doneAt = time.perf_counter() + self.conversionTime
+
+    def read(self, count):
+        pressure = int(self.pressure) & 0xFFFFFF
+        temperature = int(self.temperature * 256) & 0xFFFF
+
+        registers = {
+            0x06: pressure >> 16,
+            0x07: (pressure >> 8) & 0xFF,
+            0x08: pressure & 0xFF,
+            0x09: temperature >> 8,
+            0x0A: temperature & 0xFF,
+            0x30: 0x08 if time.perf_counter() < self._doneAt else 0x00
+        }
+
+        data = [registers.get(self.pointer + i, 0) for i in range(count)]
+        self.pointer = self.pointer + count
+        return data
+
+class VirtualLumen():
+
+    # latency is the one way usb transit time in seconds, commandTime what
+    # marlin spends on each command. rs485Timeout is paid for a packet nobody
+    # answers. timeScale stretches simulated motion, 0 makes moves instant.
+    # dropRate and corruptRate are the chance a feeder reply is lost or has a
+    # bad crc. keepalive is how often a busy notice goes out while a command
+    # holds marlin, like HOST_KEEPALIVE_FEATURE. lineErrorRate is the chance a
+    # numbered line arrives with a bad checksum
+    def __init__(self, feeders = None, latency = 0.0005, commandTime = 0.0001, rs485Timeout = 0.05,
+                 timeScale = 0.0, bufsize = 4, plannerSize = 16, advancedOK = False,
+                 dropRate = 0.0, corruptRate = 0.0, keepalive = 2.0, lineErrorRate = 0.0, seed = None, port = "sim://lumen"):
+
+        self.port = port
+        self.baudrate = 115200
+        self.timeout = 1
+        self.is_open = False
+
+        # address -> SimFeeder
+        self.feeders = dict(feeders or {})
+
+        # mux channel -> sensor
+        self.sensors = {1: SimPressureSensor(), 2: SimPressureSensor()}
+
+        self.latency = latency
+        self.commandTime = commandTime
+        self.rs485Timeout = rs485Timeout
+        self.timeScale = timeScale
+        self.bufsize = bufsize
+        self.plannerSize = plannerSize
+        self.advancedOK = advancedOK
+        self.dropRate = dropRate
+        self.corruptRate = corruptRate
+        self.keepalive = keepalive
+        self.lineErrorRate = lineErrorRate
+
+        self.motion = MotionModel()
+        self.fans = {}
+        self.lights = {}
+        self.received = []
+
+        self._random = random.Random(seed)
+
+        self._mux = 0
+        self._lastLine = 0
+        self._i2cAddress = None
+        self._i2cBuffer = []
+
+        # end times of moves still in the planner
+        self._planner = collections.deque()
+
+        self._input = collections.deque()
+        self._output = collections.deque()
+        self._inputReady = threading.Condition()
+        self._outputReady = threading.Condition()
+
+        self._worker = None
+
+#####################
+# Transport
+#####################
+
+    def open(self):
+        self.is_open = True
+
+        self._worker = threading.Thread(target=self._run, name="leash-sim", daemon=True)
+        self._worker.start()
+
+    def close(self):
+        self.is_open = False
+
+        with self._inputReady:
+            self._inputReady.notify_all()
+
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def write(self, data):
+        arrival = time.perf_counter() + self.latency
+
+        with self._inputReady:
+            for line in data.decode('utf-8').splitlines():
+                self._input.append((arrival, line))
+            self._inputReady.notify_all()
+
+        return len(data)
+
+    def readline(self):
+        deadline = time.perf_counter() + (self.timeout if self.timeout is not None else 1e9)
+
+        with self._outputReady:
+            while True:
+                now = time.perf_counter()
+
+                if self._output and self._output[0][0] <= now:
+                    return self._output.popleft()[1]
+
+                if now >= deadline:
+                    return b""
+
+                wait = deadline - now
+                if self._output:
+                    wait = min(wait, self._output[0][0] - now)
+
+                self._outputReady.wait(wait)
+
+    def read_all(self):
+        with self._outputReady:
+            now = time.perf_counter()
+            data = b""
+            while self._output and self._output[0][0] <= now:
+                data = data + self._output.popleft()[1]
+            return data
+
+    def reset_input_buffer(self):
+        self.read_all()
+
+    @property
+    def in_waiting(self):
+        with self._outputReady:
+            return sum(len(line) for _, line in self._output)
+
+#####################
+# Emulator
+#####################
+
+    def _run(self):
+        while self.is_open:
+            with self._inputReady:
+                while self.is_open and not self._input:
+                    self._inputReady.wait(0.1)
+
+                if not self.is_open:
+                    return
+
+                arrival, line = self._input.popleft()
+
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.commandTime:
+                time.sleep(self.commandTime)
+
+            for reply in self.handle(line):
+                self._reply(reply)
+
+    def _reply(self, line):
+        with self._outputReady:
+            self._output.append((time.perf_counter() + self.latency, (line + "\n").encode('utf-8')))
+            self._outputReady.notify_all()
+
+    def _ok(self):
+        if self.advancedOK:
+            with self._inputReady:
+                waiting = len(self._input)
+            return "ok N0 P" + str(self.plannerSize - len(self._planner)) + " B" + str(max(0, self.bufsize - waiting - 1))
+
+        return "ok"
+
+    def _waitPlanner(self, room):
+        # blocks like marlin does until the planner has room moves free
+        while True:
+            now = time.perf_counter()
+            while self._planner and self._planner[0] <= now:
+                self._planner.popleft()
+
+            if len(self._planner) <= self.plannerSize - room:
+                return
+
+            self._hold(self._planner[0] - now)
+
+    def _hold(self, seconds):
+        # waits out seconds of machine time, sending busy notices on the way
+        end = time.perf_counter() + seconds
+
+        while True:
+            left = end - time.perf_counter()
+            if left <= 0:
+                return
+
+            if left > self.keepalive:
+                time.sleep(self.keepalive)
+                self._reply("echo:busy: processing")
+            else:
+                time.sleep(left)
+
+    def handle(self, line):
+        # runs one command and returns the lines marlin would send back
+        self.received.append(line)
+
+        if line.startswith("N"):
+            reMatch = re.match(r"^N(\d+) (.*)\*(\d+)$", line.strip())
+
+            if reMatch is None or checksum(line.strip().rsplit("*", 1)[0]) != int(reMatch.group(3)) or self._random.random() < self.lineErrorRate:
+                return self._resend("checksum mismatch")
+
+            if int(reMatch.group(1)) != self._lastLine + 1:
+                return self._resend("Line Number is not Last Line Number+1")
+
+            self._lastLine = int(reMatch.group(1))
+            line = reMatch.group(2)
+
+        line = line.split(";")[0].strip()
+        code, words = parse(line)
+
+        if code is None:
+            return []
+
+        if code in ("G0", "G1"):
+            duration = self.motion.apply(line) * self.timeScale
+            self._waitPlanner(1)
+
+            start = self._planner[-1] if self._planner else time.perf_counter()
+            self._planner.append(max(start, time.perf_counter()) + duration)
+
+            return [self._ok()]
+
+        if code in ("M400", "G4", "G28"):
+            self._waitPlanner(self.plannerSize)
+
+            if code == "G4":
+                self._hold(self.motion.apply(line) * self.timeScale)
+            elif code == "G28":
+                self.motion.apply(line)
+
+            return [self._ok()]
+
+        if code == "M110":
+            self._lastLine = int(words.get("n") or 0)
+            return [self._ok()]
+
+        if code == "M118":
+            text = re.sub(r"^M118\s*", "", line)
+            echo = False
+
+            while True:
+                reMatch = re.match(r"^(E1|A1|P\d)\s*", text)
+                if reMatch is None:
+                    break
+                echo = echo or reMatch.group(1) == "E1"
+                text = text[reMatch.end():]
+
+            return [("echo:" if echo else "") + text, self._ok()]
+
+        if code == "M260":
+            return self._i2cWrite(words)
+
+        if code == "M261":
+            return self._i2cRead(words)
+
+        if code == "M485":
+            return self._rs485(line[4:].strip())
+
+        if code == "M106":
+            self.fans[int(words.get("p") or 0)] = int(words["s"]) if words.get("s") is not None else 255
+            return [self._ok()]
+
+        if code == "M107":
+            self.fans[int(words.get("p") or 0)] = 0
+            return [self._ok()]
+
+        if code == "M150":
+            self.lights[int(words.get("s") or 0)] = tuple(int(words.get(i) or 0) for i in ("r", "u", "b", "p"))
+            return [self._ok()]
+
+        if code == "M115":
+            return ["FIRMWARE_NAME:Marlin (leash simulator) SOURCE_CODE_URL:github.com/opulo-inc/leash", "Cap:ADVANCED_OK:" + str(int(self.advancedOK)), self._ok()]
+
+        if code in ("G90", "G91", "G92", "M204"):
+            self.motion.apply(line)
+            return [self._ok()]
+
+        if re.match(r"^[GMT]\d+$", code):
+            return [self._ok()]
+
+        return ["echo:Unknown command: \"" + line + "\"", self._ok()]
+
+    def _resend(self, error):
+        return ["Error:" + error + ", Last Line: " + str(self._lastLine), "Resend: " + str(self._lastLine + 1), "ok"]
+
+    def _i2cWrite(self, words):
+        if words.get("a") is not None:
+            self._i2cAddress = int(words["a"])
+            self._i2cBuffer = []
+
+        if words.get("b") is not None:
+            self._i2cBuffer.append(int(words["b"]))
+
+        if words.get("s"):
+            if self._i2cAddress == 112:
+                # the multiplexer takes a channel bitmask
+                self._mux = self._i2cBuffer[-1] if self._i2cBuffer else 0
+            elif self._i2cAddress == 109 and self._mux in self.sensors:
+                self.sensors[self._mux].write(self._i2cBuffer)
+
+            self._i2cBuffer = []
+
+        return [self._ok()]
+
+    def _i2cRead(self, words):
+        address = int(words.get("a") or 0)
+        count = int(words.get("b") or 1)
+
+        if address == 109 and self._mux in self.sensors:
+            data = self.sensors[self._mux].read(count)
+        else:
+            data = [0] * count
+
+        return ["i2c-reply: from:" + str(address) + " bytes:" + str(count) + " data:" + bytes(data).hex(), self._ok()]
+
+    def _rs485(self, packetString):
+        try:
+            packet = bytes.fromhex(packetString)
+        except ValueError:
+            return ["echo:Bad M485 packet", self._ok()]
+
+        if len(packet) < 6:
+            return ["echo:Bad M485 packet", self._ok()]
+
+        address, packetID, command, payload = packet[0], packet[2], packet[5], packet[6:]
+
+        if address == 0xFF:
+            replies = self._broadcast(command, payload, packetID)
+        elif address in self.feeders:
+            replies = [frame(address, packetID, self.feeders[address].handle(command, payload))]
+        else:
+            replies = []
+
+        if not replies or self._random.random() < self.dropRate:
+            time.sleep(self.rs485Timeout)
+            return ["rs485-reply: TIMEOUT", self._ok()]
+
+        # several feeders talking at once garble each other
+        if len(replies) > 1:
+            reply = bytearray(a ^ b for a, b in zip(replies[0], replies[1]))
+        else:
+            reply = replies[0]
+
+        if self._random.random() < self.corruptRate:
+            reply = bytearray(reply)
+            reply[4] = reply[4] ^ 0xFF
+
+        return ["rs485-reply: " + reply.hex(), self._ok()]
+
+    def _broadcast(self, command, payload, packetID):
+        replies = []
+
+        for address, feeder in self.feeders.items():
+            if command == Commands.UNINITIALIZED_FEEDERS_RESPOND and not feeder.initialized:
+                replies.append(frame(address, packetID, [Status.OK] + feeder.uuid))
+
+            elif command == Commands.GET_FEEDER_ADDRESS and list(payload) == feeder.uuid:
+                replies.append(frame(address, packetID, [Status.OK]))
+
+            elif command == Commands.IDENTIFY_FEEDER and list(payload) == feeder.uuid:
+                replies.append(frame(address, packetID, [Status.OK]))
+
+        return replies
+
+def feederBank(addresses, **kwargs):
+    # builds a {address: SimFeeder} table with a made up uuid for each
+    return {address: SimFeeder([0x4c, 0x55] + [address] * 10, **kwargs) for address in addresses}
@@ -0,0 +1,178 @@
+"""Cache of the Lumen's machine state, for dropping commands that change nothing
+"""
+
+from .gcode import AXES
+from .kinematics import MotionModel, parse
+
+# commands the motion model follows
+MOTION = ("G0", "G1", "G4", "G28", "G90", "G91", "G92", "M204")
+
+# commands that read or wait but leave the cached state alone
+PASSIVE = ("M400", "M118", "M261", "M485", "M105", "M110", "M114", "M115", "M119")
+
+# i2c address of the multiplexer in front of the vacuum sensors
+MUX_ADDRESS = 112
+
+def _same(a, b):
+    return a is not None and b is not None and abs(a - b) < 1e-9
+
+class MachineState():
+
+    # the state marlin is in after every command sent so far, as far as it
+    # can be told from the commands. None means unknown, and unknown state is
+    # never elided. follows sends as a SerialManager observer, and is where
+    # Lumen.position comes from
+    def __init__(self):
+
+        # owns position, positioning mode, feedrate and acceleration, and
+        # times the moves it follows
+        self.motion = MotionModel()
+
+        self.invalidate()
+
+    @property
+    def position(self):
+        return self.motion.position
+
+    @property
+    def relative(self):
+        return self.motion.relative
+
+    @property
+    def feedrate(self):
+        return self.motion.feedrate
+
+    @property
+    def acceleration(self):
+        return self.motion.acceleration
+
+    def invalidate(self):
+        # forgets everything, e.g. after a reconnect or a command the cache
+        # can't follow
+        self.motion.forget()
+
+        # selected multiplexer channel bitmask
+        self.mux = None
+
+        # index -> (r, g, b, brightness)
+        self.lights = {}
+
+        # fan index -> pwm, fans drive the pumps and valves
+        self.fans = {}
+
+        self._i2cAddress = None
+        self._i2cBuffer = []
+
+#####################
+# Following
+#####################
+
+    def apply(self, command):
+        line = command.split(";")[0]
+        code, words = parse(line)
+
+        if code is None or code in PASSIVE:
+            return
+
+        if code in MOTION:
+            self.motion.track(line)
+
+        elif code == "M150":
+            self.lights[self._light(words)] = self._color(words)
+
+        elif code == "M106":
+            self.fans[self._fan(words)] = words["s"] if words.get("s") is not None else 255
+
+        elif code == "M107":
+            self.fans[self._fan(words)] = 0
+
+        elif code == "M260":
+            self._i2cWrite(words)
+
+        else:
+            # only G90 and G91 switch positioning mode, so that much survives.
+            # an unknown M code doesn't move the axes, so position does too
+            relative = self.relative
+            position = self.position
+            self.invalidate()
+            self.motion.relative = relative
+
+            if code.startswith("M"):
+                self.motion.position = position
+
+    def _i2cWrite(self, words):
+        # marlin buffers M260 bytes until S1 sends them to the last address
+        if words.get("a") is not None:
+            self._i2cAddress = words["a"]
+
+        if words.get("b") is not None:
+            self._i2cBuffer.append(words["b"])
+
+        if words.get("s"):
+            if self._i2cAddress == MUX_ADDRESS:
+                self.mux = self._i2cBuffer[-1] if self._i2cBuffer else None
+
+            self._i2cBuffer = []
+
+    def _light(self, words):
+        return words.get("s") or 0
+
+    def _color(self, words):
+        # marlin zeroes any color left out, and brightness defaults to full
+        brightness = words.get("p")
+        return (words.get("r") or 0, words.get("u") or 0, words.get("b") or 0, brightness if brightness is not None else 255)
+
+    def _fan(self, words):
+        return words.get("p") or 0
+
+#####################
+# Eliding
+#####################
+
+    def reduce(self, command):
+        # returns command with the words that wouldn't change anything taken
+        # out, or None if the whole command is a no-op
+        code, words = parse(command.split(";")[0])
+
+        if code in ("G0", "G1"):
+            if self.relative is not False:
+                return command
+
+            tokens = command.split()
+            kept = [tokens[0]]
+
+            for token in tokens[1:]:
+                key = token[0].lower()
+                value = words.get(key)
+
+                if key in AXES and _same(value, self.position[key]):
+                    continue
+                if key == "f" and _same(value, self.feedrate):
+                    continue
+
+                kept.append(token)
+
+            if len(kept) == 1:
+                return None
+
+            return " ".join(kept)
+
+        if code == "M204":
+            value = words.get("t") if words.get("t") is not None else words.get("s")
+            return None if _same(value, self.acceleration) else command
+
+        if code == "M150":
+            return None if self.lights.get(self._light(words)) == self._color(words) else command
+
+        if code == "M106":
+            speed = words["s"] if words.get("s") is not None else 255
+            return None if _same(self.fans.get(self._fan(words)), speed) else command
+
+        if code == "M107":
+            return None if _same(self.fans.get(self._fan(words)), 0) else command
+
+        if code == "M260" and words.get("a") == MUX_ADDRESS and words.get("s") and words.get("b") is not None and not self._i2cBuffer:
+            # a complete mux select, only needed when the channel changes
+            return None if _same(self.mux, words["b"]) else command
+
+        return command
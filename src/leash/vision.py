@@ -0,0 +1,380 @@
+"""Fiducial and part offset detection for Lumen cameras
+
+Finders keep their grayscale, resize, blur and mask buffers between calls, so
+after the first frame the per-frame path does no allocation beyond what the
+OpenCV detectors do internally. All results are sub-pixel positions in the
+coordinates of the full image passed in.
+"""
+
+import math
+
+import numpy as np
+
+from ._lazy import lazy
+
+# opencv takes a while to import, so it is only loaded once a camera or
+# finder actually uses it
+cv2 = lazy("cv2")
+
+class Finder():
+
+    # roi is (x, y, width, height) in full image pixels, or None for the
+    # whole frame. scale < 1 downsamples the roi before detection
+    def __init__(self, roi = None, scale = 1.0, blur = 5, threshold = None, invert = False, minContrast = 25, maxFill = 0.5):
+
+        self.roi = roi
+        self.scale = scale
+        self.blur = blur
+
+        # None uses otsu's method to pick a threshold per frame
+        self.threshold = threshold
+        self.invert = invert
+
+        # an empty or noise-only roi still thresholds into blobs, so a frame
+        # whose foreground and background means are closer than minContrast
+        # gray levels, or a blob filling more than maxFill of the roi, is
+        # reported as not found
+        self.minContrast = minContrast
+        self.maxFill = maxFill
+
+        self._gray = None
+        self._small = None
+        self._blurred = None
+        self._mask = None
+
+    def _buffer(self, name, shape):
+        buffer = getattr(self, name)
+
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            setattr(self, name, buffer)
+
+        return buffer
+
+    def _crop(self, image):
+        if self.roi is None:
+            return image, 0, 0
+
+        x, y, w, h = self.roi
+        return image[y:y+h, x:x+w], x, y
+
+    def prepare(self, image):
+        # returns the blurred grayscale roi, and the (x, y) offset of the roi
+        # so results can be mapped back with toImage()
+        crop, x, y = self._crop(image)
+        self._offset = (x, y)
+
+        if crop.ndim == 3:
+            gray = self._buffer("_gray", crop.shape[:2])
+            cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY, dst=gray)
+        else:
+            gray = crop
+
+        if self.scale != 1.0:
+            height = max(1, int(round(gray.shape[0] * self.scale)))
+            width = max(1, int(round(gray.shape[1] * self.scale)))
+            small = self._buffer("_small", (height, width))
+            cv2.resize(gray, (width, height), dst=small, interpolation=cv2.INTER_AREA)
+            gray = small
+
+        if self.blur:
+            blurred = self._buffer("_blurred", gray.shape)
+            # the kernel has to be odd
+            kernel = self.blur | 1
+            cv2.GaussianBlur(gray, (kernel, kernel), 0, dst=blurred)
+            gray = blurred
+
+        return gray
+
+    def binarize(self, gray):
+        mask = self._buffer("_mask", gray.shape)
+
+        mode = cv2.THRESH_BINARY_INV if self.invert else cv2.THRESH_BINARY
+
+        if self.threshold is None:
+            cv2.threshold(gray, 0, 255, mode | cv2.THRESH_OTSU, dst=mask)
+        else:
+            cv2.threshold(gray, self.threshold, 255, mode, dst=mask)
+
+        return mask
+
+    def contrast(self, gray, mask):
+        # difference between the mean gray level under the mask and outside
+        # it, 0 when either side is empty
+        count = cv2.countNonZero(mask)
+
+        if count == 0 or count == mask.size:
+            return 0.0
+
+        inside = cv2.mean(gray, mask)[0]
+        outside = (float(cv2.sumElems(gray)[0]) - inside * count) / (mask.size - count)
+
+        return abs(inside - outside)
+
+    def _touchesBorder(self, x, y, w, h, shape):
+        return x <= 0 or y <= 0 or x + w >= shape[1] or y + h >= shape[0]
+
+    def toImage(self, x, y):
+        # maps a point in the prepared buffer back to full image pixels. the
+        # +0.5/-0.5 keeps pixel centers aligned when downsampling
+        return (
+            (x + 0.5) / self.scale - 0.5 + self._offset[0],
+            (y + 0.5) / self.scale - 0.5 + self._offset[1]
+        )
+
+    def _center(self, shape):
+        return (shape[1] - 1) / 2.0, (shape[0] - 1) / 2.0
+
+class FiducialFinder(Finder):
+
+    # mode is one of:
+    #   "moments"  - centroid of the thresholded blob nearest the roi center
+    #   "hough"    - HoughCircles, refined with the blob's moments
+    #   "template" - normalized cross correlation against template, with a
+    #                parabolic fit around the peak
+    # radius is the expected fiducial radius in full image pixels. in
+    # moments mode, blobs less round than minCircularity are skipped: a
+    # blob's area over that of its smallest enclosing circle, about 1 for a
+    # circle and 0.64 for a square. blobs under 4 pixels in radius after
+    # scaling are too coarse to tell apart and aren't checked
+    def __init__(self, mode = "moments", radius = (5, 60), template = None, minCircularity = 0.75, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.mode = mode
+        self.radius = radius
+        self.template = template
+        self.minCircularity = minCircularity
+
+        self._templateGray = None
+
+    def find(self, image):
+        # returns the (x, y) center of the fiducial, or False if none was found
+        gray = self.prepare(image)
+
+        if self.mode not in ("moments", "hough", "template"):
+            raise ValueError("Unknown fiducial mode: " + str(self.mode))
+
+        mask = self.binarize(gray)
+
+        if self.contrast(gray, mask) < self.minContrast:
+            return False
+
+        if self.mode == "moments":
+            found = self._findMoments(gray, mask)
+        elif self.mode == "hough":
+            found = self._findHough(gray, mask)
+        else:
+            found = self._findTemplate(gray)
+
+        if found is False:
+            return False
+
+        return self.toImage(*found)
+
+    def _areaLimits(self):
+        low, high = self.radius
+        return math.pi * (low * self.scale) ** 2, math.pi * (high * self.scale) ** 2
+
+    def _findMoments(self, gray, mask):
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+        minArea, maxArea = self._areaLimits()
+        maxArea = min(maxArea, self.maxFill * mask.size)
+        cx, cy = self._center(gray.shape)
+
+        best = False
+        bestDistance = None
+
+        # label 0 is the background
+        for i in range(1, count):
+            area = stats[i, cv2.CC_STAT_AREA]
+            if area < minArea or area > maxArea:
+                continue
+
+            left, top, w, h = stats[i, :4]
+
+            # a blob cut off by the roi edge has a biased centroid
+            if self._touchesBorder(left, top, w, h, mask.shape):
+                continue
+
+            if area >= math.pi * 16 and self._circularity(labels[top:top+h, left:left+w] == i, area) < self.minCircularity:
+                continue
+
+            x, y = centroids[i]
+            distance = (x - cx) ** 2 + (y - cy) ** 2
+
+            if bestDistance is None or distance < bestDistance:
+                best = (float(x), float(y))
+                bestDistance = distance
+
+        return best
+
+    def _circularity(self, blob, area):
+        contours, _ = cv2.findContours(blob.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+        if not contours:
+            return 0.0
+
+        # the contour runs through pixel centers, so the circle is grown by
+        # half a pixel to enclose the pixels themselves
+        (_, _), radius = cv2.minEnclosingCircle(max(contours, key=len))
+
+        return area / (math.pi * (radius + 0.5) ** 2)
+
+    def _findHough(self, gray, mask):
+        low, high = self.radius
+        low = max(1, int(low * self.scale))
+        high = max(low + 1, int(high * self.scale))
+
+        circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, 1.2, high * 2, param1=100, param2=30, minRadius=low, maxRadius=high)
+
+        if circles is None:
+            return False
+
+        cx, cy = self._center(gray.shape)
+        x, y, r = min(circles[0], key=lambda c: (c[0] - cx) ** 2 + (c[1] - cy) ** 2)
+
+        # refine the circle's center with the moments of the blob inside it
+        x0 = max(0, int(x - r - 2))
+        y0 = max(0, int(y - r - 2))
+        x1 = min(gray.shape[1], int(x + r + 3))
+        y1 = min(gray.shape[0], int(y + r + 3))
+
+        m = cv2.moments(mask[y0:y1, x0:x1], binaryImage=True)
+
+        if m["m00"] == 0:
+            return float(x), float(y)
+
+        return x0 + m["m10"] / m["m00"], y0 + m["m01"] / m["m00"]
+
+    def _findTemplate(self, gray):
+        if self.template is None:
+            raise ValueError("Template mode needs a template image")
+
+        template = self._prepareTemplate()
+
+        if template.shape[0] > gray.shape[0] or template.shape[1] > gray.shape[1]:
+            return False
+
+        scores = cv2.matchTemplate(gray, template, cv2.TM_CCOEFF_NORMED)
+        _, peak, _, (px, py) = cv2.minMaxLoc(scores)
+
+        if peak < 0.5:
+            return False
+
+        dx = _parabolicPeak(scores, px, py, 1, 0)
+        dy = _parabolicPeak(scores, px, py, 0, 1)
+
+        # the resized template's size is rounded, so its center is taken from
+        # the source template's, mapped the same way toImage() maps back
+        height, width = self.template.shape[:2]
+
+        return (
+            px + dx + width * self.scale / 2.0 - 0.5,
+            py + dy + height * self.scale / 2.0 - 0.5
+        )
+
+    def _prepareTemplate(self):
+        # the template goes through the same grayscale, scale and blur steps
+        # as the frames, once
+        if self._templateGray is None:
+            template = self.template
+
+            if template.ndim == 3:
+                template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+
+            if self.scale != 1.0:
+                template = cv2.resize(template, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+            if self.blur:
+                kernel = self.blur | 1
+                template = cv2.GaussianBlur(template, (kernel, kernel), 0)
+
+            self._templateGray = template
+
+        return self._templateGray
+
+class PartFinder(Finder):
+
+    # finds the largest blob in the roi, e.g. a part silhouetted on the
+    # bottom camera. minArea is in full image pixels
+    def __init__(self, minArea = 100, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self.minArea = minArea
+
+    def find(self, image):
+        # returns (x, y, angle) for the part's center in full image pixels and
+        # its rotation in degrees, or False if no part was found
+        gray = self.prepare(image)
+        mask = self.binarize(gray)
+
+        if self.contrast(gray, mask) < self.minContrast:
+            return False
+
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        if not contours:
+            return False
+
+        contour = max(contours, key=cv2.contourArea)
+        area = cv2.contourArea(contour)
+
+        if area < self.minArea * self.scale ** 2 or area > self.maxFill * mask.size:
+            return False
+
+        # a part cut off by the roi edge would be reported off center
+        if self._touchesBorder(*cv2.boundingRect(contour), mask.shape):
+            return False
+
+        m = cv2.moments(contour)
+
+        if m["m00"] == 0:
+            return False
+
+        (_, _), (width, height), angle = cv2.minAreaRect(contour)
+
+        # report the angle of the long side, in (-45, 45]
+        if width < height:
+            angle = angle - 90
+        while angle > 45:
+            angle = angle - 90
+        while angle <= -45:
+            angle = angle + 90
+
+        x, y = self.toImage(m["m10"] / m["m00"], m["m01"] / m["m00"])
+
+        return x, y, angle
+
+    def offset(self, image):
+        # returns (dx, dy, angle) of the part relative to the center of the
+        # full image, or False
+        found = self.find(image)
+
+        if found is False:
+            return False
+
+        x, y, angle = found
+        cx, cy = self._center(image.shape)
+
+        return x - cx, y - cy, angle
+
+def _parabolicPeak(scores, x, y, stepX, stepY):
+    # sub-pixel offset of a correlation peak along one axis
+    if not (0 < x < scores.shape[1] - 1) and stepX:
+        return 0.0
+    if not (0 < y < scores.shape[0] - 1) and stepY:
+        return 0.0
+
+    before = scores[y - stepY, x - stepX]
+    center = scores[y, x]
+    after = scores[y + stepY, x + stepX]
+
+    denominator = before - 2 * center + after
+
+    if denominator == 0:
+        return 0.0
+
+    return float(0.5 * (before - after) / denominator)
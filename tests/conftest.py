@@ -0,0 +1,43 @@
+import pytest
+
+from leash import Lumen, VirtualLumen
+from leash import cache, calibration, registry
+
+@pytest.fixture(autouse=True)
+def cacheDir(tmp_path, monkeypatch):
+    # keeps the port, camera and feeder caches out of the real ~/.leash
+    for module in (cache, calibration, registry):
+        monkeypatch.setattr(module, "CACHE_DIR", str(tmp_path))
+
+    return tmp_path
+
+@pytest.fixture
+def connect():
+    # connect(**settings) returns a connected Lumen on a fresh VirtualLumen
+    # built with settings, or on sim if one is given. all of them are
+    # disconnected after the test
+    lumens = []
+
+    def connect(sim = None, **settings):
+        if sim is None:
+            sim = VirtualLumen(**settings)
+
+        lumen = Lumen(debug=False, transport=sim)
+        lumens.append(lumen)
+
+        assert lumen.connect()
+        return lumen
+
+    yield connect
+
+    for lumen in lumens:
+        lumen.disconnect()
+
+@pytest.fixture
+def lumen(connect):
+    return connect()
+
+def sent(lumen, prefix):
+    # lines the simulator has run that start with prefix, once every ok is in
+    assert lumen.sm.drain()
+    return [line for line in lumen.sm._ser.received if line.startswith(prefix)]
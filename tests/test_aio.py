@@ -0,0 +1,44 @@
+import asyncio
+
+from leash import AsyncLumen
+from leash.sim import feederBank
+
+async def ticking(work):
+    # runs work while counting how often the event loop gets a turn
+    ticks = 0
+    done = asyncio.ensure_future(work)
+
+    while not done.done():
+        ticks = ticks + 1
+        await asyncio.sleep(0.01)
+
+    return done.result(), ticks
+
+def test_starting_a_feed_on_a_full_buffer_doesnt_block_the_loop(connect):
+    lumen = connect(feeders = feederBank([1]), timeScale = 1.0)
+
+    assert set(lumen.photon.scan(1, 2)) == {1}
+
+    # the M400 holds marlin's one slot until the move is done
+    lumen.sm.bufsize = 1
+    lumen.goto(x=300)
+    lumen.sm.submit("M400")
+    assert lumen.sm.full()
+
+    async def start():
+        return await ticking(AsyncLumen(lumen).photon.start_feed_forward(1, 40))
+
+    accepted, ticks = asyncio.run(start())
+
+    assert accepted
+    assert ticks > 5
+
+def test_disconnect_stops_the_monitor_and_closes(lumen):
+    monitor = lumen.leftPump.startMonitor(interval = 0.05)
+
+    async def disconnect():
+        return await AsyncLumen(lumen).disconnect()
+
+    assert asyncio.run(disconnect())
+    assert monitor._thread is None
+    assert not lumen.sm._ser.is_open
@@ -0,0 +1,82 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from leash import CameraCalibration
+
+SIZE = (640, 480)
+FIDUCIAL = (150.0, 80.0)
+OFFSET = np.array([-30.0, 12.0])
+
+# 0.02 mm per pixel, with the camera turned 3 degrees and its y axis flipped
+ANGLE = math.radians(3)
+M = 0.02 * np.array([[math.cos(ANGLE), math.sin(ANGLE)], [math.sin(ANGLE), -math.cos(ANGLE)]])
+
+def seen(head):
+    # where the fiducial shows up with the head at head
+    center = np.array([(SIZE[0] - 1) / 2.0, (SIZE[1] - 1) / 2.0])
+    return tuple(center + np.linalg.solve(M, np.array(FIDUCIAL) - OFFSET - np.array(head)))
+
+def fitted():
+    heads = [(180 + dx, 68 + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    calibration = CameraCalibration()
+    error = calibration.fitScale(heads, [seen(head) for head in heads], SIZE, fiducial = FIDUCIAL)
+
+    return calibration, error
+
+def test_fit_scale_recovers_the_mapping():
+    calibration, error = fitted()
+
+    assert error == pytest.approx(0, abs=1e-9)
+    assert calibration.pixelToMM == pytest.approx(M)
+    assert calibration.offset == pytest.approx(OFFSET)
+    assert calibration.mmPerPixel == pytest.approx(0.02)
+
+def test_to_machine_finds_the_fiducial():
+    calibration, _ = fitted()
+
+    head = (175.5, 70.25)
+    assert calibration.toMachine(seen(head), head) == pytest.approx(FIDUCIAL)
+
+    # heading to where the fiducial is centered brings it to the middle
+    target = calibration.headPositionFor(seen(head), head)
+    assert seen(target) == pytest.approx(((SIZE[0] - 1) / 2.0, (SIZE[1] - 1) / 2.0))
+
+def test_too_few_samples():
+    assert CameraCalibration().fitScale([(0, 0), (1, 1)], [(0, 0), (1, 1)], SIZE) is False
+
+def test_offset_is_needed_for_machine_positions():
+    calibration = CameraCalibration()
+    calibration.fitScale([(0, 0), (1, 0), (0, 1)], [(0, 0), (50, 0), (0, 50)], SIZE)
+
+    with pytest.raises(ValueError):
+        calibration.toMachine((0, 0), (0, 0))
+
+def test_save_and_load(tmp_path):
+    calibration, _ = fitted()
+
+    calibration.cameraMatrix = np.array([[500.0, 0, 319.5], [0, 500.0, 239.5], [0, 0, 1]])
+    calibration.distCoeffs = np.array([-0.1, 0.01, 0, 0, 0])
+    calibration.buildMaps()
+
+    path = str(tmp_path / "camera-top.npz")
+    calibration.save(path)
+
+    loaded = CameraCalibration.load(path)
+
+    assert loaded.imageSize == SIZE
+    assert loaded.pixelToMM == pytest.approx(calibration.pixelToMM)
+    assert loaded.offset == pytest.approx(calibration.offset)
+    assert loaded.cameraMatrix == pytest.approx(calibration.cameraMatrix)
+
+    image = np.random.default_rng(1).integers(0, 256, (SIZE[1], SIZE[0], 3), dtype=np.uint8)
+
+    # the cached tables come back, so both undistort the same way
+    assert np.array_equal(loaded.undistort(image), calibration.undistort(image))
+
+def test_default_path_is_in_the_cache(cacheDir):
+    assert CameraCalibration.defaultPath("top") == str(cacheDir / "camera-top.npz")
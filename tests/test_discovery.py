@@ -0,0 +1,40 @@
+from leash import FeederRegistry
+from leash.photon import Feeder
+from leash.sim import feederBank
+
+from conftest import sent
+
+def unicastTimeouts(lumen):
+    return [i for i in range(1, 0xFF) if lumen.metrics.counter("leash_photon_timeouts_total", address=i)]
+
+def test_cold_feeder_is_found_by_broadcast(connect):
+    lumen = connect(feeders = feederBank([40]))
+
+    assert set(lumen.photon.discover()) == {40}
+
+    # its reply and the one broadcast nobody answers, no unicast probes
+    assert len(sent(lumen, "M485 ff")) == 2
+    assert not unicastTimeouts(lumen)
+
+def test_registry_feeders_are_found_by_uuid(connect):
+    feeders = feederBank([3, 40])
+
+    # initialized by an earlier session, so they won't answer the broadcast
+    registry = FeederRegistry()
+    for address, feeder in feeders.items():
+        feeder.initialized = True
+        registry.update({address: Feeder(feeder.uuid, address, 1)})
+    registry.save()
+
+    lumen = connect(feeders = feeders)
+    lumen.photon.registry = FeederRegistry()
+
+    assert set(lumen.photon.discover()) == {3, 40}
+    assert not unicastTimeouts(lumen)
+
+def test_collisions_fall_back_to_a_scan(connect):
+    # cold feeders all answer the broadcast at once
+    lumen = connect(feeders = feederBank([3, 5]))
+
+    assert set(lumen.photon.discover(1, 8)) == {3, 5}
+    assert unicastTimeouts(lumen) == [1, 2, 4, 6, 7]
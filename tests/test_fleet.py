@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from leash import Fleet, Lumen, VirtualLumen
+
+@pytest.fixture
+def fleet():
+    fleet = Fleet()
+
+    for name in ("A", "B"):
+        fleet.add(name, Lumen(debug=False, transport=VirtualLumen(port="sim://" + name)))
+
+    assert fleet.connect() == {"A": True, "B": True}
+
+    yield fleet
+
+    fleet.disconnect()
+
+def test_jobs_run_in_order_on_their_machine(fleet):
+    ran = []
+
+    futures = [fleet.submit("A", lambda lumen, i=i: ran.append((lumen, i)) or i) for i in range(10)]
+
+    assert [future.result(5) for future in futures] == list(range(10))
+    assert ran == [(fleet["A"], i) for i in range(10)]
+
+def test_machines_run_jobs_at_the_same_time(fleet):
+    # each job waits for the other machine's, so they only finish together
+    barrier = threading.Barrier(2, timeout=5)
+
+    futures = fleet.submitAll(lambda lumen: barrier.wait() is not None)
+
+    assert {name: future.result(5) for name, future in futures.items()} == {"A": True, "B": True}
+
+def test_submit_any_picks_the_least_busy_machine(fleet):
+    release = threading.Event()
+
+    busy = fleet.submit("A", lambda lumen: release.wait(5))
+    assert fleet.submitAny(lambda lumen: lumen).result(5) is fleet["B"]
+
+    release.set()
+    assert busy.result(5)
+
+def test_failed_job_doesnt_stop_the_queue(fleet):
+    def fail(lumen):
+        raise RuntimeError("no vacuum")
+
+    failed = fleet.submit("A", fail)
+    after = fleet.submit("A", lambda lumen: "ran")
+
+    with pytest.raises(RuntimeError):
+        failed.result(5)
+
+    assert after.result(5) == "ran"
+
+def test_machines_are_labelled_and_keep_their_own_feeders(fleet, cacheDir):
+    assert fleet["A"].metrics.labels["machine"] == "A"
+
+    assert fleet["A"].photon.registry.path == str(cacheDir / "feeders-A.json")
+    assert fleet["B"].photon.registry.path == str(cacheDir / "feeders-B.json")
+
+def test_jobs_drive_the_machine(fleet):
+    assert fleet.submit("B", lambda lumen: lumen.sm.send("M118 E1 hello")).result(5).splitlines() == ["echo:hello", "ok"]
@@ -0,0 +1,34 @@
+import pytest
+
+from leash import gcode
+
+@pytest.mark.parametrize("value, text", [
+    (10, "10"),
+    (10.0, "10"),
+    (0.1 + 0.2, "0.3"),
+    (-0.0001, "0"),
+    (12.3456, "12.346"),
+    (-5.5, "-5.5"),
+    ("10", "10"),
+    ("2.50", "2.5"),
+])
+def test_number(value, text):
+    assert gcode.number(value) == text
+
+def test_number_rejects_non_numbers():
+    with pytest.raises(ValueError, match="Not a number"):
+        gcode.number("ten")
+
+    with pytest.raises(ValueError, match="Not a number"):
+        gcode.number(None)
+
+def test_move():
+    assert gcode.move(x=10.0, z="1.5") == "G0 X10 Z1.5"
+    assert gcode.move() == "G0"
+
+def test_numbered():
+    line = gcode.numbered("G0 X10", 7)
+
+    framed, check = line.rsplit("*", 1)
+    assert framed == "N7 G0 X10"
+    assert int(check) == gcode.checksum(framed)
@@ -0,0 +1,51 @@
+import math
+
+import pytest
+
+from leash import MotionModel
+
+def model():
+    # 100 mm/s and 1000 mm/s^2, so full speed takes 5 mm to reach
+    return MotionModel(feedrate = 6000, acceleration = 1000)
+
+def test_long_move_is_a_trapezoid():
+    assert model().estimate(["G0 X100"]) == pytest.approx(100 / 100.0 + 100 / 1000.0)
+
+def test_short_move_is_a_triangle():
+    assert model().estimate(["G0 X4"]) == pytest.approx(2 * math.sqrt(4 / 1000.0))
+
+def test_estimate_leaves_the_model_alone():
+    motion = model()
+    motion.estimate(["G0 X100 F3000", "M204 T100"])
+
+    assert motion.position["x"] == 0
+    assert motion.feedrate == 6000
+    assert motion.acceleration == 1000
+
+def test_dicts_and_start():
+    motion = model()
+
+    assert motion.estimate([{"x": 100, "y": None}]) == motion.estimate(["G0 X100"])
+
+    # already at x 100, only the y leg is left
+    assert motion.estimate([{"x": 100, "y": 100}], start = {"x": 100, "y": 0, "z": None}) == pytest.approx(1.1)
+
+def test_feedrate_and_acceleration_words():
+    motion = model()
+
+    assert motion.estimate(["G0 X100 F3000"]) == pytest.approx(100 / 50.0 + 50 / 1000.0)
+    assert motion.estimate(["M204 T2000", "G0 X100"]) == pytest.approx(100 / 100.0 + 100 / 2000.0)
+
+def test_relative_moves_and_dwells():
+    assert model().estimate(["G91", "G0 X50", "G0 X50", "G4 P500"]) == pytest.approx(2 * (0.5 + 0.1) + 0.5)
+
+def test_axis_limits_slow_the_move():
+    motion = MotionModel(feedrate = 6000, acceleration = 1000, maxFeedrate = {"z": 10})
+
+    assert motion.estimate(["G0 Z100"]) == pytest.approx(100 / 10.0 + 10 / 1000.0)
+
+def test_rotation_only_counts_alone():
+    motion = model()
+
+    assert motion.estimate(["G0 A100"]) == pytest.approx(1.1)
+    assert motion.estimate(["G0 X100 A100"]) == pytest.approx(1.1)
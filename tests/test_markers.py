@@ -0,0 +1,75 @@
+import asyncio, time
+
+from leash import AsyncLumen, VirtualLumen
+
+def test_finish_moves_waits_for_the_move(connect):
+    lumen = connect(timeScale=1.0)
+
+    lumen.goto(x=300, y=300)
+    expected = lumen.motion.remaining()
+
+    start = time.perf_counter()
+    assert lumen.finishMoves()
+
+    assert time.perf_counter() - start >= expected * 0.8
+    assert lumen.motion.remaining() == 0
+
+def test_busy_notices_extend_the_wait(connect):
+    lumen = connect(timeScale=2.0, keepalive=0.05)
+
+    lumen.goto(x=400, y=400)
+
+    # far shorter than the move, but marlin keeps saying it's busy
+    assert lumen.finishMoves(timeout=0.3)
+    assert lumen.metrics.counter("leash_serial_timeouts_total", code="M118") == 0
+
+def test_silent_marlin_times_out(connect):
+    lumen = connect(timeScale=2.0, keepalive=30)
+
+    lumen.goto(x=400, y=400)
+
+    assert not lumen.finishMoves(timeout=0.1)
+    assert lumen.metrics.counter("leash_serial_timeouts_total", code="M118") == 1
+
+def test_markers_finish_in_order(connect):
+    lumen = connect(timeScale=1.0)
+
+    lumen.goto(x=100)
+    first = lumen.sm.mark()
+    lumen.goto(x=200)
+    second = lumen.sm.mark()
+
+    assert lumen.sm.waitMarker(second)
+
+    # echoed before the second one, so its wait returns straight away
+    assert lumen.sm.markerFuture(first) is None
+    assert lumen.sm.waitMarker(first)
+
+class SlowHomingLumen(VirtualLumen):
+
+    # homing holds marlin for homingTime seconds, longer than the port timeout
+    def __init__(self, homingTime = 1.5, **settings):
+
+        super().__init__(**settings)
+
+        self.homingTime = homingTime
+
+    def handle(self, line):
+        if line.startswith("G28"):
+            self._hold(self.homingTime)
+
+        return super().handle(line)
+
+def test_homing_waits_on_the_marker(connect):
+    lumen = connect(sim=SlowHomingLumen())
+
+    assert lumen.home()
+    assert lumen.metrics.counter("leash_serial_timeouts_total", code="G28") == 0
+    assert not [line for line in lumen.sm._ser.received if "leash-sync" in line]
+
+def test_async_homing_waits_on_the_marker(connect):
+    lumen = connect(sim=SlowHomingLumen())
+
+    assert asyncio.run(AsyncLumen(lumen).home())
+    assert lumen.metrics.counter("leash_serial_timeouts_total", code="G28") == 0
+    assert not [line for line in lumen.sm._ser.received if "leash-sync" in line]
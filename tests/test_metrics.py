@@ -0,0 +1,71 @@
+import urllib.request
+
+from leash import Metrics
+from leash.photon import Status
+from leash.sim import feederBank
+
+def test_exposition():
+    metrics = Metrics(labels = {"machine": "A1"})
+    metrics.describe("leash_test_seconds", "histogram", "Test latencies")
+    metrics.describe("leash_test_total", "counter", "Test events")
+
+    metrics.observe("leash_test_seconds", 0.003, code="G0")
+    metrics.observe("leash_test_seconds", 0.3, code="G0")
+    metrics.increment("leash_test_total", code='M"1')
+
+    lines = metrics.exposition().splitlines()
+
+    assert "# HELP leash_test_seconds Test latencies" in lines
+    assert "# TYPE leash_test_seconds histogram" in lines
+    assert 'leash_test_seconds_bucket{machine="A1",code="G0",le="0.002"} 0' in lines
+    assert 'leash_test_seconds_bucket{machine="A1",code="G0",le="0.005"} 1' in lines
+    assert 'leash_test_seconds_bucket{machine="A1",code="G0",le="+Inf"} 2' in lines
+    assert 'leash_test_seconds_count{machine="A1",code="G0"} 2' in lines
+    assert 'leash_test_seconds_sum{machine="A1",code="G0"} 0.303' in lines
+
+    assert "# TYPE leash_test_total counter" in lines
+    assert 'leash_test_total{machine="A1",code="M\\"1"} 1' in lines
+
+def test_snapshot_and_reset():
+    metrics = Metrics()
+
+    metrics.observe("leash_test_seconds", 0.01)
+    metrics.increment("leash_test_total", 3)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["histograms"]["leash_test_seconds"][""]["count"] == 1
+    assert snapshot["counters"]["leash_test_total"][""] == 3
+
+    metrics.reset()
+    assert metrics.counter("leash_test_total") == 0
+    assert metrics.histogram("leash_test_seconds") is None
+
+def test_serve():
+    metrics = Metrics()
+    metrics.increment("leash_test_total")
+
+    server = metrics.serve(port = 0)
+
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:" + str(server.server_address[1]) + "/metrics") as response:
+            assert response.read().decode("utf-8") == metrics.exposition()
+    finally:
+        metrics.stopServing()
+
+def test_queue_time_is_kept_apart(connect):
+    lumen = connect(feeders = feederBank([1]), timeScale = 1.0)
+
+    assert set(lumen.photon.scan(1, 2)) == {1}
+    lumen.metrics.reset()
+
+    lumen.goto(x=300)
+    lumen.sm.submit("M400")
+
+    # waits behind the move, which only the queue histogram shows
+    assert lumen.photon.getFeedStatus(1) == Status.OK
+
+    queued = lumen.metrics.histogram("leash_serial_queue_seconds", code="M485")
+    assert queued.sum > 0.2
+
+    assert lumen.metrics.histogram("leash_serial_round_trip_seconds", code="M485").sum < 0.1
+    assert lumen.metrics.histogram("leash_photon_round_trip_seconds", address=1).sum < 0.1
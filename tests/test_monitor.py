@@ -0,0 +1,68 @@
+import threading
+
+from leash import PressureMonitor
+
+def events(monitor):
+    fired = []
+
+    for event in ("picked", "dropped", "clogged"):
+        monitor.on(event, lambda monitor, timestamp, value, event=event: fired.append(event))
+
+    return fired
+
+def feed(monitor, values):
+    for i, value in enumerate(values):
+        monitor.record(float(i), value)
+
+def test_pick_and_drop(lumen):
+    monitor = PressureMonitor(lumen.leftPump, window = 3)
+    fired = events(monitor)
+
+    feed(monitor, [0, 0, 0, -150000, -150000])
+    assert fired == []
+
+    feed(monitor, [-150000])
+    assert fired == ["picked"]
+    assert monitor.sealed
+
+    # back above the threshold, but not past the hysteresis
+    feed(monitor, [-90000] * 5)
+    assert fired == ["picked"]
+
+    feed(monitor, [0] * 3)
+    assert fired == ["picked", "dropped"]
+    assert not monitor.sealed
+
+def test_seal_with_nothing_expected_is_a_clog(lumen):
+    monitor = PressureMonitor(lumen.leftPump, window = 3)
+    monitor.expectEmpty = True
+    fired = events(monitor)
+
+    feed(monitor, [-150000] * 3)
+    assert fired == ["clogged"]
+
+def test_samples_wrap_around(lumen):
+    monitor = PressureMonitor(lumen.leftPump, size = 4)
+
+    feed(monitor, [1, 2, 3, 4, 5, 6])
+
+    times, values = monitor.samples()
+    assert list(values) == [3, 4, 5, 6]
+    assert list(times) == [2, 3, 4, 5]
+    assert monitor.latest() == (5, 6)
+
+def test_monitor_samples_the_sensor(lumen):
+    picked = threading.Event()
+
+    lumen.leftPump.startMonitor(window = 3).on("picked", lambda *args: picked.set())
+    lumen.sm._ser.sensors[1].pressure = -150000
+
+    assert picked.wait(5)
+
+def test_disconnect_stops_the_monitor(lumen):
+    monitor = lumen.rightPump.startMonitor()
+
+    lumen.disconnect()
+
+    assert monitor._thread is None
+    assert not monitor._running
@@ -0,0 +1,126 @@
+import pytest
+
+from leash import VirtualLumen
+from leash.logger import Logger
+from leash.photon import Photon, Commands, Status
+from leash.sim import feederBank, frame
+
+class GarblingLumen(VirtualLumen):
+
+    # flips the crc of the next garble feeder replies
+    def __init__(self, garble = 0, **settings):
+
+        super().__init__(**settings)
+
+        self.garble = garble
+
+    def _rs485(self, packetString):
+        replies = super()._rs485(packetString)
+
+        if self.garble and replies[0] != "rs485-reply: TIMEOUT":
+            self.garble = self.garble - 1
+
+            reply = bytearray.fromhex(replies[0][len("rs485-reply: "):])
+            reply[4] = reply[4] ^ 0xFF
+            replies[0] = "rs485-reply: " + reply.hex()
+
+        return replies
+
+@pytest.fixture
+def sim():
+    return GarblingLumen(feeders = feederBank([1, 2]))
+
+@pytest.fixture
+def photon(connect, sim):
+    photon = connect(sim = sim).photon
+
+    assert set(photon.scan(1, 4)) == {1, 2}
+    return photon
+
+def retries(photon, address):
+    return photon.metrics.counter("leash_photon_retries_total", address=address)
+
+def test_bad_crc_is_retried(photon, sim):
+    sim.garble = 2
+
+    assert photon.getFeederUUID(1) == sim.feeders[1].uuid
+    assert retries(photon, 1) == 2
+    assert photon.metrics.counter("leash_photon_crc_errors_total", address=1) == 2
+
+def test_retries_run_out(photon, sim):
+    sim.garble = photon.retries + 1
+
+    assert photon.getFeederUUID(1) is False
+    assert retries(photon, 1) == photon.retries
+
+def test_feeds_are_not_retried(photon, sim):
+    # a feed that went through but lost its reply would run twice
+    sim.garble = 1
+
+    assert photon.moveFeedForward(1, 20) is False
+    assert retries(photon, 1) == 0
+
+def test_empty_address_is_not_retried(photon):
+    assert photon.getFeederUUID(9) == -1
+    assert retries(photon, 9) == 0
+    assert photon.metrics.counter("leash_photon_timeouts_total", address=9) == 1
+
+def test_submitted_packets_are_retried(photon, sim):
+    sim.garble = 1
+
+    future = photon.submitPacket(2, Commands.GET_FEEDER_ID)
+
+    assert photon.resultOf(future) == [Status.OK] + sim.feeders[2].uuid
+    assert retries(photon, 2) == 1
+
+def test_queue_time_isnt_reply_time(connect):
+    # a status read stuck behind moves in a full planner takes longer than
+    # the learned timeout, but none of that is the feeder's doing
+    lumen = connect(feeders = feederBank([1]), timeScale = 1.0, plannerSize = 2)
+    photon = lumen.photon
+
+    assert set(photon.scan(1, 2)) == {1}
+
+    for i in range(5):
+        assert photon.getFeedStatus(1) == Status.OK
+
+    assert photon.timeoutFor(1) == photon.minTimeout
+
+    assert lumen.gotoSequence([{"x": 100 * (i % 2 + 1)} for i in range(6)])
+    assert photon.getFeedStatus(1) == Status.OK
+
+    assert retries(photon, 1) == 0
+    assert photon.timeoutFor(1) == photon.minTimeout
+
+def reply(address, packetID):
+    return "rs485-reply: " + frame(address, packetID, [Status.OK]).hex()
+
+@pytest.fixture
+def detached():
+    return Photon(None, Logger(False).child("photon"))
+
+def test_late_reply_is_told_apart(detached):
+    _, first = detached.buildRequest(1, Commands.MOVE_FEED_STATUS)
+    _, second = detached.buildRequest(1, Commands.MOVE_FEED_STATUS)
+
+    # the first packet's reply shows up while waiting on the second
+    assert detached.parseResponse(reply(1, first), 1, second) is False
+
+    assert detached.metrics.counter("leash_photon_late_replies_total", address=1) == 1
+    assert detached.metrics.counter("leash_photon_bad_packets_total", address=1) == 0
+
+def test_duplicate_reply_is_told_apart(detached):
+    _, first = detached.buildRequest(1, Commands.MOVE_FEED_STATUS)
+
+    assert detached.parseResponse(reply(1, first), 1, first) == [Status.OK]
+
+    _, second = detached.buildRequest(1, Commands.MOVE_FEED_STATUS)
+
+    assert detached.parseResponse(reply(1, first), 1, second) is False
+    assert detached.metrics.counter("leash_photon_duplicate_replies_total", address=1) == 1
+
+def test_stray_reply_is_a_bad_packet(detached):
+    _, sentPacketID = detached.buildRequest(1, Commands.MOVE_FEED_STATUS)
+
+    assert detached.parseResponse(reply(1, sentPacketID + 100), 1, sentPacketID) is False
+    assert detached.metrics.counter("leash_photon_bad_packets_total", address=1) == 1
@@ -0,0 +1,42 @@
+import random
+
+import pytest
+
+from leash import Placement
+from leash.planner import orderPlacements, travel
+
+def placements(seed, count = 30):
+    rng = random.Random(seed)
+
+    def point():
+        return (rng.uniform(0, 300), rng.uniform(0, 300), 10)
+
+    return [Placement(point(), point()) for i in range(count)]
+
+@pytest.mark.parametrize("start", [None, (0, 0)])
+@pytest.mark.parametrize("seed", range(20))
+def test_two_opt_never_worsens_nearest_neighbour(seed, start):
+    jobs = placements(seed)
+
+    # no passes leaves the nearest neighbour tour as it is
+    nearest = orderPlacements(jobs, start = start, passes = 0)
+    optimized = orderPlacements(jobs, start = start)
+
+    assert sorted(map(id, optimized)) == sorted(map(id, jobs))
+    assert travel(optimized, start) <= travel(nearest, start) + 1e-9
+
+def test_two_opt_improves_some_tours():
+    improved = 0
+
+    for seed in range(20):
+        jobs = placements(seed)
+        if travel(orderPlacements(jobs, start = (0, 0)), (0, 0)) < travel(orderPlacements(jobs, start = (0, 0), passes = 0), (0, 0)) - 1e-9:
+            improved = improved + 1
+
+    assert improved > 0
+
+def test_short_jobs_are_left_alone():
+    jobs = placements(0, count = 1)
+
+    assert orderPlacements(jobs) == jobs
+    assert orderPlacements([]) == []
@@ -0,0 +1,65 @@
+import asyncio, threading
+
+from leash import AsyncLumen
+from leash.pump import toPressure, toTemperature
+
+from conftest import sent
+
+def expected(raw):
+    raw = raw & 0xFFFFFF
+    return toPressure(raw >> 16, (raw >> 8) & 0xFF, raw & 0xFF)
+
+def setSensors(lumen):
+    sensors = lumen.sm._ser.sensors
+
+    sensors[1].pressure = 1000
+    sensors[1].temperature = 21.5
+    sensors[2].pressure = -2000
+    sensors[2].temperature = 30.25
+
+def test_reads_both_channels(lumen):
+    setSensors(lumen)
+
+    assert lumen.leftPump.getPressure() == expected(1000)
+    assert lumen.rightPump.getPressure() == expected(-2000)
+
+    assert lumen.leftPump.getTemperature() == toTemperature(21, 128)
+    assert lumen.rightPump.getTemperature() == toTemperature(30, 64)
+
+def test_mux_select_is_skipped_on_the_same_channel(lumen):
+    setSensors(lumen)
+
+    for i in range(3):
+        assert lumen.leftPump.getPressure() == expected(1000)
+
+    # once by the boot commands, which leave channel 2 selected, and once
+    # for the first read
+    assert sent(lumen, "M260 A112 B1 S1") == ["M260 A112 B1 S1"] * 2
+
+def test_concurrent_reads_dont_interleave(lumen):
+    setSensors(lumen)
+
+    reads = {"LEFT": [], "RIGHT": []}
+
+    def read(pump):
+        for i in range(25):
+            reads[pump.index].append(pump.getPressure())
+
+    threads = [threading.Thread(target=read, args=(pump,)) for pump in (lumen.leftPump, lumen.rightPump)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert reads["LEFT"] == [expected(1000)] * 25
+    assert reads["RIGHT"] == [expected(-2000)] * 25
+
+def test_async_reads_dont_interleave(lumen):
+    setSensors(lumen)
+
+    async def run():
+        alumen = AsyncLumen(lumen)
+        return await asyncio.gather(*[pump.get_pressure() for pump in (alumen.leftPump, alumen.rightPump) * 10])
+
+    assert asyncio.run(run()) == [expected(1000), expected(-2000)] * 10
@@ -0,0 +1,129 @@
+import asyncio, time
+
+import pytest
+
+from leash import AsyncLumen, Recorder, Trace, VirtualLumen, replay
+from leash.photon import Commands, Status
+from leash.recorder import Kind
+from leash.sim import feederBank, frame
+
+def reply(address, packetID):
+    return frame(address, packetID, [Status.OK]).hex()
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "bus.lpbr")
+
+    with Recorder(path) as recorder:
+        recorder.request(1, 7, bytes.fromhex("010007011e"))
+        recorder.reply(1, 7, reply(1, 7))
+        recorder.reply(2, 8, "TIMEOUT")
+        recorder.reply(3, 9, "not hex")
+        recorder.reply(4, 10, None)
+        recorder.late(4, 10, reply(4, 10))
+
+        assert recorder.frames == 6
+
+    with Trace(path) as trace:
+        frames = list(trace)
+
+    assert [frame.kind for frame in frames] == [Kind.REQUEST, Kind.REPLY, Kind.TIMEOUT, Kind.GARBLED, Kind.LOST, Kind.LATE]
+    assert [frame.packetID for frame in frames] == [7, 7, 8, 9, 10, 10]
+    assert bytes(frames[0].data).hex() == "010007011e"
+    assert frames[1].response() == "rs485-reply: " + reply(1, 7)
+    assert frames[3].response() == "rs485-reply: not hex"
+    assert frames[5].response() == "rs485-reply: " + reply(4, 10)
+    assert all(a.time <= b.time for a, b in zip(frames, frames[1:]))
+
+def test_replay_gives_back_what_the_session_saw(tmp_path):
+    path = str(tmp_path / "bus.lpbr")
+
+    with Recorder(path) as recorder:
+        recorder.request(1, 7, b"")
+        recorder.reply(1, 7, reply(1, 7))
+        recorder.request(2, 8, b"")
+        recorder.reply(2, 8, "TIMEOUT")
+        recorder.request(3, 9, b"")
+        recorder.reply(3, 9, "zz")
+        recorder.request(4, 10, b"")
+        recorder.reply(4, 10, None)
+        recorder.late(4, 10, reply(4, 10))
+
+    assert [resp for frame, resp in replay(path)] == [[Status.OK], -1, False, -1]
+
+def test_cut_off_trace_ends_early(tmp_path):
+    path = str(tmp_path / "bus.lpbr")
+
+    with Recorder(path) as recorder:
+        recorder.reply(1, 7, reply(1, 7))
+        recorder.reply(1, 8, reply(1, 8))
+
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 2)
+
+    with Trace(path) as trace:
+        assert [frame.packetID for frame in trace] == [7]
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"not a bus log at all")
+
+    with pytest.raises(ValueError):
+        Trace(str(path))
+
+class SlowLumen(VirtualLumen):
+
+    # the next feeder reply takes delay seconds longer
+    def __init__(self, **settings):
+
+        super().__init__(**settings)
+
+        self.delay = 0
+
+    def _rs485(self, packetString):
+        if self.delay:
+            time.sleep(self.delay)
+            self.delay = 0
+
+        return super()._rs485(packetString)
+
+@pytest.fixture
+def slow(connect, tmp_path):
+    sim = SlowLumen(feeders = feederBank([1]))
+    lumen = connect(sim = sim)
+
+    assert set(lumen.photon.scan(1, 2)) == {1}
+
+    # learns the feeder's timeout, which a slow reply then overruns
+    for i in range(5):
+        assert lumen.photon.getFeedStatus(1) == Status.OK
+
+    lumen.photon.recorder = Recorder(str(tmp_path / "bus.lpbr"))
+    sim.delay = lumen.photon.timeoutFor(1) * 2
+
+    return lumen
+
+def lateFrames(lumen):
+    lumen.photon.recorder.close()
+
+    with Trace(lumen.photon.recorder.path) as trace:
+        frames = [(frame.kind, frame.packetID) for frame in trace if frame.kind in (Kind.LOST, Kind.LATE)]
+
+    assert [kind for kind, packetID in frames] == [Kind.LOST, Kind.LATE]
+    assert frames[0][1] == frames[1][1]
+
+def test_late_reply_is_recorded(slow):
+    assert slow.photon.getFeedStatus(1) == Status.OK
+    assert slow.sm.drain()
+
+    assert slow.metrics.counter("leash_photon_late_replies_total", address=1) == 1
+    lateFrames(slow)
+
+def test_async_late_reply_is_recorded(slow):
+    async def status():
+        return await AsyncLumen(slow).photon.send_packet(1, Commands.MOVE_FEED_STATUS)
+
+    assert asyncio.run(status()) == [Status.OK]
+    assert slow.sm.drain()
+
+    assert slow.metrics.counter("leash_photon_late_replies_total", address=1) == 1
+    lateFrames(slow)
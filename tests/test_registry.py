@@ -0,0 +1,72 @@
+import os
+
+from leash import FeederRegistry
+from leash.photon import Feeder
+from leash.sim import feederBank
+
+from conftest import sent
+
+def test_round_trip(cacheDir):
+    registry = FeederRegistry()
+    feeder = Feeder([1] * 12, 7, 2)
+
+    registry.update({7: feeder})
+    registry.assignSlot(feeder.uuid, "A3")
+    registry.save()
+
+    loaded = FeederRegistry()
+
+    assert loaded.path == os.path.join(str(cacheDir), "feeders.json")
+    assert loaded.known() == [([1] * 12, 7, 2)]
+    assert loaded.slotOf([1] * 12) == "A3"
+
+    loaded.forget([1] * 12)
+    assert loaded.known() == []
+
+def test_missing_or_corrupt_file_is_empty(cacheDir):
+    assert FeederRegistry().known() == []
+
+    with open(os.path.join(str(cacheDir), "feeders.json"), "w") as f:
+        f.write("{not json")
+
+    assert FeederRegistry().known() == []
+
+def test_machines_get_their_own_file(cacheDir):
+    assert FeederRegistry.forMachine("A/1").path == os.path.join(str(cacheDir), "feeders-A_1.json")
+
+def remember(feeders):
+    registry = FeederRegistry()
+    for address, feeder in feeders.items():
+        registry.update({address: Feeder(feeder.uuid, address, 1)})
+    registry.save()
+
+def test_reconnect_initializes_known_feeders(connect):
+    feeders = feederBank([3, 40])
+    remember(feeders)
+
+    lumen = connect(feeders = feeders)
+
+    assert set(lumen.photon.reconnect()) == {3, 40}
+    assert all(feeder.initialized for feeder in feeders.values())
+
+    # no broadcasts, and no other address was probed
+    assert not sent(lumen, "M485 ff")
+    assert len(sent(lumen, "M485")) == 2
+
+def test_reconnect_follows_a_moved_feeder(connect):
+    feeders = feederBank([3])
+    remember(feeders)
+
+    # the same feeder, now in another slot
+    lumen = connect(feeders = {5: feeders[3]})
+
+    assert set(lumen.photon.reconnect()) == {5}
+    assert FeederRegistry().known() == [(feeders[3].uuid, 5, 1)]
+
+def test_reconnect_forgets_feeders_that_are_gone(connect):
+    remember(feederBank([3]))
+
+    lumen = connect(feeders = feederBank([9]))
+
+    assert set(lumen.photon.reconnect(min = 1, max = 12)) == {9}
+    assert [address for uuid, address, version in FeederRegistry().known()] == [9]
@@ -0,0 +1,76 @@
+from leash import VirtualLumen
+
+class LossyLumen(VirtualLumen):
+
+    # never sends the ok for the lines in lose, like one lost on the wire
+    def __init__(self, lose, **settings):
+
+        super().__init__(**settings)
+
+        self.lose = set(lose)
+
+    def handle(self, line):
+        replies = super().handle(line)
+
+        if line in self.lose:
+            self.lose.discard(line)
+            replies = [reply for reply in replies if not reply.startswith("ok")]
+
+        return replies
+
+def test_oks_resolve_their_own_commands(lumen):
+    futures = [lumen.sm.submit("M118 E1 line:" + str(i)) for i in range(20)]
+
+    for i, future in enumerate(futures):
+        assert future.result(5).splitlines() == ["echo:line:" + str(i), "ok"]
+
+    assert not lumen.sm._pending
+
+def test_pipelining_keeps_to_bufsize(connect):
+    lumen = connect(bufsize=4, commandTime=0.002)
+
+    assert lumen.sm.stream(["M118 E1 line:" + str(i) for i in range(20)])
+    assert len(lumen.sm._pending) <= lumen.sm.bufsize
+    assert lumen.sm.drain()
+
+def test_comment_lines_are_answered_locally(lumen):
+    before = len(lumen.sm._ser.received)
+
+    assert lumen.sm.send("; just a comment") == "ok"
+    assert lumen.sm.send("   ") == "ok"
+    assert len(lumen.sm._ser.received) == before
+
+    assert lumen.sm.send("M118 E1 after ; trailing comment").splitlines() == ["echo:after", "ok"]
+
+def test_lost_ok_resyncs(connect):
+    lumen = connect(sim=LossyLumen(["M118 E1 lost"]))
+
+    assert lumen.sm.send("M118 E1 lost", timeout=0.2) == ""
+
+    # the next reply goes to the next command, not the one that lost its ok
+    assert lumen.sm.send("M118 E1 next", timeout=2).splitlines() == ["echo:next", "ok"]
+    assert lumen.sm.drain(2)
+
+    assert lumen.metrics.counter("leash_serial_lost_oks_total", code="M118") == 1
+
+def test_slow_command_is_not_dropped_by_resync(connect):
+    lumen = connect(timeScale=1.0)
+
+    lumen.goto(x=200)
+    future = lumen.sm.submit("M400")
+
+    assert lumen.sm.send("M118 E1 early", timeout=0.01) == ""
+    assert future.result(5) == "ok"
+    assert lumen.metrics.counter("leash_serial_lost_oks_total", code="M400") == 0
+
+def test_resends_keep_replies_in_order(connect):
+    lumen = connect(lineErrorRate=0.05, seed=3)
+
+    assert lumen.sm.enableChecksums()
+
+    futures = [lumen.sm.submit("M118 E1 line:" + str(i)) for i in range(100)]
+
+    for i, future in enumerate(futures):
+        assert future.result(5).splitlines() == ["echo:line:" + str(i), "ok"]
+
+    assert lumen.metrics.counter("leash_serial_resends_total", code="M118") > 0
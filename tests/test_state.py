@@ -0,0 +1,81 @@
+from conftest import sent
+
+def test_repeated_goto_is_elided(lumen):
+    lumen.goto(x=10, y=20)
+    lumen.goto(x=10, y=20)
+
+    assert sent(lumen, "G0 X") == ["G0 X10 Y20"]
+
+def test_unchanged_axes_are_dropped(lumen):
+    lumen.goto(x=10, y=20)
+    lumen.goto(x=10, y=25)
+
+    assert sent(lumen, "G0")[-1] == "G0 Y25"
+
+def test_repeated_light_is_elided(lumen):
+    lumen.lightOn("TOP")
+    lumen.lightOn("TOP")
+    lumen.lightOn("BOT")
+
+    assert len(sent(lumen, "M150")) == 2
+
+def test_unknown_gcode_invalidates_position(lumen):
+    lumen.goto(x=10, y=20)
+    lumen.sm.send("G29")
+
+    assert lumen.position["x"] is None
+
+    lumen.goto(x=10, y=20)
+    assert sent(lumen, "G0 X10 Y20") == ["G0 X10 Y20", "G0 X10 Y20"]
+
+def test_unknown_mcode_keeps_position(lumen):
+    lumen.goto(x=10, y=20)
+    lumen.sm.send("M115")
+
+    assert lumen.position["x"] == 10
+    assert lumen.position["y"] == 20
+
+def test_relative_moves_are_never_elided(lumen):
+    lumen.sm.send("G91")
+    lumen.goto(x=1)
+    lumen.goto(x=1)
+    lumen.sm.send("G90")
+
+    assert sent(lumen, "G0 X1") == ["G0 X1", "G0 X1"]
+    assert lumen.position["x"] is None
+
+def test_reconnect_forgets_state(lumen):
+    lumen.lightOn("TOP")
+    lumen.disconnect()
+
+    assert lumen.connect()
+
+    lumen.lightOn("TOP")
+    assert len(sent(lumen, "M150")) == 2
+
+def test_homing_zeroes_position(lumen):
+    assert lumen.position["x"] is None
+
+    assert lumen.home()
+
+    for axis in ("x", "y", "z"):
+        assert lumen.position[axis] == 0
+
+    # the machine is already there
+    lumen.goto(x=0, y=0, z=0)
+    assert sent(lumen, "G0 X") == []
+
+def test_partial_homing_only_moves_its_axes(lumen):
+    lumen.goto(x=10, y=20, z=5)
+    lumen.home(x=True, y=False, z=False)
+
+    assert lumen.position["x"] == 0
+    assert lumen.position["y"] == 20
+    assert lumen.position["z"] == 5
+
+def test_moves_from_an_unknown_position_take_no_time(lumen):
+    assert lumen.motion is lumen.state.motion
+    assert lumen.estimate([{"x": 100}]) == 0
+
+    assert lumen.home()
+    assert lumen.estimate([{"x": 100}]) > 0
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+from leash import FiducialFinder, PartFinder
+
+def disc(x = 320, y = 240, radius = 20):
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    cv2.circle(image, (x, y), radius, (255, 255, 255), -1)
+    return image
+
+def template():
+    image = np.zeros((61, 61), dtype=np.uint8)
+    cv2.circle(image, (30, 30), 20, 255, -1)
+    return image
+
+# fresh finders for each test, the buffers are kept between calls
+FINDERS = {
+    "moments": lambda: FiducialFinder(mode = "moments"),
+    "hough": lambda: FiducialFinder(mode = "hough"),
+    "template": lambda: FiducialFinder(mode = "template", template = template()),
+    "scaled": lambda: FiducialFinder(mode = "moments", scale = 0.5),
+    "part": lambda: PartFinder(),
+}
+
+def blank():
+    return np.zeros((480, 640, 3), dtype=np.uint8)
+
+def gray():
+    return np.full((480, 640, 3), 128, dtype=np.uint8)
+
+def noise():
+    return np.random.default_rng(1).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+
+@pytest.mark.parametrize("frame", [blank, gray, noise])
+@pytest.mark.parametrize("finder", FINDERS)
+def test_empty_frames_find_nothing(finder, frame):
+    assert FINDERS[finder]().find(frame()) is False
+
+@pytest.mark.parametrize("finder", FINDERS)
+def test_disc_is_found(finder):
+    found = FINDERS[finder]().find(disc(300, 250))
+
+    assert found is not False
+    assert found[0] == pytest.approx(300, abs=1)
+    assert found[1] == pytest.approx(250, abs=1)
+
+def test_square_is_not_a_fiducial():
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    cv2.rectangle(image, (300, 220), (340, 260), (255, 255, 255), -1)
+
+    assert FiducialFinder(mode = "moments").find(image) is False
+
+def test_cut_off_part_is_not_found():
+    assert PartFinder().find(disc(5, 240)) is False